@@ -59,4 +59,78 @@ class DotDict(dict):
         if name in dir(self):
             super(DotDict, self).__delattr__(name)
         else:
-            del self[name]
\ No newline at end of file
+            del self[name]
+
+
+def convertToLazyDotDict(struct):
+    """
+    Like convertToDotDictRecurse(), but only wraps the top level of
+    @struct. Nested dicts and lists are converted the first time they are
+    accessed, so reading a few fields of a large message is cheap.
+    """
+    if type(struct) is dict:
+        return LazyDotDict(struct)
+    elif type(struct) is list:
+        return LazyDotList(struct)
+    else:
+        return struct
+
+
+class LazyDotDict(DotDict):
+    """
+    A DotDict whose nested dicts and lists are converted to LazyDotDict
+    and LazyDotList when they are first read, then stored back so each
+    value is converted at most once.
+    """
+
+    def __getitem__(self, key):
+        value = dict.__getitem__(self, key)
+        converted = convertToLazyDotDict(value)
+        if converted is not value:
+            dict.__setitem__(self, key, converted)
+        return converted
+
+    def get(self, key, default=None):
+        if key in self:
+            return self[key]
+        return default
+
+    def itervalues(self):
+        for key in self:
+            yield self[key]
+
+    def iteritems(self):
+        for key in self:
+            yield key, self[key]
+
+    def values(self):
+        return list(self.itervalues())
+
+    def items(self):
+        return list(self.iteritems())
+
+    def copy(self):
+        return LazyDotDict(self)
+
+
+class LazyDotList(list):
+    """
+    A list whose dict and list elements are converted to LazyDotDict and
+    LazyDotList when they are first read.
+    """
+
+    def __getitem__(self, index):
+        value = list.__getitem__(self, index)
+        if isinstance(index, slice):
+            return LazyDotList(value)
+        converted = convertToLazyDotDict(value)
+        if converted is not value:
+            list.__setitem__(self, index, converted)
+        return converted
+
+    def __getslice__(self, i, j):
+        return LazyDotList(list.__getslice__(self, i, j))
+
+    def __iter__(self):
+        for i in xrange(len(self)):
+            yield self[i]
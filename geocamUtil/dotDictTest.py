@@ -0,0 +1,58 @@
+#__BEGIN_LICENSE__
+# Copyright (c) 2017, United States Government, as represented by the
+# Administrator of the National Aeronautics and Space Administration.
+# All rights reserved.
+#
+# The GeoRef platform is licensed under the Apache License, Version 2.0
+# (the "License"); you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+# http://www.apache.org/licenses/LICENSE-2.0.
+#
+# Unless required by applicable law or agreed to in writing, software distributed
+# under the License is distributed on an "AS IS" BASIS, WITHOUT WARRANTIES OR
+# CONDITIONS OF ANY KIND, either express or implied. See the License for the
+# specific language governing permissions and limitations under the License.
+#__END_LICENSE__
+
+import unittest
+
+from geocamUtil.dotDict import DotDict, LazyDotDict, LazyDotList, convertToLazyDotDict
+
+
+class LazyDotDictTest(unittest.TestCase):
+    def setUp(self):
+        self.struct = {'a': 1,
+                       'b': {'c': {'d': 2}},
+                       'e': [{'f': 3}, [4, {'g': 5}]]}
+        self.obj = convertToLazyDotDict(self.struct)
+
+    def test_attributes(self):
+        self.assertTrue(isinstance(self.obj, DotDict))
+        self.assertEqual(1, self.obj.a)
+        self.assertEqual(2, self.obj.b.c.d)
+        self.assertEqual(3, self.obj.e[0].f)
+        self.assertEqual(5, self.obj.e[1][1].g)
+
+    def test_lazy(self):
+        self.assertEqual(dict, type(dict.__getitem__(self.obj, 'b')))
+        b = self.obj.b
+        self.assertEqual(LazyDotDict, type(b))
+        # converted once, then stored back
+        self.assertTrue(b is self.obj.b)
+        self.assertEqual(dict, type(dict.__getitem__(b, 'c')))
+
+    def test_iteration(self):
+        self.assertTrue(all([isinstance(v, (int, DotDict, LazyDotList))
+                             for v in self.obj.values()]))
+        self.assertEqual([LazyDotDict, LazyDotList],
+                         [type(elt) for elt in self.obj.e])
+        self.assertEqual(LazyDotList, type(self.obj.e[1:]))
+        self.assertEqual(5, self.obj.e[1:][0][1].g)
+        self.assertEqual(None, self.obj.get('missing'))
+
+    def test_equal(self):
+        self.assertEqual(self.struct, self.obj)
+
+
+if __name__ == '__main__':
+    unittest.main()
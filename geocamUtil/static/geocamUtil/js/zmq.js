@@ -6,7 +6,11 @@
 
 /* url: url to connect to zmqProxy.py websockets server
    opts: can specify 'onopen' and 'onclose' handlers.
-         can set autoReconnect to true. */
+         can set autoReconnect to true.
+         can set batchMsecs to have the proxy batch messages into one
+         frame every batchMsecs, and batchMaxMessages to limit the
+         messages per frame. batches are unpacked transparently.
+         can set deflate to true to ask for per-message compression. */
 ZmqManager = function(url, opts) {
     this.url = url;
     this.opts = opts;
@@ -27,7 +31,11 @@ ZmqManager.prototype.connect = function() {
     if (this.socket != null) {
         return;
     }
-    this.socket = new WebSocket(this.url);
+    var url = this.url;
+    if (this.opts.deflate) {
+        url += (url.indexOf('?') == -1 ? '?' : '&') + 'deflate=1';
+    }
+    this.socket = new WebSocket(url);
     this.socket.onmessage = function(self) {
         return function() {
             self.onmessage.apply(self, arguments);
@@ -135,11 +143,27 @@ ZmqManager.prototype.handleResponse = function(topic, body) {
     }
 };
 
+ZmqManager.BATCH_PREFIX = 'zmqProxy.batch:';
+ZmqManager.BATCH_SEPARATOR = '\x1e';
+
 ZmqManager.prototype.onmessage = function(msg) {
-    var colonIndex = msg.data.search(':');
-    var topicWithColon = msg.data.substr(0, colonIndex + 1);
-    var topic = msg.data.substr(0, colonIndex);
-    var body = msg.data.substr(colonIndex + 1);
+    var data = msg.data;
+    if (data.lastIndexOf(ZmqManager.BATCH_PREFIX, 0) == 0) {
+        var messages = data.substr(ZmqManager.BATCH_PREFIX.length)
+            .split(ZmqManager.BATCH_SEPARATOR);
+        for (var i = 0; i < messages.length; i++) {
+            this.dispatch(messages[i]);
+        }
+    } else {
+        this.dispatch(data);
+    }
+};
+
+ZmqManager.prototype.dispatch = function(data) {
+    var colonIndex = data.indexOf(':');
+    var topicWithColon = data.substr(0, colonIndex + 1);
+    var topic = data.substr(0, colonIndex);
+    var body = data.substr(colonIndex + 1);
 
     // special case: handle jsonrpc response
     if (topic == 'zmqProxy.response') {
@@ -155,6 +179,13 @@ ZmqManager.prototype.onmessage = function(msg) {
 };
 
 ZmqManager.prototype.onopen = function() {
+    if (this.opts.batchMsecs) {
+        var params = {'intervalMsecs': this.opts.batchMsecs};
+        if (this.opts.batchMaxMessages) {
+            params.maxMessages = this.opts.batchMaxMessages;
+        }
+        this.sendRequest('setBatch', params);
+    }
     if (this.opts.onopen) {
         this.opts.onopen(this);
     }
@@ -20,6 +20,7 @@
 from geocamUtil.models.timestampDescriptorTest import TimestampDescriptorTest
 from geocamUtil.MultiSettingsTest import MultiSettingsTest
 from geocamUtil.anyjsonTest import AnyJsonTest
+from geocamUtil.dotDictTest import LazyDotDictTest
 from geocamUtil.models.UuidFieldTest import UuidFieldTest
 from geocamUtil.models.ExtrasFieldTest import ExtrasFieldTest
 from geocamUtil.models.jsonFieldTest import JsonFieldTest
@@ -28,6 +29,22 @@ from geocamUtil.InstallerTest import InstallerTest
 from geocamUtil.storeTest import StoreTest
 from geocamUtil.icons.rotateTest import IconsRotateTest
 from geocamUtil.icons.svgTest import IconsSvgTest
+from geocamUtil.zmqUtil.modelSerializerTest import ModelSerializerTest
+from geocamUtil.zmqUtil.messageCodecTest import MessageCodecTest
+from geocamUtil.zmqUtil.messageFilterTest import MessageFilterTest
+from geocamUtil.zmqUtil.zmqBridgeTest import ZmqBridgeTest
+from geocamUtil.zmqUtil.utilTest import (LogParserTest,
+                                         MmapLogParserTest,
+                                         MergedLogParserTest,
+                                         MultipartTest)
+from geocamUtil.zmqUtil.zmqPlaybackTest import ZmqPlaybackTest
+from geocamUtil.zmqUtil.zmqStatLogsTest import ZmqStatLogsTest
+from geocamUtil.zmqUtil.zmqProxyTest import ZmqProxyTest
+from geocamUtil.zmqUtil.logIndexTest import LogIndexTest
+from geocamUtil.zmqUtil.logWriterTest import MessageLogWriterTest, LogRotationTest
+from geocamUtil.zmqUtil.trafficStatsTest import TrafficStatsTest
+from geocamUtil.zmqUtil.subscriberTest import SubscriberTest
+from geocamUtil.zmqUtil.zmqSortLogsTest import ZmqSortLogsTest
 
 # commandsTest is destructive and should only be run in the example site for geocamUtil
 from geocamUtil.management import commandUtil
@@ -0,0 +1,144 @@
+#__BEGIN_LICENSE__
+# Copyright (c) 2017, United States Government, as represented by the
+# Administrator of the National Aeronautics and Space Administration.
+# All rights reserved.
+#
+# The GeoRef platform is licensed under the Apache License, Version 2.0
+# (the "License"); you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+# http://www.apache.org/licenses/LICENSE-2.0.
+#
+# Unless required by applicable law or agreed to in writing, software distributed
+# under the License is distributed on an "AS IS" BASIS, WITHOUT WARRANTIES OR
+# CONDITIONS OF ANY KIND, either express or implied. See the License for the
+# specific language governing permissions and limitations under the License.
+#__END_LICENSE__
+
+"""
+Content-addressed storage for message attachments logged by zmqCentral.
+
+Each attachment is stored once under its SHA-1 digest:
+
+  <logDir>/attachments/sha1/<first 2 hex digits>/<remaining hex digits>
+
+The attachments field of the message log record refers to the stored
+files with a reference in the format:
+
+  sha1:<digest>=<quoted filename>,<digest>=<quoted filename>,...
+
+Older logs instead store a directory path relative to the log
+directory; getAttachmentFiles() understands both.
+"""
+
+import os
+import hashlib
+import tempfile
+import urllib
+import traceback
+
+from geocamUtil.zmqUtil.util import parseMessage
+
+ATTACHMENT_REF_PREFIX = 'sha1:'
+
+
+def getAttachmentStoreDir(logDir):
+    return os.path.join(logDir, 'attachments', 'sha1')
+
+
+def getAttachmentPath(storeDir, digest):
+    return os.path.join(storeDir, digest[:2], digest[2:])
+
+
+def storeAttachment(storeDir, data):
+    """
+    Stores @data under its digest in @storeDir unless an identical
+    attachment is already there. Returns (digest, numBytesWritten).
+    """
+    digest = hashlib.sha1(data).hexdigest()
+    path = getAttachmentPath(storeDir, digest)
+    if os.path.exists(path):
+        return digest, 0
+
+    parentDir = os.path.dirname(path)
+    if not os.path.exists(parentDir):
+        try:
+            os.makedirs(parentDir)
+        except OSError:
+            # another worker may have created it first
+            if not os.path.isdir(parentDir):
+                raise
+
+    # write to a temp file and rename so readers and concurrent
+    # writers never see a partial attachment
+    fd, tmpPath = tempfile.mkstemp(dir=parentDir, prefix='.tmp')
+    try:
+        os.write(fd, data)
+    finally:
+        os.close(fd)
+    os.rename(tmpPath, path)
+    return digest, len(data)
+
+
+def formatAttachmentRef(entries):
+    if not entries:
+        return '-'
+    return ATTACHMENT_REF_PREFIX + ','.join(['%s=%s' % (digest, urllib.quote(filename, safe=''))
+                                             for digest, filename in entries])
+
+
+def parseAttachmentRef(ref):
+    """
+    Returns the list of (digest, filename) pairs in @ref.
+    """
+    assert ref.startswith(ATTACHMENT_REF_PREFIX)
+    result = []
+    for entry in ref[len(ATTACHMENT_REF_PREFIX):].split(','):
+        if entry:
+            digest, quotedName = entry.split('=', 1)
+            result.append((digest, urllib.unquote(quotedName)))
+    return result
+
+
+def getAttachmentFiles(logDir, attachmentsPath):
+    """
+    Returns a list of (filename, fullPath) pairs for the attachments
+    of a message log record, given the record's attachments field.
+    """
+    if attachmentsPath == '-':
+        return []
+    if attachmentsPath.startswith(ATTACHMENT_REF_PREFIX):
+        storeDir = getAttachmentStoreDir(logDir)
+        return [(filename, getAttachmentPath(storeDir, digest))
+                for digest, filename in parseAttachmentRef(attachmentsPath)]
+    attachmentDir = os.path.join(logDir, attachmentsPath)
+    return [(filename, os.path.join(attachmentDir, filename))
+            for filename in sorted(os.listdir(attachmentDir))]
+
+
+def storeMessageAttachments(logDir, msg):
+    """
+    Parses raw message @msg, stores its attachments and returns a dict
+    with the message to log without its attachments ('msg'), the
+    attachment reference ('ref') and the number of attachment bytes
+    received and newly written. On failure returns a dict with the
+    traceback text in 'error'. Designed to run in a worker process.
+    """
+    try:
+        parsed = parseMessage(msg)
+        storeDir = getAttachmentStoreDir(logDir)
+        entries = []
+        numBytes = 0
+        numBytesWritten = 0
+        for i, attachment in enumerate(parsed['attachments']):
+            data = attachment.get_payload()
+            digest, written = storeAttachment(storeDir, data)
+            filename = attachment.get_filename() or 'attachment%d' % i
+            entries.append((digest, filename))
+            numBytes += len(data)
+            numBytesWritten += written
+        return {'msg': ':'.join((parsed['topic'], parsed['json'])),
+                'ref': formatAttachmentRef(entries),
+                'bytes': numBytes,
+                'bytesWritten': numBytesWritten}
+    except:  # pylint: disable=W0702
+        return {'error': traceback.format_exc()}
@@ -0,0 +1,119 @@
+#!/usr/bin/env python
+#__BEGIN_LICENSE__
+# Copyright (c) 2017, United States Government, as represented by the
+# Administrator of the National Aeronautics and Space Administration.
+# All rights reserved.
+#
+# The GeoRef platform is licensed under the Apache License, Version 2.0
+# (the "License"); you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+# http://www.apache.org/licenses/LICENSE-2.0.
+#
+# Unless required by applicable law or agreed to in writing, software distributed
+# under the License is distributed on an "AS IS" BASIS, WITHOUT WARRANTIES OR
+# CONDITIONS OF ANY KIND, either express or implied. See the License for the
+# specific language governing permissions and limitations under the License.
+#__END_LICENSE__
+
+"""
+Throughput benchmark for ZmqPublisher.sendRaw() with small telemetry
+messages. For comparison it also times the old send path, which
+flushed the ZMQStream after every message. A local SUB socket stands
+in for central so messages actually go out over tcp.
+
+The publisher sends faster than tcp drains, so the benchmark runs with
+--highWaterMark 0 (no limit) by default. With a finite high-water mark,
+messages past it are silently dropped, and the msgs/sec of that trial
+counts messages that never arrived. The received column shows how many
+actually did, and a trial that lost messages is flagged.
+"""
+
+import time
+
+import zmq
+
+from geocamUtil.zmqUtil.publisher import ZmqPublisher
+
+BODY = '{"x": 1.0, "y": 2.0, "z": 3.0, "timestamp": "1500000000000000"}'
+
+
+def legacySendRaw(publisher, topic, body):
+    publisher.pubStream.send('%s:%s' % (topic, body))
+    publisher.pubStream.flush()
+
+
+def drain(sink):
+    numReceived = 0
+    while sink.poll(200):
+        sink.recv()
+        numReceived += 1
+    return numReceived
+
+
+def benchmark(sink, endpoint, numMessages, numTopics, legacy=False, **kwargs):
+    p = ZmqPublisher('benchPublisher',
+                     centralSubscribeEndpoint=endpoint,
+                     heartbeatPeriodMsecs=3600 * 1000,
+                     **kwargs)
+    p.start()
+    time.sleep(0.2)  # let the connection come up
+    drain(sink)  # the bound sink only sends its subscription once polled
+    topics = ['vehicle.telemetry.sensor%d' % i for i in xrange(numTopics)]
+
+    start = time.time()
+    if legacy:
+        for i in xrange(numMessages):
+            legacySendRaw(p, topics[i % numTopics], BODY)
+    else:
+        for i in xrange(numMessages):
+            p.sendRaw(topics[i % numTopics], BODY)
+        p.flush()
+    elapsed = time.time() - start
+
+    p.heartbeatTimer.stop()
+    p.pubStream.close()
+    return numMessages / elapsed, p.numCoalesced, drain(sink)
+
+
+def main():
+    import optparse
+    parser = optparse.OptionParser('usage: %prog')
+    parser.add_option('-n', '--numMessages',
+                      default=50000, type='int',
+                      help='Number of messages to send per trial [%default]')
+    parser.add_option('-t', '--numTopics',
+                      default=10, type='int',
+                      help='Number of distinct topics [%default]')
+    parser.add_option('-e', '--endpoint',
+                      default='tcp://127.0.0.1:17899',
+                      help='Endpoint for the stand-in central socket [%default]')
+    parser.add_option('--highWaterMark',
+                      default=0, type='int',
+                      help='High-water mark for the publish socket, 0 for no limit [%default]')
+    opts, args = parser.parse_args()
+    if args:
+        parser.error('expected no args')
+
+    sink = zmq.Context.instance().socket(zmq.SUB)
+    sink.setsockopt(zmq.SUBSCRIBE, '')
+    sink.setsockopt(zmq.RCVHWM, 0)
+    sink.bind(opts.endpoint)
+
+    trials = [('flush every send (old)', dict(legacy=True)),
+              ('direct send', {}),
+              ('batchSize=100', dict(batchSize=100)),
+              ('batchSize=100 + coalesce', dict(batchSize=100, coalesce=['vehicle.telemetry.']))]
+    print '%-28s %14s %12s %12s' % ('mode', 'msgs/sec', 'coalesced', 'received')
+    for name, kwargs in trials:
+        rate, numCoalesced, numReceived = benchmark(sink, opts.endpoint, opts.numMessages,
+                                                    opts.numTopics,
+                                                    highWaterMark=opts.highWaterMark,
+                                                    **kwargs)
+        lost = ''
+        if numCoalesced + numReceived < opts.numMessages:
+            lost = '  (%d lost at the high-water mark)' % (opts.numMessages - numCoalesced - numReceived)
+        print '%-28s %14.0f %12d %12d%s' % (name, rate, numCoalesced, numReceived, lost)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,89 @@
+#!/usr/bin/env python
+#__BEGIN_LICENSE__
+# Copyright (c) 2017, United States Government, as represented by the
+# Administrator of the National Aeronautics and Space Administration.
+# All rights reserved.
+#
+# The GeoRef platform is licensed under the Apache License, Version 2.0
+# (the "License"); you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+# http://www.apache.org/licenses/LICENSE-2.0.
+#
+# Unless required by applicable law or agreed to in writing, software distributed
+# under the License is distributed on an "AS IS" BASIS, WITHOUT WARRANTIES OR
+# CONDITIONS OF ANY KIND, either express or implied. See the License for the
+# specific language governing permissions and limitations under the License.
+#__END_LICENSE__
+
+"""
+Micro-benchmark for ZmqSubscriber.routeMessage() as the number of
+subscribed prefixes grows. For comparison it also times a linear scan
+over the prefixes, which is how routeMessage() used to work.
+"""
+
+import time
+
+from geocamUtil.zmqUtil.subscriber import ZmqSubscriber
+
+
+def handleMessage(topic, body):
+    pass
+
+
+def linearRouteMessage(subscriber, msg):
+    colonIndex = msg.find(':')
+    topic = msg[:(colonIndex + 1)]
+    body = msg[(colonIndex + 1):]
+    handled = 0
+    for topicPrefix, registry in subscriber.handlers.iteritems():
+        if topic.startswith(topicPrefix):
+            for handler, _kind in registry.itervalues():
+                handler(topic[:-1], body)
+                handled = 1
+    return handled
+
+
+def timeCalls(func, msgs, numMessages):
+    numMsgs = len(msgs)
+    start = time.time()
+    for i in xrange(numMessages):
+        func(msgs[i % numMsgs])
+    return (time.time() - start) / numMessages * 1e+6
+
+
+def benchmark(numPrefixes, numTopics, numMessages):
+    s = ZmqSubscriber('benchSubscriber')
+    for i in xrange(numPrefixes):
+        s.subscribeRaw('vehicle%d.telemetry.' % i, handleMessage)
+    msgs = ['vehicle%d.telemetry.pose:{"x": 1, "y": 2}' % (i % numPrefixes)
+            for i in xrange(numTopics)]
+
+    linearUsecs = timeCalls(lambda msg: linearRouteMessage(s, msg), msgs, numMessages)
+    cachedUsecs = timeCalls(s.routeMessage, msgs, numMessages)
+    return linearUsecs, cachedUsecs
+
+
+def main():
+    import optparse
+    parser = optparse.OptionParser('usage: %prog')
+    parser.add_option('-p', '--prefixCounts',
+                      default='1,10,100,1000,10000',
+                      help='Comma-separated list of prefix counts to try [%default]')
+    parser.add_option('-t', '--numTopics',
+                      default=100, type='int',
+                      help='Number of distinct topics in the message stream [%default]')
+    parser.add_option('-n', '--numMessages',
+                      default=20000, type='int',
+                      help='Number of messages to route per trial [%default]')
+    opts, args = parser.parse_args()
+    if args:
+        parser.error('expected no args')
+
+    print '%10s %18s %18s' % ('prefixes', 'linear (us/msg)', 'cached (us/msg)')
+    for numPrefixes in [int(n) for n in opts.prefixCounts.split(',')]:
+        linearUsecs, cachedUsecs = benchmark(numPrefixes, opts.numTopics, opts.numMessages)
+        print '%10d %18.2f %18.2f' % (numPrefixes, linearUsecs, cachedUsecs)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,189 @@
+#__BEGIN_LICENSE__
+# Copyright (c) 2017, United States Government, as represented by the
+# Administrator of the National Aeronautics and Space Administration.
+# All rights reserved.
+#
+# The GeoRef platform is licensed under the Apache License, Version 2.0
+# (the "License"); you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+# http://www.apache.org/licenses/LICENSE-2.0.
+#
+# Unless required by applicable law or agreed to in writing, software distributed
+# under the License is distributed on an "AS IS" BASIS, WITHOUT WARRANTIES OR
+# CONDITIONS OF ANY KIND, either express or implied. See the License for the
+# specific language governing permissions and limitations under the License.
+#__END_LICENSE__
+
+"""
+Sidecar index for zmqCentral message logs.
+
+The index divides the log into blocks of consecutive records. Each
+block is written to the index file as one line of JSON when it is
+closed:
+
+  {"offset": <byte offset of first record>,
+   "end": <byte offset just past last record>,
+   "minTime": <earliest timestamp>,
+   "maxTime": <latest timestamp>,
+   "count": <number of records>,
+   "topics": {<topic>: <byte offset of first record with topic>, ...}}
+
+A reader can use the blocks to seek straight to the part of the log
+covering a time range or a set of topic prefixes, then scan records
+from there. Records written after the last checkpoint are not indexed
+and must be scanned linearly.
+"""
+
+import os
+import logging
+
+from geocamUtil import anyjson as json
+
+INDEX_SUFFIX = '.index'
+MANIFEST_SUFFIX = '.manifest.json'
+COMPRESSED_SUFFIX = '.gz'
+DEFAULT_CHECKPOINT_RECORDS = 1000
+DEFAULT_CHECKPOINT_BYTES = 4 * 1024 * 1024
+DEFAULT_CHECKPOINT_USECS = 10 * 1000000
+
+
+def getUncompressedPath(logPath):
+    if logPath.endswith(COMPRESSED_SUFFIX):
+        return logPath[:-len(COMPRESSED_SUFFIX)]
+    return logPath
+
+
+def getIndexPath(logPath):
+    """
+    Returns the path of the index for the log at @logPath. Compressed
+    and uncompressed copies of a log share the same index, since its
+    offsets refer to the uncompressed log.
+    """
+    return getUncompressedPath(logPath) + INDEX_SUFFIX
+
+
+def getManifestPath(logPath):
+    return getUncompressedPath(logPath) + MANIFEST_SUFFIX
+
+
+def topicMatches(topic, topicPrefixes):
+    """
+    Returns True if @topic matches any of @topicPrefixes, using the same
+    'topic:' convention as ZmqSubscriber subscriptions.
+    """
+    return (topic + ':').startswith(topicPrefixes)
+
+
+class LogIndexWriter(object):
+    def __init__(self, indexFile, checkpointRecords=DEFAULT_CHECKPOINT_RECORDS,
+                 checkpointBytes=DEFAULT_CHECKPOINT_BYTES,
+                 checkpointUsecs=DEFAULT_CHECKPOINT_USECS):
+        self.indexFile = indexFile
+        self.checkpointRecords = checkpointRecords
+        self.checkpointBytes = checkpointBytes
+        self.checkpointUsecs = checkpointUsecs
+        self.block = None
+
+    def add(self, timestamp, offset, size, topic):
+        """
+        Record that a log record with @timestamp and @topic was written
+        at byte @offset and occupies @size bytes in the log.
+        """
+        block = self.block
+        if block is None:
+            block = {'offset': offset,
+                     'end': offset,
+                     'minTime': timestamp,
+                     'maxTime': timestamp,
+                     'count': 0,
+                     'topics': {}}
+            self.block = block
+        if timestamp < block['minTime']:
+            block['minTime'] = timestamp
+        if timestamp > block['maxTime']:
+            block['maxTime'] = timestamp
+        block['end'] = offset + size
+        block['count'] += 1
+        block['topics'].setdefault(topic, offset)
+
+        if (block['count'] >= self.checkpointRecords
+                or block['end'] - block['offset'] >= self.checkpointBytes
+                or block['maxTime'] - block['minTime'] >= self.checkpointUsecs):
+            self.checkpoint()
+
+    def checkpoint(self):
+        if self.block is None:
+            return
+        self.indexFile.write(json.dumps(self.block))
+        self.indexFile.write('\n')
+        self.indexFile.flush()
+        self.block = None
+
+    def close(self):
+        self.checkpoint()
+        self.indexFile.close()
+
+
+class LogIndex(object):
+    def __init__(self, blocks):
+        self.blocks = blocks
+        if blocks:
+            self.end = blocks[-1]['end']
+        else:
+            self.end = 0
+
+    @classmethod
+    def load(cls, indexPath):
+        """
+        Returns the index stored at @indexPath, or None if there is no
+        index.
+        """
+        if not os.path.exists(indexPath):
+            return None
+        blocks = []
+        for lineNum, line in enumerate(open(indexPath, 'rb')):
+            try:
+                block = json.loads(line)
+            except ValueError:
+                # most likely a partially written final line
+                logging.warning('LogIndex: bad index entry in line %d of %s',
+                                lineNum + 1, indexPath)
+                continue
+            block['topics'] = dict(((topic.encode('utf-8'), offset)
+                                    for topic, offset in block['topics'].iteritems()))
+            blocks.append(block)
+        return cls(blocks)
+
+    def getRanges(self, startTime=None, endTime=None, topicPrefixes=None):
+        """
+        Returns a list of (beginOffset, endOffset) byte ranges of the log
+        that may contain records matching the query. The last range has
+        endOffset None and covers the unindexed tail of the log.
+        """
+        if topicPrefixes is not None:
+            topicPrefixes = tuple(topicPrefixes)
+
+        ranges = []
+        for block in self.blocks:
+            if startTime is not None and block['maxTime'] < startTime:
+                continue
+            if endTime is not None and block['minTime'] > endTime:
+                continue
+            begin = block['offset']
+            if topicPrefixes:
+                offsets = [offset
+                           for topic, offset in block['topics'].iteritems()
+                           if topicMatches(topic, topicPrefixes)]
+                if not offsets:
+                    continue
+                begin = min(offsets)
+            if ranges and ranges[-1][1] == block['offset']:
+                ranges[-1][1] = block['end']
+            else:
+                ranges.append([begin, block['end']])
+
+        if ranges and ranges[-1][1] == self.end:
+            ranges[-1][1] = None
+        else:
+            ranges.append([self.end, None])
+        return [tuple(r) for r in ranges]
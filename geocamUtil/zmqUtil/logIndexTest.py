@@ -0,0 +1,132 @@
+#__BEGIN_LICENSE__
+# Copyright (c) 2017, United States Government, as represented by the
+# Administrator of the National Aeronautics and Space Administration.
+# All rights reserved.
+#
+# The GeoRef platform is licensed under the Apache License, Version 2.0
+# (the "License"); you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+# http://www.apache.org/licenses/LICENSE-2.0.
+#
+# Unless required by applicable law or agreed to in writing, software distributed
+# under the License is distributed on an "AS IS" BASIS, WITHOUT WARRANTIES OR
+# CONDITIONS OF ANY KIND, either express or implied. See the License for the
+# specific language governing permissions and limitations under the License.
+#__END_LICENSE__
+
+
+import os
+import shutil
+import tempfile
+import unittest
+from cStringIO import StringIO
+
+from geocamUtil.zmqUtil.logIndex import LogIndexWriter, LogIndex, getIndexPath
+from geocamUtil.zmqUtil.util import openLogParser
+
+
+class LogIndexTest(unittest.TestCase):
+    def setUp(self):
+        self.tmpDir = tempfile.mkdtemp(prefix='logIndexTest')
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpDir)
+
+    def getIndex(self, indexText):
+        indexPath = os.path.join(self.tmpDir, 'log.txt.index')
+        out = open(indexPath, 'wb')
+        out.write(indexText)
+        out.close()
+        return LogIndex.load(indexPath)
+
+    def writeIndex(self, numRecords, **kwargs):
+        """
+        Indexes @numRecords records of 10 bytes each, 100 usecs
+        apart. Records 1 and 7 have topic 'a', the rest topic 'b'.
+        """
+        indexFile = StringIO()
+        writer = LogIndexWriter(indexFile, **kwargs)
+        for i in xrange(numRecords):
+            if i in (1, 7):
+                topic = 'a'
+            else:
+                topic = 'b'
+            writer.add(100 * i, 10 * i, 10, topic)
+        return writer, indexFile
+
+    def test_checkpointRecords(self):
+        writer, indexFile = self.writeIndex(10, checkpointRecords=3)
+        # the tenth record is still in the open block
+        self.assertEqual(3, len(indexFile.getvalue().splitlines()))
+        index = self.getIndex(indexFile.getvalue())
+        self.assertEqual({'offset': 30,
+                          'end': 60,
+                          'minTime': 300,
+                          'maxTime': 500,
+                          'count': 3,
+                          'topics': {'b': 30}},
+                         index.blocks[1])
+        self.assertEqual({'a': 70, 'b': 60}, index.blocks[2]['topics'])
+        self.assertEqual(90, index.end)
+
+        writer.checkpoint()
+        self.assertEqual(4, len(indexFile.getvalue().splitlines()))
+
+    def test_checkpointBytesAndTime(self):
+        _writer, indexFile = self.writeIndex(10, checkpointBytes=40)
+        self.assertEqual([4, 4], [block['count']
+                                  for block in self.getIndex(indexFile.getvalue()).blocks])
+        _writer, indexFile = self.writeIndex(10, checkpointUsecs=200)
+        self.assertEqual([3, 3, 3], [block['count']
+                                     for block in self.getIndex(indexFile.getvalue()).blocks])
+
+    def test_getRanges(self):
+        _writer, indexFile = self.writeIndex(10, checkpointRecords=3)
+        index = self.getIndex(indexFile.getvalue())
+        # adjacent blocks are merged, and the last one runs on into the
+        # unindexed tail
+        self.assertEqual([(0, None)], index.getRanges())
+        self.assertEqual([(30, None)], index.getRanges(startTime=350))
+        self.assertEqual([(0, 30), (90, None)], index.getRanges(endTime=250))
+        self.assertEqual([(30, 60), (90, None)], index.getRanges(startTime=350, endTime=450))
+
+    def test_getRangesTopics(self):
+        _writer, indexFile = self.writeIndex(10, checkpointRecords=3)
+        index = self.getIndex(indexFile.getvalue())
+        # ranges start at the first matching record of each block
+        self.assertEqual([(10, 30), (70, None)], index.getRanges(topicPrefixes=['a:']))
+        self.assertEqual([(10, 30), (90, None)], index.getRanges(endTime=250, topicPrefixes=['a:']))
+        self.assertEqual([(90, None)], index.getRanges(topicPrefixes=['c']))
+
+    def test_loadPartialLine(self):
+        _writer, indexFile = self.writeIndex(10, checkpointRecords=3)
+        index = self.getIndex(indexFile.getvalue() + '{"offset": 90, "e')
+        self.assertEqual(3, len(index.blocks))
+        self.assertEqual(None, LogIndex.load(os.path.join(self.tmpDir, 'missing.index')))
+
+    def test_select(self):
+        logPath = os.path.join(self.tmpDir, 'messages.txt')
+        logFile = open(logPath, 'wb')
+        writer = LogIndexWriter(open(getIndexPath(logPath), 'wb'), checkpointRecords=7)
+        msgs = []
+        for i in xrange(50):
+            topic = 'topic%d' % (i % 5)
+            msg = '%s:{"i": %d}' % (topic, i)
+            record = '@@@ %d %d - %s\n' % (1000 + i, len(msg), msg)
+            writer.add(1000 + i, logFile.tell(), len(record), topic)
+            logFile.write(record)
+            msgs.append(msg)
+        writer.checkpoint()
+        logFile.close()
+
+        parser = openLogParser(logPath)
+        self.assertNotEqual(None, parser.index)
+        self.assertEqual(msgs[10:21], [rec.msg for rec in parser.select(1010, 1020)])
+        self.assertEqual(msgs[3::5], [rec.msg for rec in parser.select(topicPrefixes=['topic3:'])])
+        self.assertEqual(msgs[33:46:5], [rec.msg for rec in parser.select(1030, 1045, ['topic3:'])])
+        parser.close()
+        writer.close()
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,370 @@
+#__BEGIN_LICENSE__
+# Copyright (c) 2017, United States Government, as represented by the
+# Administrator of the National Aeronautics and Space Administration.
+# All rights reserved.
+#
+# The GeoRef platform is licensed under the Apache License, Version 2.0
+# (the "License"); you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+# http://www.apache.org/licenses/LICENSE-2.0.
+#
+# Unless required by applicable law or agreed to in writing, software distributed
+# under the License is distributed on an "AS IS" BASIS, WITHOUT WARRANTIES OR
+# CONDITIONS OF ANY KIND, either express or implied. See the License for the
+# specific language governing permissions and limitations under the License.
+#__END_LICENSE__
+
+import os
+import time
+import gzip
+import shutil
+import logging
+import threading
+import Queue
+
+from geocamUtil import anyjson as json
+from geocamUtil.zmqUtil.util import getMessageSize, getMessageTopic
+from geocamUtil.zmqUtil.logIndex import (LogIndexWriter,
+                                         getIndexPath,
+                                         getManifestPath,
+                                         COMPRESSED_SUFFIX,
+                                         DEFAULT_CHECKPOINT_RECORDS)
+
+SYNC_POLICIES = ('none', 'periodic', 'batch')
+DEFAULT_QUEUE_SIZE = 100000
+DEFAULT_MAX_BATCH_BYTES = 1024 * 1024
+DEFAULT_SYNC_PERIOD_SECS = 1.0
+IDLE_POLL_SECS = 1.0
+
+
+def writeManifest(logPath, manifest):
+    manifestPath = getManifestPath(logPath)
+    tmpPath = manifestPath + '.tmp'
+    out = open(tmpPath, 'wb')
+    out.write(json.dumps(manifest, sort_keys=True, indent=4))
+    out.close()
+    os.rename(tmpPath, manifestPath)
+
+
+def compressSegment(logPath):
+    """
+    Compresses the closed log segment at @logPath with gzip, then
+    removes the uncompressed copy. Returns the path of the compressed
+    segment.
+    """
+    compressedPath = logPath + COMPRESSED_SUFFIX
+    tmpPath = compressedPath + '.tmp'
+    src = open(logPath, 'rb')
+    dst = gzip.open(tmpPath, 'wb')
+    shutil.copyfileobj(src, dst, 1024 * 1024)
+    dst.close()
+    src.close()
+    os.rename(tmpPath, compressedPath)
+    os.unlink(logPath)
+    return compressedPath
+
+
+class SegmentCompressor(object):
+    """
+    Compresses closed message log segments in a background thread and
+    writes their manifests.
+    """
+
+    def __init__(self):
+        self.queue = Queue.Queue()
+        self.thread = None
+
+    def start(self):
+        self.thread = threading.Thread(target=self.run,
+                                       name='SegmentCompressor')
+        self.thread.daemon = True
+        self.thread.start()
+
+    def stop(self):
+        self.queue.put(None)
+        self.thread.join()
+        self.thread = None
+
+    def addSegment(self, logPath, manifest):
+        self.queue.put((logPath, manifest))
+
+    def run(self):
+        while True:
+            job = self.queue.get()
+            if job is None:
+                break
+            logPath, manifest = job
+            try:
+                manifest['file'] = os.path.basename(compressSegment(logPath))
+                writeManifest(logPath, manifest)
+                logging.info('SegmentCompressor: compressed %s', logPath)
+            except:  # pylint: disable=W0702
+                logging.exception('SegmentCompressor: error compressing %s', logPath)
+
+
+class MessageLogWriter(object):
+    """
+    MessageLogWriter appends records to a message log from a background
+    thread so that a slow disk never stalls the caller.
+
+    Records are passed to the thread through a bounded queue. If the
+    queue is full, the record is dropped and counted rather than
+    blocking. The thread collects whatever records are waiting into a
+    batch of up to maxBatchBytes and writes the batch with a single
+    write call (group commit). The sync policy controls durability:
+
+      'none': flush each batch to the OS but never fsync
+      'periodic': fsync at most once every syncPeriodSecs
+      'batch': fsync after every batch
+
+    If rotateBytes or rotateSecs is set, the writer closes the current
+    segment once it reaches that size or age and continues in the file
+    returned by getSegmentPath(). Closed segments are gzip-compressed by
+    a background SegmentCompressor (unless compress is False) and get a
+    manifest recording their time range, message count and topics.
+    The segment that is active when the writer stops is left
+    uncompressed, so links to the latest log stay valid.
+
+    Example usage:
+
+    writer = MessageLogWriter('messages.txt', sync='periodic')
+    writer.start()
+    writer.write(getTimestamp(), '-', 'topic:{"a": 1}')
+    writer.stop()
+    """
+
+    def __init__(self, logPath,
+                 indexCheckpoint=DEFAULT_CHECKPOINT_RECORDS,
+                 queueSize=DEFAULT_QUEUE_SIZE,
+                 maxBatchBytes=DEFAULT_MAX_BATCH_BYTES,
+                 sync='none',
+                 syncPeriodSecs=DEFAULT_SYNC_PERIOD_SECS,
+                 rotateBytes=0,
+                 rotateSecs=0,
+                 getSegmentPath=None,
+                 compress=True):
+        if sync not in SYNC_POLICIES:
+            raise ValueError('unknown sync policy %s, expected one of %s'
+                             % (sync, ', '.join(SYNC_POLICIES)))
+        self.logPath = logPath
+        self.indexCheckpoint = indexCheckpoint
+        self.maxBatchBytes = maxBatchBytes
+        self.sync = sync
+        self.syncPeriodSecs = syncPeriodSecs
+        self.rotateBytes = rotateBytes
+        self.rotateSecs = rotateSecs
+        self.getSegmentPath = getSegmentPath
+        self.rotating = bool(rotateBytes or rotateSecs)
+        if self.rotating and getSegmentPath is None:
+            raise ValueError('log rotation requires getSegmentPath')
+        self.compressor = None
+        if self.rotating and compress:
+            self.compressor = SegmentCompressor()
+
+        self.queue = Queue.Queue(queueSize)
+        self.thread = None
+        self.logFile = None
+        self.index = None
+        self.offset = 0
+        self.dirty = False
+        self.lastSyncTime = 0
+        self.segment = None
+        self.segmentOpenTime = None
+
+        self.numQueued = 0
+        self.numDropped = 0
+        self.numWritten = 0
+        self.numBatches = 0
+        self.numBytes = 0
+        self.numSyncs = 0
+
+    def open(self):
+        self.logFile = open(self.logPath, 'ab')
+        self.offset = os.path.getsize(self.logPath)
+        if self.indexCheckpoint:
+            indexFile = open(getIndexPath(self.logPath), 'ab')
+            self.index = LogIndexWriter(indexFile,
+                                        checkpointRecords=self.indexCheckpoint)
+        self.segment = {'minTime': None,
+                        'maxTime': None,
+                        'count': 0,
+                        'bytes': 0,
+                        'topics': {}}
+        self.segmentOpenTime = time.time()
+
+    def close(self, final=False):
+        self.syncIfNeeded(force=True)
+        self.logFile.close()
+        self.logFile = None
+        if self.index:
+            self.index.close()
+            self.index = None
+        if self.rotating:
+            self.finishSegment(compress=not final)
+
+    def finishSegment(self, compress=True):
+        manifest = self.segment
+        manifest['file'] = os.path.basename(self.logPath)
+        if self.compressor and compress:
+            self.compressor.addSegment(self.logPath, manifest)
+        else:
+            writeManifest(self.logPath, manifest)
+
+    def rotate(self):
+        newPath = self.getSegmentPath()
+        if newPath == self.logPath:
+            # can happen when rotating twice within the time resolution
+            # of the segment names, just keep writing
+            return
+        self.close()
+        logging.info('MessageLogWriter: rotating message log to %s', newPath)
+        self.logPath = newPath
+        self.open()
+
+    def needsRotate(self):
+        if not self.rotating:
+            return False
+        return ((self.rotateBytes and self.segment['bytes'] >= self.rotateBytes)
+                or (self.rotateSecs and time.time() - self.segmentOpenTime >= self.rotateSecs))
+
+    def start(self):
+        if self.compressor:
+            self.compressor.start()
+        self.open()
+        self.thread = threading.Thread(target=self.run,
+                                       name='MessageLogWriter')
+        self.thread.daemon = True
+        self.thread.start()
+
+    def stop(self):
+        if self.thread is None:
+            return
+        self.queue.put(None)
+        self.thread.join()
+        self.thread = None
+        if self.compressor:
+            self.compressor.stop()
+
+    def write(self, timestamp, attachmentsPath, msg):
+        """
+        Queues a record for writing. Never blocks. Returns False if the
+        record was dropped because the queue was full. @msg may be a
+        legacy single-frame message or the [topic, body] frames of a
+        multipart message.
+        """
+        try:
+            self.queue.put_nowait((timestamp, attachmentsPath, msg))
+        except Queue.Full:
+            self.numDropped += 1
+            return False
+        self.numQueued += 1
+        return True
+
+    def getStats(self):
+        return {'queueDepth': self.queue.qsize(),
+                'queued': self.numQueued,
+                'dropped': self.numDropped,
+                'written': self.numWritten,
+                'batches': self.numBatches,
+                'bytes': self.numBytes,
+                'syncs': self.numSyncs}
+
+    def getIdleTimeout(self):
+        timeout = IDLE_POLL_SECS
+        if self.sync == 'periodic':
+            timeout = min(timeout, self.syncPeriodSecs)
+        if self.rotateSecs:
+            timeout = min(timeout, self.rotateSecs)
+        return timeout
+
+    def run(self):
+        timeout = self.getIdleTimeout()
+        stopping = False
+        while not stopping:
+            try:
+                rec = self.queue.get(timeout=timeout)
+            except Queue.Empty:
+                # idle, make sure earlier batches reach the disk and
+                # that a quiet log still rotates on time. no point in
+                # closing out a segment with nothing in it.
+                try:
+                    self.syncIfNeeded()
+                    if self.segment['count'] and self.needsRotate():
+                        self.rotate()
+                except:  # pylint: disable=W0702
+                    logging.exception('MessageLogWriter: error rotating %s', self.logPath)
+                continue
+            if rec is None:
+                break
+
+            batch = [rec]
+            batchBytes = getMessageSize(rec[2])
+            while batchBytes < self.maxBatchBytes:
+                try:
+                    rec = self.queue.get_nowait()
+                except Queue.Empty:
+                    break
+                if rec is None:
+                    stopping = True
+                    break
+                batch.append(rec)
+                batchBytes += getMessageSize(rec[2])
+
+            try:
+                self.writeBatch(batch)
+                self.syncIfNeeded(force=(self.sync == 'batch'))
+                if self.needsRotate():
+                    self.rotate()
+            except:  # pylint: disable=W0702
+                logging.exception('MessageLogWriter: error writing batch to %s', self.logPath)
+        self.close(final=True)
+
+    def writeBatch(self, batch):
+        chunks = []
+        offset = self.offset
+        index = self.index
+        topicCounts = self.segment['topics']
+        for timestamp, attachmentsPath, msg in batch:
+            msgSize = getMessageSize(msg)
+            header = '@@@ %d %d %s ' % (timestamp, msgSize, attachmentsPath)
+            chunks.append(header)
+            if isinstance(msg, list):
+                # topic and body frames of a multipart message
+                chunks.extend(msg[:2])
+            else:
+                chunks.append(msg)
+            chunks.append('\n')
+            recordSize = len(header) + msgSize + 1
+            topic = getMessageTopic(msg)
+            if index:
+                index.add(timestamp, offset, recordSize, topic)
+            topicCounts[topic] = topicCounts.get(topic, 0) + 1
+            offset += recordSize
+
+        segment = self.segment
+        batchMinTime = min([rec[0] for rec in batch])
+        batchMaxTime = max([rec[0] for rec in batch])
+        if segment['minTime'] is None or batchMinTime < segment['minTime']:
+            segment['minTime'] = batchMinTime
+        if segment['maxTime'] is None or batchMaxTime > segment['maxTime']:
+            segment['maxTime'] = batchMaxTime
+        segment['count'] += len(batch)
+        segment['bytes'] += offset - self.offset
+
+        self.logFile.write(''.join(chunks))
+        self.logFile.flush()
+        self.numBytes += offset - self.offset
+        self.offset = offset
+        self.numWritten += len(batch)
+        self.numBatches += 1
+        self.dirty = True
+
+    def syncIfNeeded(self, force=False):
+        if not self.dirty or self.sync == 'none':
+            return
+        now = time.time()
+        if force or now - self.lastSyncTime >= self.syncPeriodSecs:
+            os.fsync(self.logFile.fileno())
+            self.lastSyncTime = now
+            self.numSyncs += 1
+            self.dirty = False
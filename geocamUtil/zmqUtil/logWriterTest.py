@@ -0,0 +1,197 @@
+#__BEGIN_LICENSE__
+# Copyright (c) 2017, United States Government, as represented by the
+# Administrator of the National Aeronautics and Space Administration.
+# All rights reserved.
+#
+# The GeoRef platform is licensed under the Apache License, Version 2.0
+# (the "License"); you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+# http://www.apache.org/licenses/LICENSE-2.0.
+#
+# Unless required by applicable law or agreed to in writing, software distributed
+# under the License is distributed on an "AS IS" BASIS, WITHOUT WARRANTIES OR
+# CONDITIONS OF ANY KIND, either express or implied. See the License for the
+# specific language governing permissions and limitations under the License.
+#__END_LICENSE__
+
+
+import os
+import time
+import shutil
+import tempfile
+import unittest
+
+from geocamUtil import anyjson as json
+from geocamUtil.zmqUtil.logWriter import MessageLogWriter
+from geocamUtil.zmqUtil.logIndex import getIndexPath, getManifestPath
+from geocamUtil.zmqUtil.util import openLogParser
+
+TEST_TIMEOUT_SECS = 5
+
+
+class LogWriterTestCase(unittest.TestCase):
+    def setUp(self):
+        self.tmpDir = tempfile.mkdtemp(prefix='logWriterTest')
+        self.logPath = os.path.join(self.tmpDir, 'messages.txt')
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpDir)
+
+    def readLog(self, logPath=None):
+        if logPath is None:
+            logPath = self.logPath
+        parser = openLogParser(logPath)
+        result = [(rec.timestamp, rec.msg) for rec in parser]
+        parser.close()
+        return result
+
+
+class MessageLogWriterTest(LogWriterTestCase):
+    def runWriter(self, writer, msgs):
+        """
+        Queues @msgs and runs the writer in this thread until it has
+        written them all.
+        """
+        writer.open()
+        for i, msg in enumerate(msgs):
+            self.assertTrue(writer.write(1000 + i, '-', msg))
+        writer.queue.put(None)
+        writer.run()
+
+    def test_groupCommit(self):
+        msgs = ['topic%d:{"i": %d}' % (i % 3, i) for i in xrange(100)]
+        writer = MessageLogWriter(self.logPath, indexCheckpoint=10)
+        self.runWriter(writer, msgs)
+        # everything waiting in the queue goes out in one write
+        stats = writer.getStats()
+        self.assertEqual(1, stats['batches'])
+        self.assertEqual(100, stats['written'])
+        self.assertEqual(0, stats['queueDepth'])
+        self.assertEqual(0, stats['syncs'])
+        self.assertEqual(os.path.getsize(self.logPath), stats['bytes'])
+        self.assertEqual(list(enumerate(msgs, 1000)), self.readLog())
+        self.assertEqual(10, len(open(getIndexPath(self.logPath)).readlines()))
+
+    def test_maxBatchBytes(self):
+        msgs = ['topic:%s' % ('x' * 94) for _i in xrange(10)]
+        writer = MessageLogWriter(self.logPath, maxBatchBytes=250, sync='batch')
+        self.runWriter(writer, msgs)
+        # batches end once they reach 250 bytes of messages
+        self.assertEqual(4, writer.numBatches)
+        self.assertEqual(4, writer.numSyncs)
+        self.assertEqual(list(enumerate(msgs, 1000)), self.readLog())
+
+    def test_multipart(self):
+        writer = MessageLogWriter(self.logPath)
+        self.runWriter(writer, [['topic:', '{"a": 1}'], 'topic:{"a": 2}'])
+        self.assertEqual([(1000, 'topic:{"a": 1}'), (1001, 'topic:{"a": 2}')],
+                         self.readLog())
+
+    def test_queueFull(self):
+        writer = MessageLogWriter(self.logPath, queueSize=2)
+        self.assertTrue(writer.write(1000, '-', 'topic:0'))
+        self.assertTrue(writer.write(1001, '-', 'topic:1'))
+        # a full queue drops records instead of blocking
+        self.assertFalse(writer.write(1002, '-', 'topic:2'))
+        self.assertFalse(writer.write(1003, '-', 'topic:3'))
+        stats = writer.getStats()
+        self.assertEqual(2, stats['queueDepth'])
+        self.assertEqual(2, stats['queued'])
+        self.assertEqual(2, stats['dropped'])
+
+        writer.start()
+        writer.stop()
+        self.assertEqual([(1000, 'topic:0'), (1001, 'topic:1')], self.readLog())
+
+    def test_badSyncPolicy(self):
+        self.assertRaises(ValueError, MessageLogWriter, self.logPath, sync='sometimes')
+
+
+class LogRotationTest(LogWriterTestCase):
+    def setUp(self):
+        super(LogRotationTest, self).setUp()
+        self.numSegments = 0
+
+    def getSegmentPath(self):
+        path = os.path.join(self.tmpDir, 'messages-%d.txt' % self.numSegments)
+        self.numSegments += 1
+        return path
+
+    def makeWriter(self, **kwargs):
+        return MessageLogWriter(self.getSegmentPath(),
+                                getSegmentPath=self.getSegmentPath,
+                                **kwargs)
+
+    def readManifest(self, logPath):
+        return json.loads(open(getManifestPath(logPath)).read())
+
+    def test_rotateBytes(self):
+        # 116-byte records, written one per batch
+        msgs = ['topic%d:%s' % (i % 2, 'x' * 93) for i in xrange(10)]
+        writer = self.makeWriter(rotateBytes=250, maxBatchBytes=1)
+        for i, msg in enumerate(msgs):
+            writer.write(1000 + i, '-', msg)
+        writer.start()
+        writer.stop()
+
+        self.assertEqual(4, self.numSegments)
+        records = []
+        for i in xrange(3):
+            logPath = os.path.join(self.tmpDir, 'messages-%d.txt' % i)
+            self.assertFalse(os.path.exists(logPath))
+            records += self.readLog(logPath + '.gz')
+            manifest = self.readManifest(logPath)
+            self.assertEqual('messages-%d.txt.gz' % i, manifest['file'])
+            self.assertEqual(3, manifest['count'])
+            self.assertEqual(348, manifest['bytes'])
+            self.assertEqual(1000 + 3 * i, manifest['minTime'])
+            self.assertEqual(1002 + 3 * i, manifest['maxTime'])
+
+        # the active segment is left uncompressed
+        logPath = os.path.join(self.tmpDir, 'messages-3.txt')
+        self.assertEqual(logPath, writer.logPath)
+        self.assertFalse(os.path.exists(logPath + '.gz'))
+        records += self.readLog(logPath)
+        manifest = self.readManifest(logPath)
+        self.assertEqual('messages-3.txt', manifest['file'])
+        self.assertEqual({'topic1': 1}, manifest['topics'])
+        self.assertEqual(list(enumerate(msgs, 1000)), records)
+
+    def test_rotateIdle(self):
+        writer = self.makeWriter(rotateSecs=0.1)
+        writer.start()
+        writer.write(1000, '-', 'topic:0')
+        deadline = time.time() + TEST_TIMEOUT_SECS
+        while self.numSegments < 2 and time.time() < deadline:
+            time.sleep(0.05)
+        # a quiet log rotates on time, but an empty segment doesn't
+        time.sleep(0.3)
+        writer.stop()
+
+        self.assertEqual(2, self.numSegments)
+        logPath = os.path.join(self.tmpDir, 'messages-0.txt')
+        self.assertEqual([(1000, 'topic:0')], self.readLog(logPath + '.gz'))
+        self.assertEqual(1, self.readManifest(logPath)['count'])
+        logPath = os.path.join(self.tmpDir, 'messages-1.txt')
+        self.assertEqual([], self.readLog(logPath))
+        self.assertEqual(0, self.readManifest(logPath)['count'])
+
+    def test_noCompress(self):
+        writer = self.makeWriter(rotateBytes=1, compress=False)
+        for i in xrange(3):
+            writer.write(1000 + i, '-', 'topic:%d' % i)
+        writer.start()
+        writer.stop()
+
+        # all three records fit in one batch
+        self.assertEqual(2, self.numSegments)
+        logPath = os.path.join(self.tmpDir, 'messages-0.txt')
+        self.assertEqual(3, len(self.readLog(logPath)))
+        self.assertEqual('messages-0.txt', self.readManifest(logPath)['file'])
+
+    def test_requiresSegmentPath(self):
+        self.assertRaises(ValueError, MessageLogWriter, self.logPath, rotateBytes=1000)
+
+
+if __name__ == '__main__':
+    unittest.main()
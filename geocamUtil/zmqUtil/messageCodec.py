@@ -0,0 +1,153 @@
+#__BEGIN_LICENSE__
+# Copyright (c) 2017, United States Government, as represented by the
+# Administrator of the National Aeronautics and Space Administration.
+# All rights reserved.
+#
+# The GeoRef platform is licensed under the Apache License, Version 2.0
+# (the "License"); you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+# http://www.apache.org/licenses/LICENSE-2.0.
+#
+# Unless required by applicable law or agreed to in writing, software distributed
+# under the License is distributed on an "AS IS" BASIS, WITHOUT WARRANTIES OR
+# CONDITIONS OF ANY KIND, either express or implied. See the License for the
+# specific language governing permissions and limitations under the License.
+#__END_LICENSE__
+
+"""
+Codecs for the structured message bodies sent by
+ZmqPublisher.sendJson() and decoded for ZmqSubscriber.subscribeJson().
+
+JSON bodies are sent as plain JSON text, as they always have been.
+Bodies in any other codec start with CODEC_PREFIX followed by a
+one-character codec id, for example '\\x00m' for msgpack. JSON text
+never starts with a NUL byte, so a receiver can always tell which codec
+a body uses, and modules using different codecs can share the bus. A
+module that doesn't know the codec of a message can still forward,
+log and replay it, since the body is never touched in transit.
+
+Codecs that depend on optional modules are only registered if the
+module is installed. Asking for a codec that isn't available falls
+back to JSON.
+"""
+
+import logging
+
+from geocamUtil import anyjson as json
+
+try:
+    import msgpack
+    HAVE_MSGPACK = True
+except ImportError:
+    HAVE_MSGPACK = False
+
+CODEC_PREFIX = '\x00'
+DEFAULT_CODEC = 'json'
+
+# codecs we know about, whether or not their modules are installed
+KNOWN_CODECS = ('json', 'msgpack')
+
+
+class MessageCodec(object):
+    def __init__(self, name, codecId, dumps, loads):
+        self.name = name
+        self.codecId = codecId
+        self.dumps = dumps
+        self.loads = loads
+        if codecId is None:
+            self.prefix = ''
+        else:
+            self.prefix = CODEC_PREFIX + codecId
+
+    def encode(self, obj):
+        return self.prefix + self.dumps(obj)
+
+
+CODECS = {}
+CODECS_BY_ID = {}
+
+
+def registerCodec(name, codecId, dumps, loads):
+    """
+    Registers a codec. @codecId is the one-character id that marks
+    bodies in this codec on the wire. @dumps converts an object to a
+    str and @loads converts it back.
+    """
+    if codecId is not None and len(codecId) != 1:
+        raise ValueError('codec id must be a single character, got %s' % repr(codecId))
+    if codecId in CODECS_BY_ID:
+        raise ValueError('codec id %s is already used by codec %s'
+                         % (repr(codecId), CODECS_BY_ID[codecId].name))
+    codec = MessageCodec(name, codecId, dumps, loads)
+    CODECS[name] = codec
+    CODECS_BY_ID[codecId] = codec
+    return codec
+
+
+def getCodec(name):
+    """
+    Returns the codec registered as @name. Falls back to JSON if @name
+    is a known codec whose module isn't installed.
+    """
+    codec = CODECS.get(name)
+    if codec is not None:
+        return codec
+    if name in KNOWN_CODECS:
+        logging.warning('message codec %s is not available, falling back to %s',
+                        name, DEFAULT_CODEC)
+        return CODECS[DEFAULT_CODEC]
+    raise ValueError('unknown message codec %s, expected one of %s'
+                     % (name, ', '.join(sorted(CODECS.iterkeys()))))
+
+
+def getBodyCodec(body):
+    """
+    Returns the codec used to encode @body.
+    """
+    if not body.startswith(CODEC_PREFIX):
+        return CODECS[DEFAULT_CODEC]
+    codec = CODECS_BY_ID.get(body[1:2])
+    if codec is None:
+        raise ValueError('message body has unknown codec id %s' % repr(body[1:2]))
+    return codec
+
+
+def encodeBody(obj, codec=None):
+    """
+    Returns @obj encoded as a message body using @codec, a codec name or
+    MessageCodec object. Uses JSON if @codec is None.
+    """
+    if codec is None:
+        return json.dumps(obj)
+    if not isinstance(codec, MessageCodec):
+        codec = getCodec(codec)
+    return codec.encode(obj)
+
+
+def decodeBody(body):
+    """
+    Decodes message body @body, whatever codec it uses.
+    """
+    if not body.startswith(CODEC_PREFIX):
+        return json.loads(body)
+    return getBodyCodec(body).loads(body[2:])
+
+
+def toJsonBody(body):
+    """
+    Returns @body as JSON text, converting it if it uses another codec.
+    Use this to hand messages to clients that only understand JSON.
+    """
+    if not body.startswith(CODEC_PREFIX):
+        return body
+    return json.dumps(decodeBody(body))
+
+
+registerCodec('json', None, json.dumps, json.loads)
+
+if HAVE_MSGPACK:
+    # strings are packed as utf-8 raw and unpacked as unicode, the same
+    # way they round-trip through JSON
+    registerCodec('msgpack', 'm',
+                  lambda obj: msgpack.packb(obj, use_bin_type=False),
+                  lambda data: msgpack.unpackb(data, raw=False))
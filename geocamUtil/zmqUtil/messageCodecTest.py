@@ -0,0 +1,76 @@
+#__BEGIN_LICENSE__
+# Copyright (c) 2017, United States Government, as represented by the
+# Administrator of the National Aeronautics and Space Administration.
+# All rights reserved.
+#
+# The GeoRef platform is licensed under the Apache License, Version 2.0
+# (the "License"); you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+# http://www.apache.org/licenses/LICENSE-2.0.
+#
+# Unless required by applicable law or agreed to in writing, software distributed
+# under the License is distributed on an "AS IS" BASIS, WITHOUT WARRANTIES OR
+# CONDITIONS OF ANY KIND, either express or implied. See the License for the
+# specific language governing permissions and limitations under the License.
+#__END_LICENSE__
+
+import unittest
+
+from geocamUtil import anyjson as json
+from geocamUtil.zmqUtil.messageCodec import (encodeBody,
+                                             decodeBody,
+                                             toJsonBody,
+                                             getBodyCodec,
+                                             getCodec,
+                                             HAVE_MSGPACK)
+from geocamUtil.zmqUtil.publisher import ZmqPublisher
+
+
+class MessageCodecTest(unittest.TestCase):
+    def setUp(self):
+        self.obj = {u'name': u'caf\xe9',
+                    u'timestamp': u'1500000000000000',
+                    u'pose': [1.5, -2, None, True],
+                    u'nested': {u'x': {}}}
+
+    def test_json(self):
+        body = encodeBody(self.obj, 'json')
+        self.assertEqual(self.obj, json.loads(body))
+        self.assertEqual('json', getBodyCodec(body).name)
+        self.assertEqual(self.obj, decodeBody(body))
+        self.assertTrue(toJsonBody(body) is body)
+
+    def test_msgpack(self):
+        if not HAVE_MSGPACK:
+            self.assertEqual('json', getCodec('msgpack').name)
+            return
+        body = encodeBody(self.obj, 'msgpack')
+        self.assertTrue(body.startswith('\x00m'))
+        self.assertEqual('msgpack', getBodyCodec(body).name)
+        self.assertEqual(self.obj, decodeBody(body))
+        self.assertEqual(self.obj, json.loads(toJsonBody(body)))
+        # strings come back as unicode, as they do from JSON
+        self.assertEqual(unicode, type(decodeBody(encodeBody({'a': 'b'}, 'msgpack'))['a']))
+
+    def test_controlMessagesJson(self):
+        publisher = ZmqPublisher('codecTest', codec='msgpack')
+        sent = []
+        publisher.sendRaw = lambda topic, body: sent.append((topic, body))
+        publisher.heartbeat()
+        publisher.sendJson('central.rpc', {'method': 'info'})
+        publisher.sendJson('rover.pose', {'x': 1})
+        # central parses control messages with plain json.loads
+        self.assertEqual('central.heartbeat.codecTest', sent[0][0])
+        self.assertEqual(u'codecTest', json.loads(sent[0][1])['module'])
+        self.assertEqual(u'info', json.loads(sent[1][1])['method'])
+        self.assertEqual(1, decodeBody(sent[2][1])['x'])
+        if HAVE_MSGPACK:
+            self.assertTrue(sent[2][1].startswith('\x00m'))
+
+    def test_unknown(self):
+        self.assertRaises(ValueError, getCodec, 'nosuchcodec')
+        self.assertRaises(ValueError, decodeBody, '\x00?xyz')
+
+
+if __name__ == '__main__':
+    unittest.main()
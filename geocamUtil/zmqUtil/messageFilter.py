@@ -0,0 +1,397 @@
+#__BEGIN_LICENSE__
+# Copyright (c) 2017, United States Government, as represented by the
+# Administrator of the National Aeronautics and Space Administration.
+# All rights reserved.
+#
+# The GeoRef platform is licensed under the Apache License, Version 2.0
+# (the "License"); you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+# http://www.apache.org/licenses/LICENSE-2.0.
+#
+# Unless required by applicable law or agreed to in writing, software distributed
+# under the License is distributed on an "AS IS" BASIS, WITHOUT WARRANTIES OR
+# CONDITIONS OF ANY KIND, either express or implied. See the License for the
+# specific language governing permissions and limitations under the License.
+#__END_LICENSE__
+
+r"""
+Filter expressions over message topics and bodies, used by zmqGrep.
+An expression tests fields of the decoded message body, for example:
+
+  battery.level < 20 and status == "LOW"
+  name =~ /^rover/i and not (pose.x >= 0)
+  samples[0].value != null or @topic =~ /\.error$/
+
+Field paths are dot-separated keys, with [n] for list elements.
+Operands are numbers, quoted strings, true, false, null or other field
+paths. A comparison with a missing field is false. The ordering
+operators only compare numbers with numbers and strings with strings.
+=~ and !~ search with a regex, written /.../ (/.../i to ignore case)
+or as a quoted string. A field path on its own is true if the field is
+present and truthy. Terms combine with and, or, not and parentheses.
+
+@topic is the topic of the message. Terms that only look at @topic are
+checked before the body is decoded, and their result is cached per
+topic, so they cost almost nothing for messages they reject.
+"""
+
+import re
+import operator
+
+from geocamUtil.zmqUtil.util import parseMessageBody
+from geocamUtil.zmqUtil.messageCodec import decodeBody
+
+TOKEN_REGEX = re.compile(r'''
+    \s*(?:
+      (?P<number>-?(?:\d+\.?\d*|\.\d+)(?:[eE][-+]?\d+)?)
+    | (?P<string>"(?:[^"\\]|\\.)*"|'(?:[^'\\]|\\.)*')
+    | (?P<regex>/(?:[^/\\]|\\.)*/i?)
+    | (?P<op>==|!=|<=|>=|=~|!~|<|>|\(|\)|!)
+    | (?P<path>@?[A-Za-z_]\w*(?:\.[A-Za-z_]\w*|\[-?\d+\])*)
+    )''', re.VERBOSE)
+
+PATH_KEY_REGEX = re.compile(r'([A-Za-z_]\w*)|\[(-?\d+)\]')
+
+KEYWORDS = {'and': 'and',
+            'or': 'or',
+            'not': 'not'}
+CONSTANTS = {'true': True,
+             'false': False,
+             'null': None}
+
+COMPARISONS = {'==': operator.eq,
+               '!=': operator.ne,
+               '<': operator.lt,
+               '<=': operator.le,
+               '>': operator.gt,
+               '>=': operator.ge}
+ORDERED_COMPARISONS = ('<', '<=', '>', '>=')
+REGEX_COMPARISONS = ('=~', '!~')
+
+TOPIC_FIELD = '@topic'
+
+# max number of topics to remember the result of topic-only terms for
+MAX_TOPIC_CACHE = 10000
+
+
+class FilterSyntaxError(ValueError):
+    pass
+
+
+class Missing(object):
+    def __nonzero__(self):
+        return False
+
+    def __repr__(self):
+        return 'MISSING'
+
+
+MISSING = Missing()
+
+
+def tokenize(expr):
+    """
+    Returns a list of (kind, text) tokens for @expr.
+    """
+    tokens = []
+    pos = 0
+    exprLen = len(expr.rstrip())
+    while pos < exprLen:
+        m = TOKEN_REGEX.match(expr, pos)
+        if m is None:
+            raise FilterSyntaxError('can\'t parse filter at "%s"' % expr[pos:].strip())
+        kind = m.lastgroup
+        text = m.group(kind)
+        if kind == 'path' and text in KEYWORDS:
+            kind = 'keyword'
+        tokens.append((kind, text))
+        pos = m.end()
+    return tokens
+
+
+class FilterParser(object):
+    """
+    Recursive descent parser that turns a filter expression into a tree
+    of tuples:
+
+      ('or', [terms]), ('and', [terms]), ('not', term),
+      ('compare', op, left, right), ('truth', operand)
+
+    where operands are ('path', keys), ('literal', value) or ('regex',
+    compiledRegex).
+    """
+    def __init__(self, expr):
+        self.expr = expr
+        self.tokens = tokenize(expr)
+        self.pos = 0
+
+    def peek(self):
+        if self.pos < len(self.tokens):
+            return self.tokens[self.pos]
+        return (None, None)
+
+    def take(self):
+        token = self.peek()
+        self.pos += 1
+        return token
+
+    def error(self, msg):
+        raise FilterSyntaxError('%s in filter "%s"' % (msg, self.expr))
+
+    def parse(self):
+        if not self.tokens:
+            self.error('empty expression')
+        tree = self.parseOr()
+        if self.pos != len(self.tokens):
+            self.error('unexpected "%s"' % self.peek()[1])
+        return tree
+
+    def parseOr(self):
+        terms = [self.parseAnd()]
+        while self.peek() == ('keyword', 'or'):
+            self.take()
+            terms.append(self.parseAnd())
+        if len(terms) == 1:
+            return terms[0]
+        return ('or', terms)
+
+    def parseAnd(self):
+        terms = [self.parseNot()]
+        while self.peek() == ('keyword', 'and'):
+            self.take()
+            terms.append(self.parseNot())
+        if len(terms) == 1:
+            return terms[0]
+        return ('and', terms)
+
+    def parseNot(self):
+        if self.peek() in (('keyword', 'not'), ('op', '!')):
+            self.take()
+            return ('not', self.parseNot())
+        return self.parsePrimary()
+
+    def parsePrimary(self):
+        if self.peek() == ('op', '('):
+            self.take()
+            tree = self.parseOr()
+            if self.take() != ('op', ')'):
+                self.error('expected ")"')
+            return tree
+        left = self.parseOperand()
+        kind, op = self.peek()
+        if kind == 'op' and (op in COMPARISONS or op in REGEX_COMPARISONS):
+            self.take()
+            right = self.parseOperand()
+            if op in REGEX_COMPARISONS:
+                if right[0] == 'literal' and isinstance(right[1], basestring):
+                    right = ('regex', self.compileRegex(right[1]))
+                elif right[0] != 'regex':
+                    self.error('%s needs a regex on the right' % op)
+            elif right[0] == 'regex':
+                self.error('regex can only be used with =~ and !~')
+            if left[0] == 'regex':
+                self.error('regex must be on the right of %s' % op)
+            return ('compare', op, left, right)
+        if left[0] == 'regex':
+            self.error('regex must be used with =~ or !~')
+        return ('truth', left)
+
+    def compileRegex(self, pattern, flags=0):
+        try:
+            return re.compile(pattern, flags)
+        except re.error, err:
+            self.error('bad regex /%s/: %s' % (pattern, err))
+
+    def parseOperand(self):
+        kind, text = self.take()
+        if kind == 'number':
+            if re.match(r'^-?\d+$', text):
+                return ('literal', int(text))
+            return ('literal', float(text))
+        if kind == 'string':
+            # compare as unicode, like strings decoded from JSON
+            return ('literal', text[1:-1].decode('string_escape').decode('utf-8'))
+        if kind == 'regex':
+            if text.endswith('i'):
+                return ('regex', self.compileRegex(text[1:-2], re.IGNORECASE))
+            return ('regex', self.compileRegex(text[1:-1]))
+        if kind == 'path':
+            if text in CONSTANTS:
+                return ('literal', CONSTANTS[text])
+            if text.startswith('@'):
+                if text != TOPIC_FIELD:
+                    self.error('unknown field %s' % text)
+                return ('path', (TOPIC_FIELD,))
+            keys = tuple([str(name) if name else int(index)
+                          for name, index in PATH_KEY_REGEX.findall(text)])
+            return ('path', keys)
+        if text is None:
+            self.error('unexpected end of expression')
+        self.error('expected a value, not "%s"' % text)
+
+
+def parseFilter(expr):
+    return FilterParser(expr).parse()
+
+
+def usesBody(tree):
+    """
+    Returns True if evaluating @tree needs the message body.
+    """
+    kind = tree[0]
+    if kind in ('and', 'or'):
+        return any((usesBody(term) for term in tree[1]))
+    if kind == 'not':
+        return usesBody(tree[1])
+    if kind == 'truth':
+        return usesBody(tree[1])
+    if kind == 'compare':
+        return usesBody(tree[2]) or usesBody(tree[3])
+    if kind == 'path':
+        return tree[1] != (TOPIC_FIELD,)
+    return False
+
+
+def isComparable(a, b):
+    if isinstance(a, basestring):
+        return isinstance(b, basestring)
+    return (isinstance(a, (int, long, float)) and not isinstance(a, bool)
+            and isinstance(b, (int, long, float)) and not isinstance(b, bool))
+
+
+def compileOperand(operand):
+    kind, value = operand
+    if kind == 'literal':
+        return lambda topic, obj: value
+    if value == (TOPIC_FIELD,):
+        return lambda topic, obj: topic
+
+    def getField(topic, obj):
+        for key in value:
+            try:
+                obj = obj[key]
+            except (KeyError, IndexError, TypeError):
+                return MISSING
+        return obj
+    return getField
+
+
+def compileCompare(op, left, right):
+    getLeft = compileOperand(left)
+
+    if op in REGEX_COMPARISONS:
+        search = right[1].search
+        wantMatch = (op == '=~')
+
+        def testRegex(topic, obj):
+            value = getLeft(topic, obj)
+            if not isinstance(value, basestring):
+                return False
+            return (search(value) is not None) == wantMatch
+        return testRegex
+
+    compare = COMPARISONS[op]
+    ordered = op in ORDERED_COMPARISONS
+    getRight = compileOperand(right)
+
+    def testCompare(topic, obj):
+        a = getLeft(topic, obj)
+        b = getRight(topic, obj)
+        if a is MISSING or b is MISSING:
+            return False
+        if ordered and not isComparable(a, b):
+            return False
+        return compare(a, b)
+    return testCompare
+
+
+def compileTree(tree):
+    """
+    Returns a function test(topic, obj) that evaluates @tree against a
+    message with topic @topic and decoded body @obj.
+    """
+    kind = tree[0]
+    if kind in ('and', 'or'):
+        tests = [compileTree(term) for term in tree[1]]
+        if kind == 'and':
+            return lambda topic, obj: all((test(topic, obj) for test in tests))
+        return lambda topic, obj: any((test(topic, obj) for test in tests))
+    if kind == 'not':
+        test = compileTree(tree[1])
+        return lambda topic, obj: not test(topic, obj)
+    if kind == 'truth':
+        getValue = compileOperand(tree[1])
+        return lambda topic, obj: bool(getValue(topic, obj))
+    if kind == 'compare':
+        return compileCompare(*tree[1:])
+    raise ValueError('unknown filter node %s' % kind)
+
+
+def decodeMessageBody(body):
+    """
+    Decodes the JSON part of message body @body, which may be in the
+    legacy MIME format with attachments. Raises ValueError if it can't
+    be decoded.
+    """
+    if body.startswith('Content-Type:'):
+        body = parseMessageBody(body)['json']
+    return decodeBody(body)
+
+
+class MessageFilter(object):
+    """
+    A compiled filter expression. The top-level terms joined by 'and'
+    are split into those that only look at the topic and those that
+    need the body, so messages can be rejected by topic before their
+    bodies are decoded.
+    """
+    def __init__(self, expr):
+        self.expr = expr
+        tree = parseFilter(expr)
+        if tree[0] == 'and':
+            terms = tree[1]
+        else:
+            terms = [tree]
+        topicTerms = [term for term in terms if not usesBody(term)]
+        bodyTerms = [term for term in terms if usesBody(term)]
+        self.matchTopic = self.compileTerms(topicTerms)
+        self.matchBody = self.compileTerms(bodyTerms)
+        self.topicCache = {}
+
+    @staticmethod
+    def compileTerms(terms):
+        if not terms:
+            return None
+        if len(terms) == 1:
+            return compileTree(terms[0])
+        return compileTree(('and', terms))
+
+    def matchesTopic(self, topic):
+        """
+        Returns False if no message with @topic can match.
+        """
+        if self.matchTopic is None:
+            return True
+        result = self.topicCache.get(topic)
+        if result is None:
+            result = bool(self.matchTopic(topic, None))
+            if len(self.topicCache) >= MAX_TOPIC_CACHE:
+                self.topicCache.clear()
+            self.topicCache[topic] = result
+        return result
+
+    def matches(self, topic, body):
+        """
+        Returns True if the message with @topic and raw body @body
+        matches. A message whose body can't be decoded only matches if
+        the filter doesn't look at the body.
+        """
+        if not self.matchesTopic(topic):
+            return False
+        if self.matchBody is None:
+            return True
+        try:
+            obj = decodeMessageBody(body)
+        except ValueError:
+            return False
+        return self.matchBody(topic, obj)
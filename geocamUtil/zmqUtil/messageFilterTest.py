@@ -0,0 +1,67 @@
+#__BEGIN_LICENSE__
+# Copyright (c) 2017, United States Government, as represented by the
+# Administrator of the National Aeronautics and Space Administration.
+# All rights reserved.
+#
+# The GeoRef platform is licensed under the Apache License, Version 2.0
+# (the "License"); you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+# http://www.apache.org/licenses/LICENSE-2.0.
+#
+# Unless required by applicable law or agreed to in writing, software distributed
+# under the License is distributed on an "AS IS" BASIS, WITHOUT WARRANTIES OR
+# CONDITIONS OF ANY KIND, either express or implied. See the License for the
+# specific language governing permissions and limitations under the License.
+#__END_LICENSE__
+
+import unittest
+
+from geocamUtil import anyjson as json
+from geocamUtil.zmqUtil.messageFilter import MessageFilter, FilterSyntaxError
+
+
+class MessageFilterTest(unittest.TestCase):
+    def setUp(self):
+        self.body = json.dumps({'battery': {'level': 15.5, 'status': 'LOW'},
+                                'name': 'rover2',
+                                'samples': [{'value': 3}, {'value': None}],
+                                'ok': False})
+
+    def assertMatches(self, expr, expected, topic='rover.battery', body=None):
+        if body is None:
+            body = self.body
+        self.assertEqual(expected, MessageFilter(expr).matches(topic, body), expr)
+
+    def test_compare(self):
+        self.assertMatches('battery.level < 20', True)
+        self.assertMatches('battery.level >= 20', False)
+        self.assertMatches('battery.status == "LOW" and samples[0].value == 3', True)
+        self.assertMatches('samples[1].value == null', True)
+        self.assertMatches("name != 'rover2' or not ok", True)
+        # missing fields and mismatched types never compare
+        self.assertMatches('battery.voltage < 20', False)
+        self.assertMatches('battery.voltage != 20', False)
+        self.assertMatches('battery.status > 3', False)
+        self.assertMatches('samples[5].value', False)
+
+    def test_regex(self):
+        self.assertMatches('name =~ /^ROVER\\d$/i', True)
+        self.assertMatches('name !~ "^rover"', False)
+        self.assertMatches('battery.level =~ /1/', False)
+
+    def test_topic(self):
+        messageFilter = MessageFilter('@topic =~ /^base\\./ and battery.level < 20')
+        self.assertTrue(messageFilter.matchTopic is not None)
+        self.assertTrue(messageFilter.matchBody is not None)
+        # rejected by topic without looking at the body
+        self.assertFalse(messageFilter.matches('rover.battery', 'not json'))
+        self.assertTrue(messageFilter.matches('base.battery', self.body))
+        self.assertFalse(MessageFilter('battery.level < 20').matches('rover.battery', 'not json'))
+
+    def test_syntax(self):
+        for expr in ('', 'level <', 'a == /x/', '(a == 1', 'a == 1 b', '@time > 0', 'x =~ "("'):
+            self.assertRaises(FilterSyntaxError, MessageFilter, expr)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,268 @@
+#__BEGIN_LICENSE__
+# Copyright (c) 2017, United States Government, as represented by the
+# Administrator of the National Aeronautics and Space Administration.
+# All rights reserved.
+#
+# The GeoRef platform is licensed under the Apache License, Version 2.0
+# (the "License"); you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+# http://www.apache.org/licenses/LICENSE-2.0.
+#
+# Unless required by applicable law or agreed to in writing, software distributed
+# under the License is distributed on an "AS IS" BASIS, WITHOUT WARRANTIES OR
+# CONDITIONS OF ANY KIND, either express or implied. See the License for the
+# specific language governing permissions and limitations under the License.
+#__END_LICENSE__
+
+"""
+Fast conversion of Django model instances to and from the message
+format used by ZmqPublisher.sendDjango():
+
+  {"model": "<app_label>.<model_name>",
+   "pk": <primary key>,
+   "fields": {<field name>: <value>, ...}}
+
+This is the same structure the Django JSON serializer produces for one
+object, with values already in their JSON form. Instead of serializing
+to text and parsing the text back, serializeModel() reads each field
+with a getter that is worked out once per model class and cached.
+deserializeModel() likewise builds instances directly from the parsed
+message with cached per-field converters, instead of re-encoding the
+data for the Django deserializer.
+"""
+
+try:
+    from django.apps import apps
+    getModelByLabel = apps.get_model
+except ImportError:
+    # Django < 1.7
+    from django.db.models import get_model
+
+    def getModelByLabel(label):
+        return get_model(*label.split('.', 1))
+
+from django.db.models import Field
+from django.core.serializers.json import DjangoJSONEncoder
+from django.utils.encoding import force_text, is_protected_type
+
+JSON_NATIVE_TYPES = (basestring, int, long, float)
+FAST_TYPES = (int, long, float, bool, str, unicode)
+
+_encoder = DjangoJSONEncoder()
+_fieldGettersCache = {}
+_modelCache = {}
+_fieldConvertersCache = {}
+
+# marks fields missing from a message
+MISSING = object()
+
+
+def toJsonValue(value):
+    """
+    Returns @value as the JSON serializer would encode it, so that
+    dates, times, decimals and UUIDs become strings.
+    """
+    if value is None or isinstance(value, JSON_NATIVE_TYPES):
+        return value
+    return _encoder.default(value)
+
+
+def getRemoteField(field):
+    # Django 1.9 renamed field.rel to field.remote_field
+    return getattr(field, 'remote_field', getattr(field, 'rel', None))
+
+
+def getRelatedModel(remoteField):
+    # Django 1.8 renamed rel.to to remote_field.model
+    return getattr(remoteField, 'model', None) or remoteField.to
+
+
+def hasDefault(field, methodName):
+    return getattr(type(field), methodName).__func__ is getattr(Field, methodName).__func__
+
+
+def getPlainFieldGetter(attname):
+    # same result as Serializer.handle_field() for fields that don't
+    # override value_from_object() or value_to_string()
+    def getter(obj):
+        value = getattr(obj, attname)
+        if value is None or type(value) in FAST_TYPES:
+            if type(value) is str:
+                return force_text(value)
+            return value
+        if is_protected_type(value):
+            return toJsonValue(value)
+        return force_text(value)
+    return getter
+
+
+def getFieldGetter(field):
+    def getter(obj):
+        value = field.value_from_object(obj)
+        if not is_protected_type(value):
+            value = field.value_to_string(obj)
+        return toJsonValue(value)
+    return getter
+
+
+def getForeignKeyGetter(field):
+    attname = field.get_attname()
+
+    def getter(obj):
+        value = getattr(obj, attname)
+        if not is_protected_type(value):
+            value = field.value_to_string(obj)
+        return toJsonValue(value)
+    return getter
+
+
+def getManyToManyGetter(field):
+    name = field.name
+
+    def getter(obj):
+        return [toJsonValue(force_text(related._get_pk_val(), strings_only=True))
+                for related in getattr(obj, name).iterator()]
+    return getter
+
+
+def getFieldGetters(model):
+    """
+    Returns a list of (fieldName, getter) pairs for the serialized fields
+    of @model, in the order the Django serializer visits them.
+    """
+    getters = _fieldGettersCache.get(model)
+    if getters is not None:
+        return getters
+
+    getters = []
+    meta = model._meta.concrete_model._meta
+    for field in meta.local_fields:
+        if not field.serialize:
+            continue
+        if getRemoteField(field) is None:
+            if hasDefault(field, 'value_from_object') and hasDefault(field, 'value_to_string'):
+                getters.append((field.name, getPlainFieldGetter(field.attname)))
+            else:
+                getters.append((field.name, getFieldGetter(field)))
+        else:
+            getters.append((field.name, getForeignKeyGetter(field)))
+    for field in meta.many_to_many:
+        if field.serialize and getRemoteField(field).through._meta.auto_created:
+            getters.append((field.name, getManyToManyGetter(field)))
+
+    _fieldGettersCache[model] = getters
+    return getters
+
+
+def serializeModel(modelInstance):
+    """
+    Returns the message dict for @modelInstance.
+    """
+    fields = {}
+    for name, getter in getFieldGetters(type(modelInstance)):
+        fields[name] = getter(modelInstance)
+    return {'model': force_text(modelInstance._meta),
+            'pk': toJsonValue(force_text(modelInstance._get_pk_val(), strings_only=True)),
+            'fields': fields}
+
+
+def getModel(label):
+    model = _modelCache.get(label)
+    if model is None:
+        model = getModelByLabel(label)
+        _modelCache[label] = model
+    return model
+
+
+def isManyToOne(field):
+    remoteField = getRemoteField(field)
+    return remoteField is not None and not getattr(field, 'many_to_many', False)
+
+
+def getForeignKeyConverter(field, resolveRelations):
+    remoteField = getRemoteField(field)
+    model = getRelatedModel(remoteField)
+    targetField = model._meta.get_field(remoteField.field_name)
+    manager = model._default_manager
+    hasNaturalKey = hasattr(manager, 'get_by_natural_key')
+
+    def converter(value):
+        if value is None:
+            return None
+        if hasNaturalKey and isinstance(value, (list, tuple)):
+            if not resolveRelations:
+                # keep the natural key, no lookups
+                return value
+            related = manager.get_by_natural_key(*value)
+            value = getattr(related, remoteField.field_name)
+            if getRemoteField(model._meta.pk) is not None:
+                # natural key of a model whose pk is itself a relation
+                value = value.pk
+            return value
+        return targetField.to_python(value)
+    return converter
+
+
+def getFieldConverters(model, resolveRelations):
+    """
+    Returns (fields, pkIndex, convertersByName) for @model, where
+    @fields is the list of concrete fields in the order the model
+    constructor accepts them as positional arguments, and
+    @convertersByName maps serialized field names to (index, converter)
+    pairs.
+    """
+    key = (model, resolveRelations)
+    result = _fieldConvertersCache.get(key)
+    if result is not None:
+        return result
+
+    meta = model._meta
+    fields = list(getattr(meta, 'concrete_fields', meta.fields))
+    pkIndex = None
+    convertersByName = {}
+    for i, field in enumerate(fields):
+        if field is meta.pk:
+            pkIndex = i
+        if isManyToOne(field):
+            convertersByName[field.name] = (i, getForeignKeyConverter(field, resolveRelations))
+        else:
+            convertersByName[field.name] = (i, field.to_python)
+
+    result = (fields, pkIndex, convertersByName)
+    _fieldConvertersCache[key] = result
+    return result
+
+
+def deserializeModel(data, resolveRelations=True):
+    """
+    Returns an unsaved model instance built from the message dict @data,
+    matching what the Django deserializer returns as its 'object'.
+    Many-to-many data is ignored. If @resolveRelations is False, natural
+    keys of foreign keys are never looked up in the database and are
+    used as-is. Plain key values are still converted to the type of the
+    key field.
+    """
+    model = getModel(data['model'])
+    fields, pkIndex, convertersByName = getFieldConverters(model, resolveRelations)
+
+    values = [MISSING] * len(fields)
+    pk = data.get('pk')
+    if pk is not None:
+        values[pkIndex] = fields[pkIndex].to_python(pk)
+    for name, value in data['fields'].iteritems():
+        entry = convertersByName.get(name)
+        if entry is not None:
+            index, converter = entry
+            values[index] = converter(value)
+    for i, value in enumerate(values):
+        if value is MISSING:
+            values[i] = fields[i].get_default()
+
+    obj = model(*values)
+    if (resolveRelations and obj.pk is None and hasattr(model, 'natural_key')
+            and hasattr(model._default_manager, 'get_by_natural_key')):
+        try:
+            obj.pk = model._default_manager.get_by_natural_key(*obj.natural_key()).pk
+        except model.DoesNotExist:
+            pass
+    return obj
@@ -0,0 +1,134 @@
+#__BEGIN_LICENSE__
+# Copyright (c) 2017, United States Government, as represented by the
+# Administrator of the National Aeronautics and Space Administration.
+# All rights reserved.
+#
+# The GeoRef platform is licensed under the Apache License, Version 2.0
+# (the "License"); you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+# http://www.apache.org/licenses/LICENSE-2.0.
+#
+# Unless required by applicable law or agreed to in writing, software distributed
+# under the License is distributed on an "AS IS" BASIS, WITHOUT WARRANTIES OR
+# CONDITIONS OF ANY KIND, either express or implied. See the License for the
+# specific language governing permissions and limitations under the License.
+#__END_LICENSE__
+
+import datetime
+import decimal
+import unittest
+
+from django.db import models
+from django.core import serializers
+
+from geocamUtil import anyjson as json
+from geocamUtil.models import UuidField, JsonCharField
+from geocamUtil.zmqUtil.modelSerializer import serializeModel, deserializeModel
+from geocamUtil.zmqUtil.publisher import ZmqPublisher
+
+
+class SerializerExampleParent(models.Model):
+    name = models.CharField(max_length=32)
+
+    class Meta:
+        app_label = 'geocamUtil'
+
+
+class SerializerExample(models.Model):
+    name = models.CharField(max_length=32)
+    notes = models.TextField(blank=True)
+    count = models.IntegerField(default=0)
+    value = models.FloatField(null=True)
+    flag = models.BooleanField(default=False)
+    price = models.DecimalField(max_digits=8, decimal_places=2, null=True)
+    day = models.DateField(null=True)
+    timestamp = models.DateTimeField(null=True)
+    uuid = UuidField()
+    extras = JsonCharField(max_length=256, blank=True)
+    parent = models.ForeignKey(SerializerExampleParent, null=True, on_delete=models.CASCADE)
+
+    class Meta:
+        app_label = 'geocamUtil'
+
+
+def getExample():
+    return SerializerExample(id=7,
+                             name='foo',
+                             notes=u'caf\xe9',
+                             count=3,
+                             value=2.5,
+                             flag=True,
+                             price=decimal.Decimal('12.34'),
+                             day=datetime.date(2017, 1, 2),
+                             timestamp=datetime.datetime(2017, 1, 2, 3, 4, 5, 678901),
+                             extras=[1, 2],
+                             parent_id=5)
+
+
+class FakeSocket(object):
+    def __init__(self):
+        self.sent = []
+
+    def send_multipart(self, frames, flags=0):
+        self.sent.append(list(frames))
+
+
+def getFieldValues(obj):
+    return dict([(field.attname, getattr(obj, field.attname))
+                 for field in obj._meta.concrete_fields])
+
+
+class ModelSerializerTest(unittest.TestCase):
+    def assertSameAsDjango(self, obj):
+        django = json.loads(serializers.serialize('json', [obj]))[0]
+        self.assertEqual(django, json.loads(json.dumps(serializeModel(obj))))
+
+    def test_values(self):
+        self.assertSameAsDjango(getExample())
+
+    def test_defaults(self):
+        self.assertSameAsDjango(SerializerExample(name='bar'))
+
+    def test_deserialize(self):
+        dataText = json.dumps(serializeModel(getExample()))
+        django = list(serializers.deserialize('json', '[%s]' % dataText))[0].object
+        obj = deserializeModel(json.loads(dataText))
+        self.assertEqual(SerializerExample, type(obj))
+        self.assertEqual(getFieldValues(django), getFieldValues(obj))
+
+    def test_deserializeMissingFields(self):
+        data = {'model': 'geocamUtil.serializerexample',
+                'pk': 3,
+                'fields': {'name': 'baz', 'parent': '5'}}
+        obj = deserializeModel(data)
+        self.assertEqual(3, obj.pk)
+        self.assertEqual(0, obj.count)
+        self.assertEqual(5, obj.parent_id)
+        # the key is still converted to the right type, just not looked up
+        self.assertEqual(5, deserializeModel(data, resolveRelations=False).parent_id)
+
+    def test_sendDjangoMany(self):
+        instances = [SerializerExample(id=i, name='ex%d' % i) for i in xrange(3)]
+        publisher = ZmqPublisher('serializerTest', wireMode='multipart')
+        publisher.pubSocket = FakeSocket()
+        publisher.sendDjangoMany(instances)
+        # one topic and one body frame per instance
+        sent = publisher.pubSocket.sent
+        self.assertEqual([2, 2, 2], [len(frames) for frames in sent])
+        self.assertEqual(['geocamUtil.serializerexample:'] * 3, [frames[0] for frames in sent])
+        self.assertEqual([0, 1, 2], [json.loads(frames[1])['data']['pk'] for frames in sent])
+        self.assertEqual(serializeModel(instances[1]), json.loads(sent[1][1])['data'])
+
+        # the instances go through the sendMany() batch, so repeated
+        # messages on a coalesced topic collapse to the last one
+        publisher = ZmqPublisher('serializerTest', coalesce=['geocamUtil.'])
+        publisher.pubSocket = FakeSocket()
+        publisher.sendDjangoMany(instances)
+        sent = publisher.pubSocket.sent
+        self.assertEqual(1, len(sent))
+        self.assertEqual(1, len(sent[0]))
+        self.assertEqual(2, json.loads(sent[0][0].split(':', 1)[1])['data']['pk'])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -18,20 +18,25 @@
 
 # pylint: disable=E1101
 
+import time
 import logging
 import re
+import itertools
 
 import zmq
 from zmq.eventloop.zmqstream import ZMQStream
 from zmq.eventloop import ioloop
 
-from django.core import serializers
-
-from geocamUtil import anyjson as json
 from geocamUtil.zmqUtil.util import (getTimestamp,
                                      parseEndpoint,
                                      getShortHostName,
+                                     getAttachmentFrames,
+                                     formatMimeBody,
+                                     FrameAttachment,
+                                     WIRE_MODES,
                                      DEFAULT_CENTRAL_SUBSCRIBE_PORT)
+from geocamUtil.zmqUtil.modelSerializer import serializeModel
+from geocamUtil.zmqUtil.messageCodec import getCodec, KNOWN_CODECS, DEFAULT_CODEC
 
 PUBLISHER_OPT_DEFAULTS = {'centralHost': '127.0.0.1',
                           'moduleName': None,
@@ -39,9 +44,23 @@ PUBLISHER_OPT_DEFAULTS = {'centralHost': '127.0.0.1',
                           % DEFAULT_CENTRAL_SUBSCRIBE_PORT,
                           'publishEndpoint': 'tcp://127.0.0.1:random',
                           'heartbeatPeriodMsecs': 5000,
-                          # 'highWaterMark': 100
+                          'highWaterMark': None,
+                          'countDrops': False,
+                          'wireMode': 'single',
+                          'batchSize': 0,
+                          'batchDelayMsecs': 0,
+                          'coalesce': None,
+                          'codec': DEFAULT_CODEC,
                           }
 
+# control messages for central, always sent as JSON so that centrals
+# and modules that don't know about codecs can parse them
+CONTROL_TOPIC_PREFIX = 'central.'
+JSON_CODEC = getCodec('json')
+
+# max model instances sendDjangoMany() serializes before sending them
+DJANGO_BATCH_SIZE = 1000
+
 
 class ZmqPublisher(object):
     def __init__(self,
@@ -51,7 +70,13 @@ class ZmqPublisher(object):
                  centralSubscribeEndpoint=PUBLISHER_OPT_DEFAULTS['centralSubscribeEndpoint'],
                  publishEndpoint=PUBLISHER_OPT_DEFAULTS['publishEndpoint'],
                  heartbeatPeriodMsecs=PUBLISHER_OPT_DEFAULTS['heartbeatPeriodMsecs'],
-                 # highWaterMark=PUBLISHER_OPT_DEFAULTS['highWaterMark']
+                 highWaterMark=PUBLISHER_OPT_DEFAULTS['highWaterMark'],
+                 countDrops=PUBLISHER_OPT_DEFAULTS['countDrops'],
+                 wireMode=PUBLISHER_OPT_DEFAULTS['wireMode'],
+                 batchSize=PUBLISHER_OPT_DEFAULTS['batchSize'],
+                 batchDelayMsecs=PUBLISHER_OPT_DEFAULTS['batchDelayMsecs'],
+                 coalesce=PUBLISHER_OPT_DEFAULTS['coalesce'],
+                 codec=PUBLISHER_OPT_DEFAULTS['codec'],
                  ):
         self.moduleName = moduleName
         self.centralHost = centralHost
@@ -66,12 +91,31 @@ class ZmqPublisher(object):
         self.publishEndpoint = parseEndpoint(publishEndpoint,
                                              defaultPort='random')
         self.heartbeatPeriodMsecs = heartbeatPeriodMsecs
-        #self.highWaterMark = highWaterMark
+        self.highWaterMark = highWaterMark
+        self.countDrops = countDrops
+        if wireMode not in WIRE_MODES:
+            raise ValueError('unknown wireMode %s, expected one of %s'
+                             % (wireMode, ', '.join(WIRE_MODES)))
+        self.wireMode = wireMode
+        self.batchSize = batchSize
+        self.batchDelayMsecs = batchDelayMsecs
+        if coalesce is None:
+            coalesce = []
+        self.coalescePrefixes = tuple(coalesce)
+        self.codec = getCodec(codec)
 
         self.pubStream = None
+        self.pubSocket = None
         self.heartbeatTimer = None
+        self.numDropped = 0
 
-        self.serializer = serializers.get_serializer('json')()
+        # messages waiting to be sent in batch mode. entries replaced by
+        # a later message on the same coalesced topic are set to None.
+        self.pending = []
+        self.pendingTopics = {}
+        self.flushScheduled = False
+        self.flushTimeout = None
+        self.numCoalesced = 0
 
     @classmethod
     def addOptions(cls, parser, defaultModuleName):
@@ -84,7 +128,7 @@ class ZmqPublisher(object):
                               default=defaultModuleName,
                               help='Name to use for this module [%default]')
         if not parser.has_option('--centralSubscribeEndpoint'):
-            parser.add_option('--centralSubcribeEndpoint',
+            parser.add_option('--centralSubscribeEndpoint',
                               default=PUBLISHER_OPT_DEFAULTS['centralSubscribeEndpoint'],
                               help='Endpoint where central listens for messages [%default]')
         if not parser.has_option('--publishEndpoint'):
@@ -96,11 +140,39 @@ class ZmqPublisher(object):
                               default=PUBLISHER_OPT_DEFAULTS['heartbeatPeriodMsecs'],
                               type='int',
                               help='Period for sending heartbeats to central [%default]')
-        #if not parser.has_option('--highWaterMark'):
-        #    parser.add_option('--highWaterMark',
-        #                      default=PUBLISHER_OPT_DEFAULTS['highWaterMark'],
-        #                      type='int',
-        #                      help='High-water mark for publish socket (see 0MQ docs) [%default]')
+        if not parser.has_option('--wireMode'):
+            parser.add_option('--wireMode',
+                              default=PUBLISHER_OPT_DEFAULTS['wireMode'],
+                              type='choice', choices=WIRE_MODES,
+                              help='Send topic and body as one frame ("single") or as separate frames ("multipart") [%default]')
+        if not parser.has_option('--highWaterMark'):
+            parser.add_option('--highWaterMark',
+                              default=PUBLISHER_OPT_DEFAULTS['highWaterMark'],
+                              type='int',
+                              help='High-water mark for publish socket (see 0MQ docs) [libzmq default]')
+        if not parser.has_option('--countDrops'):
+            parser.add_option('--countDrops',
+                              action='store_true', default=PUBLISHER_OPT_DEFAULTS['countDrops'],
+                              help='Count messages dropped at the high-water mark and report them to central. A message is then dropped for all subscribers when any one of them is full')
+        if not parser.has_option('--batchSize'):
+            parser.add_option('--batchSize',
+                              default=PUBLISHER_OPT_DEFAULTS['batchSize'],
+                              type='int',
+                              help='Queue up to this many messages and send them together, or 0 to send each message right away [%default]')
+        if not parser.has_option('--batchDelayMsecs'):
+            parser.add_option('--batchDelayMsecs',
+                              default=PUBLISHER_OPT_DEFAULTS['batchDelayMsecs'],
+                              type='int',
+                              help='In batch mode, max delay before queued messages are sent, or 0 to send them at the end of the current ioloop iteration [%default]')
+        if not parser.has_option('--coalesce'):
+            parser.add_option('--coalesce',
+                              action='append',
+                              help='Topic prefix to coalesce in batch mode: a queued message is replaced by a newer one on the same topic (can specify multiple times)')
+        if not parser.has_option('--codec'):
+            parser.add_option('--codec',
+                              default=PUBLISHER_OPT_DEFAULTS['codec'],
+                              type='choice', choices=KNOWN_CODECS,
+                              help='Codec for messages sent with sendJson(), falls back to json if not installed [%default]')
 
     @classmethod
     def getOptionValues(cls, opts):
@@ -113,34 +185,180 @@ class ZmqPublisher(object):
 
     def heartbeat(self):
         logging.debug('ZmqPublisher: heartbeat')
-        self.sendJson('central.heartbeat.%s' % self.moduleName,
-                      {'host': getShortHostName(),
-                       'pub': self.publishEndpoint})
+        params = {'host': getShortHostName(),
+                  'pub': self.publishEndpoint}
+        if self.countDrops:
+            params['dropped'] = self.numDropped
+        self.sendJson('central.heartbeat.%s' % self.moduleName, params)
+
+    def sendNow(self, frames):
+        """
+        Sends @frames straight to the socket. A PUB socket never blocks
+        on send, so there is no need to go through the ZMQStream send
+        queue and flush it every time. The flip side is that a publisher
+        sending faster than the connection drains silently loses
+        messages once the high-water mark (1000 messages by default in
+        libzmq) is reached. Raise it with highWaterMark (0 means no
+        limit) or use countDrops to count the losses.
+        """
+        if self.countDrops:
+            # the XPUB_NODROP socket refuses the message instead of
+            # silently discarding it when a subscriber is at its HWM
+            try:
+                self.pubSocket.send_multipart(frames, zmq.NOBLOCK)
+            except zmq.Again:
+                self.numDropped += 1
+        else:
+            self.pubSocket.send_multipart(frames)
+
+    def sendFrames(self, frames, topic):
+        if self.batchSize:
+            self.queueFrames(frames, topic)
+        else:
+            self.sendNow(frames)
+
+    def queueFrames(self, frames, topic):
+        if self.coalescePrefixes and (topic + ':').startswith(self.coalescePrefixes):
+            index = self.pendingTopics.get(topic)
+            if index is not None:
+                self.pending[index] = None
+                self.numCoalesced += 1
+            self.pendingTopics[topic] = len(self.pending)
+        self.pending.append(frames)
+
+        if not self.batchSize:
+            return
+        if len(self.pending) >= self.batchSize:
+            self.flush()
+        elif not self.flushScheduled:
+            self.flushScheduled = True
+            loop = ioloop.IOLoop.instance()
+            if self.batchDelayMsecs:
+                self.flushTimeout = loop.add_timeout(time.time() + self.batchDelayMsecs / 1000.0,
+                                                     self.flush)
+            else:
+                loop.add_callback(self.flush)
+
+    def flush(self):
+        """
+        Sends any messages queued in batch mode. Call before exiting to
+        make sure nothing is left behind.
+        """
+        if self.flushTimeout is not None:
+            ioloop.IOLoop.instance().remove_timeout(self.flushTimeout)
+            self.flushTimeout = None
+        self.flushScheduled = False
+        if not self.pending:
+            return
+        pending = self.pending
+        self.pending = []
+        self.pendingTopics = {}
+        for frames in pending:
+            if frames is not None:
+                self.sendNow(frames)
+
+    def getFrames(self, topic, body):
+        if self.wireMode == 'multipart':
+            return (topic + ':', body)
+        else:
+            return ('%s:%s' % (topic, body),)
 
     def sendRaw(self, topic, body):
-        self.pubStream.send('%s:%s' % (topic, body))
-        self.pubStream.flush()
+        self.sendFrames(self.getFrames(topic, body), topic)
 
-    def sendJson(self, topic, obj):
+    def sendMany(self, messages):
+        """
+        Sends @messages, a sequence of (topic, body) pairs, as one batch.
+        Topics matching a coalesce prefix are coalesced within the batch.
+        In batch mode the messages join the pending batch; otherwise
+        they are sent before sendMany() returns.
+        """
+        for topic, body in messages:
+            self.queueFrames(self.getFrames(topic, body), topic)
+        if not self.batchSize:
+            self.flush()
+
+    def sendAttachments(self, topic, body, attachments):
+        """
+        Sends @body with @attachments, a list of FrameAttachment objects
+        or (filename, contentType, data) tuples. In multipart wire mode
+        each attachment travels as separate frames; otherwise the body
+        and attachments are packed into a MIME document.
+        """
+        attachments = [a if isinstance(a, FrameAttachment) else FrameAttachment(*a)
+                       for a in attachments]
+        if self.wireMode == 'multipart':
+            self.sendFrames([topic + ':', body] + getAttachmentFrames(attachments), topic)
+        else:
+            self.sendFrames(('%s:%s' % (topic, formatMimeBody(body, attachments)),), topic)
+
+    def encodeJson(self, topic, obj):
+        """
+        Returns the body sendJson() would send for @obj on @topic.
+        """
         if isinstance(obj, dict):
             obj.setdefault('module', self.moduleName)
             obj.setdefault('timestamp', str(getTimestamp()))
-        self.sendRaw(topic, json.dumps(obj))
+        codec = self.codec
+        if topic.startswith(CONTROL_TOPIC_PREFIX):
+            codec = JSON_CODEC
+        return codec.encode(obj)
 
-    def sendDjango(self, modelInstance, topic=None, topicSuffix=None):
-        dataText = self.serializer.serialize([modelInstance])
-        data = json.loads(dataText)[0]
+    def sendJson(self, topic, obj):
+        """
+        Sends @obj encoded with the publisher's codec, JSON by default.
+        Control messages to central (topics starting with 'central.')
+        are always sent as JSON. See messageCodec.
+        """
+        self.sendRaw(topic, self.encodeJson(topic, obj))
+
+    def getDjangoMessage(self, modelInstance, topic=None, topicSuffix=None):
+        """
+        Returns the (topic, body) pair sendDjango() would send for
+        @modelInstance.
+        """
+        data = serializeModel(modelInstance)
         if topic is None:
             topic = data['model'].encode('utf-8')
             if topicSuffix is not None:
                 topic += topicSuffix
-        self.sendJson(topic, {'data': data})
+        return topic, self.encodeJson(topic, {'data': data})
+
+    def sendDjango(self, modelInstance, topic=None, topicSuffix=None):
+        self.sendRaw(*self.getDjangoMessage(modelInstance, topic, topicSuffix))
+
+    def sendDjangoMany(self, modelInstances, topic=None, topicSuffix=None):
+        """
+        Sends the sendDjango() messages for @modelInstances, which may be
+        a list or a queryset, through sendMany(), so they are batched
+        and coalesced like any other sendMany() call. Querysets are
+        iterated without filling their result cache, and at most
+        DJANGO_BATCH_SIZE instances are serialized at a time.
+        """
+        if hasattr(modelInstances, 'iterator'):
+            modelInstances = modelInstances.iterator()
+        modelInstances = iter(modelInstances)
+        while True:
+            messages = [self.getDjangoMessage(modelInstance, topic, topicSuffix)
+                        for modelInstance in itertools.islice(modelInstances, DJANGO_BATCH_SIZE)]
+            if not messages:
+                break
+            self.sendMany(messages)
 
     def start(self):
-        pubSocket = self.context.socket(zmq.PUB)
+        if self.countDrops:
+            pubSocket = self.context.socket(zmq.XPUB)
+            pubSocket.setsockopt(zmq.XPUB_NODROP, 1)
+        else:
+            pubSocket = self.context.socket(zmq.PUB)
+        if self.highWaterMark is not None:
+            pubSocket.setsockopt(zmq.SNDHWM, self.highWaterMark)
+        self.pubSocket = pubSocket
         self.pubStream = ZMQStream(pubSocket)
+        if self.countDrops:
+            # XPUB delivers subscription messages, which we don't need
+            self.pubStream.on_recv(lambda _msg: None)
         # self.pubStream.setsockopt(zmq.IDENTITY, self.moduleName)
-        # self.pubStream.setsockopt(zmq.HWM, self.highWaterMark)
         self.pubStream.connect(self.centralSubscribeEndpoint)
         logging.info('zmq.publisher: connected to central at %s', self.centralSubscribeEndpoint)
 
@@ -16,22 +16,45 @@
 
 # pylint: disable=E1101
 
+import time
 import logging
-import sys
 import zmq
 from zmq.eventloop.zmqstream import ZMQStream
+from zmq.eventloop import ioloop
 
-from django.core import serializers
-
-from geocamUtil import anyjson as json
-from geocamUtil.zmqUtil.util import parseEndpoint, DEFAULT_CENTRAL_PUBLISH_PORT, LogParser
-from geocamUtil.models.ExtrasDotField import convertToDotDictRecurse
+from geocamUtil.zmqUtil.util import (parseEndpoint,
+                                     parseTimestampArg,
+                                     parseMessageBody,
+                                     parseAttachmentFrames,
+                                     formatMimeBody,
+                                     DEFAULT_CENTRAL_PUBLISH_PORT,
+                                     openLogParsers)
+from geocamUtil.dotDict import convertToLazyDotDict
+from geocamUtil.zmqUtil.modelSerializer import deserializeModel
+from geocamUtil.zmqUtil.messageCodec import decodeBody
 
 SUBSCRIBER_OPT_DEFAULTS = {'centralHost': '127.0.0.1',
                            'moduleName': None,
                            'centralPublishEndpoint': 'tcp://{centralHost}:%d'
                            % DEFAULT_CENTRAL_PUBLISH_PORT,
-                           'replay': None}
+                           'replay': None,
+                           'replayStart': None,
+                           'replayEnd': None,
+                           'replayDedupeMsecs': None,
+                           'highWaterMark': None,
+                           'conflate': None}
+
+# max messages to pull off the socket at once when conflating
+MAX_CONFLATE_BATCH = 1000
+
+# max number of distinct topics to cache handler lists for
+MAX_TOPIC_CACHE = 10000
+
+# what form of the message a handler is called with
+RAW_HANDLER = 'raw'
+JSON_HANDLER = 'json'
+ATTACHMENTS_HANDLER = 'attachments'
+BRIDGE_HANDLER = 'bridge'
 
 
 class ZmqSubscriber(object):
@@ -40,7 +63,12 @@ class ZmqSubscriber(object):
                  centralHost=SUBSCRIBER_OPT_DEFAULTS['centralHost'],
                  context=None,
                  centralPublishEndpoint=SUBSCRIBER_OPT_DEFAULTS['centralPublishEndpoint'],
-                 replay=None):
+                 replay=None,
+                 replayStart=None,
+                 replayEnd=None,
+                 replayDedupeMsecs=None,
+                 highWaterMark=None,
+                 conflate=None):
         self.moduleName = moduleName
         self.centralHost = centralHost
 
@@ -54,10 +82,24 @@ class ZmqSubscriber(object):
         self.replayPaths = replay
         if self.replayPaths is None:
             self.replayPaths = []
+        self.replayStart = replayStart
+        if isinstance(self.replayStart, basestring):
+            self.replayStart = parseTimestampArg(self.replayStart)
+        self.replayEnd = replayEnd
+        if isinstance(self.replayEnd, basestring):
+            self.replayEnd = parseTimestampArg(self.replayEnd)
+        self.replayDedupeMsecs = replayDedupeMsecs
+
+        self.highWaterMark = highWaterMark
+        if conflate is None:
+            conflate = []
+        self.conflatePrefixes = tuple(conflate)
+        self.numConflated = 0
 
         self.handlers = {}
+        self.topicCache = {}
         self.counter = 0
-        self.deserializer = serializers.get_deserializer('json')
+        self.batches = {}
         self.stream = None
 
     @classmethod
@@ -78,6 +120,24 @@ class ZmqSubscriber(object):
             parser.add_option('--replay',
                               action='append',
                               help='Replay specified message log (can specify multiple times), or use - to read from stdin')
+        if not parser.has_option('--replayStart'):
+            parser.add_option('--replayStart',
+                              help='When replaying, skip messages before this time (UTC "YYYY-MM-DD HH:MM:SS" or microsecond timestamp)')
+        if not parser.has_option('--replayEnd'):
+            parser.add_option('--replayEnd',
+                              help='When replaying, skip messages after this time (UTC "YYYY-MM-DD HH:MM:SS" or microsecond timestamp)')
+        if not parser.has_option('--replayDedupeMsecs'):
+            parser.add_option('--replayDedupeMsecs',
+                              type='int',
+                              help='When replaying several logs, drop a message if the same message came from another log within this many msecs [no dedupe]')
+        if not parser.has_option('--highWaterMark'):
+            parser.add_option('--highWaterMark',
+                              type='int',
+                              help='High-water mark for subscribe socket (see 0MQ docs) [libzmq default]')
+        if not parser.has_option('--conflate'):
+            parser.add_option('--conflate',
+                              action='append',
+                              help='Topic prefix to conflate: when messages back up, only deliver the latest message for each topic (can specify multiple times)')
 
     @classmethod
     def getOptionValues(cls, opts):
@@ -90,78 +150,303 @@ class ZmqSubscriber(object):
 
     def start(self):
         sock = self.context.socket(zmq.SUB)
+        if self.highWaterMark is not None:
+            sock.setsockopt(zmq.RCVHWM, self.highWaterMark)
         self.stream = ZMQStream(sock)
         # causes problems with multiple instances
         #self.stream.setsockopt(zmq.IDENTITY, self.moduleName)
         self.stream.connect(self.centralPublishEndpoint)
         logging.info('zmq.subscriber: connected to central at %s', self.centralPublishEndpoint)
+        # handlers registered before start
+        for topicPrefix in self.handlers.iterkeys():
+            logging.info('zmq.subscriber: subscribe %s', topicPrefix)
+            self.stream.setsockopt(zmq.SUBSCRIBE, topicPrefix)
         self.stream.on_recv(self.routeMessages)
 
     def routeMessages(self, messages):
-        for msg in messages:
-            self.routeMessage(msg)
+        """
+        @messages holds the frames of one message: a single frame in the
+        legacy format, or [topic:, body, attachment frames...] in
+        multipart wire mode.
+        """
+        if self.conflatePrefixes:
+            return self.routeConflated(messages)
+        return self.routeFrames(messages)
+
+    def routeConflated(self, messages):
+        """
+        Pulls the backlog of waiting messages off the socket and routes
+        it, skipping all but the latest message for each topic that
+        matches a conflate prefix. Other messages are routed in order.
+        """
+        batch = [messages]
+        sock = self.stream.socket
+        while len(batch) < MAX_CONFLATE_BATCH:
+            try:
+                batch.append(sock.recv_multipart(zmq.NOBLOCK))
+            except zmq.Again:
+                break
+
+        latest = {}
+        for i, frames in enumerate(batch):
+            if len(frames) == 1:
+                topic = frames[0][:(frames[0].find(':') + 1)]
+            else:
+                topic = frames[0]
+            if topic.startswith(self.conflatePrefixes):
+                if topic in latest:
+                    batch[latest[topic]] = None
+                    self.numConflated += 1
+                latest[topic] = i
+
+        handled = 0
+        for frames in batch:
+            if frames is not None:
+                handled += self.routeFrames(frames)
+        return handled
+
+    def routeFrames(self, messages):
+        if len(messages) == 1:
+            return self.routeMessage(messages[0])
+        if len(messages) % 2:
+            # attachments take two frames each, so an odd frame at the
+            # end is the header of a message imported by zmqBridge
+            return self.dispatch(messages[0], messages[1],
+                                 parseAttachmentFrames(messages[2:-1]),
+                                 messages[-1])
+        return self.dispatch(messages[0], messages[1], parseAttachmentFrames(messages[2:]))
 
     def routeMessage(self, msg):
         colonIndex = msg.find(':')
         topic = msg[:(colonIndex + 1)]
         body = msg[(colonIndex + 1):]
+        return self.dispatch(topic, body)
 
-        handled = 0
-        for topicPrefix, registry in self.handlers.iteritems():
-            if topic.startswith(topicPrefix):
-                for handler in registry.itervalues():
-                    handler(topic[:-1], body)
-                    handled = 1
+    def dispatch(self, topic, body, attachments=None, bridgeHeader=None):
+        """
+        Calls the handlers matching @topic (which includes the trailing
+        colon). @attachments is None for legacy messages, whose
+        attachments are still packed into @body, and a list of
+        FrameAttachment objects for multipart messages. @bridgeHeader is
+        only passed to handlers registered with subscribeBridge(). Each
+        handler gets the message in the format it subscribed for. Each of
+        those formats is computed at most once per message, so JSON
+        handlers share one decoded object.
+        """
+        topicHandlers = self.topicCache.get(topic)
+        if topicHandlers is None:
+            topicHandlers = self.getTopicHandlers(topic)
 
-        return handled
+        rawBody = None
+        parsed = None
+        obj = None
+        for handler, kind in topicHandlers:
+            if kind == JSON_HANDLER:
+                if obj is None:
+                    if attachments is None and body.startswith('Content-Type:'):
+                        if parsed is None:
+                            parsed = parseMessageBody(body)
+                        jsonBody = parsed['json']
+                    else:
+                        jsonBody = body
+                    obj = convertToLazyDotDict(decodeBody(jsonBody))
+                handler(topic[:-1], obj)
+            elif kind == ATTACHMENTS_HANDLER:
+                if attachments is None:
+                    if parsed is None:
+                        parsed = parseMessageBody(body)
+                    handler(topic[:-1], parsed['json'], parsed['attachments'])
+                else:
+                    handler(topic[:-1], body, attachments)
+            else:
+                if rawBody is None:
+                    if attachments:
+                        # raw handlers expect the legacy format
+                        rawBody = formatMimeBody(body, attachments)
+                    else:
+                        rawBody = body
+                if kind == BRIDGE_HANDLER:
+                    handler(topic[:-1], rawBody, bridgeHeader)
+                else:
+                    handler(topic[:-1], rawBody)
+
+        if topicHandlers:
+            return 1
+        else:
+            return 0
+
+    def getTopicHandlers(self, topic):
+        """
+        Returns the list of (handler, kind) pairs subscribed
+        to prefixes of @topic and caches it. Looking up each prefix of
+        the topic costs O(len(topic)) no matter how many prefixes are
+        subscribed. The cache is cleared whenever subscriptions change.
+        """
+        topicHandlers = []
+        handlers = self.handlers
+        for i in xrange(len(topic) + 1):
+            registry = handlers.get(topic[:i])
+            if registry:
+                topicHandlers.extend([registry[handlerIndex]
+                                      for handlerIndex in sorted(registry.iterkeys())])
+        if len(self.topicCache) >= MAX_TOPIC_CACHE:
+            self.topicCache.clear()
+        self.topicCache[topic] = topicHandlers
+        return topicHandlers
 
     def subscribeRaw(self, topicPrefix, handler):
+        return self.addHandler(topicPrefix, handler, RAW_HANDLER)
+
+    def subscribeBridge(self, topicPrefix, handler):
+        """
+        Like subscribeRaw(), but calls handler(topic, body, bridgeHeader),
+        where @bridgeHeader is the header frame zmqBridge appends to the
+        messages it imports from its peers, or None for messages that
+        were published locally.
+        """
+        return self.addHandler(topicPrefix, handler, BRIDGE_HANDLER)
+
+    def subscribeAttachments(self, topicPrefix, handler):
+        """
+        Calls handler(topic, jsonBody, attachments) for matching
+        messages. @attachments is a list of objects with get_filename(),
+        get_content_type() and get_payload() accessors, whether the
+        message arrived in the legacy MIME format or as multipart frames.
+        """
+        return self.addHandler(topicPrefix, handler, ATTACHMENTS_HANDLER)
+
+    def addHandler(self, topicPrefix, handler, kind):
         topicRegistry = self.handlers.setdefault(topicPrefix, {})
-        if not topicRegistry:
+        if not topicRegistry and self.stream is not None:
             logging.info('zmq.subscriber: subscribe %s', topicPrefix)
             self.stream.setsockopt(zmq.SUBSCRIBE, topicPrefix)
         handlerId = (topicPrefix, self.counter)
-        topicRegistry[self.counter] = handler
+        topicRegistry[self.counter] = (handler, kind)
         self.counter += 1
+        self.topicCache.clear()
         return handlerId
 
     def subscribeJson(self, topicPrefix, handler):
-        def jsonHandler(topicPrefix, body):
-            return handler(topicPrefix, convertToDotDictRecurse(json.loads(body)))
-        return self.subscribeRaw(topicPrefix, jsonHandler)
-
-    def subscribeDjango(self, topicPrefix, handler):
-        def djangoHandler(topicPrefix, body):
-            obj = json.loads(body)
-            dataText = json.dumps([obj['data']])
-            modelInstance = list(self.deserializer(dataText))[0]
-            return handler(topicPrefix, modelInstance.object)
-        return self.subscribeRaw(topicPrefix, djangoHandler)
+        """
+        Calls handler(topic, obj) for matching messages, where @obj is
+        the decoded body as a LazyDotDict. Bodies in any registered codec
+        are decoded (see messageCodec). The body is decoded once
+        per message and @obj is shared by all JSON handlers, so handlers
+        should not modify it.
+        """
+        return self.addHandler(topicPrefix, handler, JSON_HANDLER)
+
+    def subscribeDjango(self, topicPrefix, handler, resolveRelations=True):
+        """
+        Calls handler(topic, modelInstance) for matching messages sent
+        with ZmqPublisher.sendDjango(). If @resolveRelations is False,
+        foreign keys are set from the key values in the message without
+        any database lookups.
+        """
+        def djangoHandler(topicPrefix, obj):
+            return handler(topicPrefix, deserializeModel(obj['data'], resolveRelations))
+        return self.addHandler(topicPrefix, djangoHandler, JSON_HANDLER)
+
+    def subscribeDjangoBatch(self, topicPrefix, handler,
+                             maxBatchSize=100,
+                             maxDelaySecs=1.0,
+                             resolveRelations=True):
+        """
+        Like subscribeDjango(), but collects model instances and calls
+        handler(topicPrefix, modelInstances) with up to @maxBatchSize of
+        them at a time, at most @maxDelaySecs after the first one
+        arrived. Useful for handlers that save instances with
+        bulk_create().
+        """
+        batch = ModelBatch(topicPrefix, handler, maxBatchSize, maxDelaySecs)
+
+        def djangoHandler(topicPrefix, obj):
+            batch.add(deserializeModel(obj['data'], resolveRelations))
+        handlerId = self.addHandler(topicPrefix, djangoHandler, JSON_HANDLER)
+        self.batches[handlerId] = batch
+        return handlerId
+
+    def flushBatches(self):
+        for batch in self.batches.itervalues():
+            batch.flush()
 
     def unsubscribe(self, handlerId):
+        batch = self.batches.pop(handlerId, None)
+        if batch is not None:
+            batch.flush()
         topicPrefix, index = handlerId
         topicRegistry = self.handlers[topicPrefix]
         del topicRegistry[index]
+        self.topicCache.clear()
         if not topicRegistry:
-            logging.info('zmq.subscriber: unsubscribe %s', topicPrefix)
-            self.stream.setsockopt(zmq.UNSUBSCRIBE, topicPrefix)
+            del self.handlers[topicPrefix]
+            if self.stream is not None:
+                logging.info('zmq.subscriber: unsubscribe %s', topicPrefix)
+                self.stream.setsockopt(zmq.UNSUBSCRIBE, topicPrefix)
 
     def connect(self, endpoint):
         self.stream.connect(endpoint)
 
     def replay(self):
+        """
+        Routes the messages in the replay logs to the subscribed
+        handlers. Multiple logs are merged in timestamp order.
+        """
         numReplayed = 0
         numHandled = 0
-        for replayPath in self.replayPaths:
-            print '=== replaying messages from %s' % replayPath
-            if replayPath == '-':
-                replayFile = sys.stdin
-            else:
-                replayFile = open(replayPath, 'rb')
-            stream = LogParser(replayFile)
-            for rec in stream:
-                numReplayed += 1
-                numHandled += self.routeMessage(rec.msg)
-
-                if numReplayed % 10000 == 0:
-                    print 'replayed %d messages, %d handled' % (numReplayed, numHandled)
+        topicPrefixes = self.handlers.keys()
+        if not self.replayPaths:
+            return
+        print '=== replaying messages from %s' % ', '.join(self.replayPaths)
+        dedupeWindowUsecs = None
+        if self.replayDedupeMsecs:
+            dedupeWindowUsecs = self.replayDedupeMsecs * 1000
+        stream = openLogParsers(self.replayPaths, dedupeWindowUsecs)
+        for rec in stream.select(self.replayStart, self.replayEnd, topicPrefixes):
+            numReplayed += 1
+            numHandled += self.routeMessage(rec.msg)
+
+            if numReplayed % 10000 == 0:
+                print 'replayed %d messages, %d handled' % (numReplayed, numHandled)
+        stream.close()
+        if getattr(stream, 'numDuplicates', 0):
+            print 'dropped %d duplicate messages' % stream.numDuplicates
+        # the ioloop may not be running to flush batches on their timers
+        self.flushBatches()
+
+
+class ModelBatch(object):
+    """
+    Collects model instances for subscribeDjangoBatch() and passes them
+    to the handler in batches.
+    """
+
+    def __init__(self, topicPrefix, handler, maxBatchSize, maxDelaySecs):
+        self.topicPrefix = topicPrefix
+        self.handler = handler
+        self.maxBatchSize = maxBatchSize
+        self.maxDelaySecs = maxDelaySecs
+        self.instances = []
+        self.timeout = None
+
+    def add(self, modelInstance):
+        self.instances.append(modelInstance)
+        if len(self.instances) >= self.maxBatchSize:
+            self.flush()
+        elif self.timeout is None:
+            self.timeout = (ioloop.IOLoop.instance()
+                            .add_timeout(time.time() + self.maxDelaySecs, self.handleTimeout))
+
+    def handleTimeout(self):
+        self.timeout = None
+        self.flush()
+
+    def flush(self):
+        if self.timeout is not None:
+            ioloop.IOLoop.instance().remove_timeout(self.timeout)
+            self.timeout = None
+        if not self.instances:
+            return
+        instances = self.instances
+        self.instances = []
+        self.handler(self.topicPrefix, instances)
@@ -0,0 +1,102 @@
+#__BEGIN_LICENSE__
+# Copyright (c) 2017, United States Government, as represented by the
+# Administrator of the National Aeronautics and Space Administration.
+# All rights reserved.
+#
+# The GeoRef platform is licensed under the Apache License, Version 2.0
+# (the "License"); you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+# http://www.apache.org/licenses/LICENSE-2.0.
+#
+# Unless required by applicable law or agreed to in writing, software distributed
+# under the License is distributed on an "AS IS" BASIS, WITHOUT WARRANTIES OR
+# CONDITIONS OF ANY KIND, either express or implied. See the License for the
+# specific language governing permissions and limitations under the License.
+#__END_LICENSE__
+
+
+import unittest
+
+from geocamUtil.zmqUtil import subscriber
+from geocamUtil.zmqUtil.subscriber import ZmqSubscriber
+
+PREFIXES = ['', 'a', 'a.', 'a.b', 'a.b:', 'a.bc', 'a.b.c', 'b', 'b.a:', 'c.']
+TOPICS = ['a', 'a.b', 'a.bc', 'a.b.c', 'a.b.cd', 'ab', 'b', 'b.a', 'b.ab', 'c', 'c.d', 'd']
+
+
+class SubscriberTest(unittest.TestCase):
+    def setUp(self):
+        self.calls = []
+        self.subscriber = ZmqSubscriber('subscriberTest')
+
+    def subscribe(self, topicPrefix, name=None):
+        if name is None:
+            name = topicPrefix
+
+        def handler(topic, body):
+            self.calls.append((name, topic, body))
+        return self.subscriber.subscribeRaw(topicPrefix, handler)
+
+    def route(self, msg):
+        self.calls = []
+        self.subscriber.routeMessage(msg)
+        return sorted(self.calls)
+
+    def linearRoute(self, msg):
+        """
+        Routes @msg the way routeMessage() did before it cached handler
+        lists, by scanning every subscribed prefix.
+        """
+        self.calls = []
+        colonIndex = msg.find(':')
+        topic = msg[:(colonIndex + 1)]
+        body = msg[(colonIndex + 1):]
+        for topicPrefix, registry in self.subscriber.handlers.iteritems():
+            if topic.startswith(topicPrefix):
+                for handler, _kind in registry.itervalues():
+                    handler(topic[:-1], body)
+        return sorted(self.calls)
+
+    def test_matchesLinearScan(self):
+        for prefix in PREFIXES:
+            self.subscribe(prefix)
+        self.subscribe('a.', 'a. (second)')
+        for topic in TOPICS:
+            msg = '%s:{"x": 1}' % topic
+            expected = self.linearRoute(msg)
+            self.assertEqual(expected, self.route(msg))
+            # again from the cache
+            self.assertEqual(expected, self.route(msg))
+        self.assertEqual(len(TOPICS), len(self.subscriber.topicCache))
+
+    def test_order(self):
+        self.subscribe('a.b', 'long')
+        self.subscribe('a', 'short')
+        self.subscribe('a.b', 'long (second)')
+        self.subscriber.routeMessage('a.b:1')
+        # shorter prefixes first, then in order of subscription
+        self.assertEqual(['short', 'long', 'long (second)'],
+                         [name for name, _topic, _body in self.calls])
+
+    def test_cacheInvalidation(self):
+        self.subscribe('a.')
+        self.assertEqual([('a.', 'a.b', '1')], self.route('a.b:1'))
+        handlerId = self.subscribe('a.b')
+        self.assertEqual([('a.', 'a.b', '1'), ('a.b', 'a.b', '1')], self.route('a.b:1'))
+        self.subscriber.unsubscribe(handlerId)
+        self.assertEqual([('a.', 'a.b', '1')], self.route('a.b:1'))
+
+    def test_cacheBounded(self):
+        realMax = subscriber.MAX_TOPIC_CACHE
+        subscriber.MAX_TOPIC_CACHE = 5
+        try:
+            self.subscribe('a.')
+            for i in xrange(12):
+                self.assertEqual([('a.', 'a.%d' % i, '1')], self.route('a.%d:1' % i))
+                self.assertTrue(len(self.subscriber.topicCache) <= 5)
+        finally:
+            subscriber.MAX_TOPIC_CACHE = realMax
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,123 @@
+#__BEGIN_LICENSE__
+# Copyright (c) 2017, United States Government, as represented by the
+# Administrator of the National Aeronautics and Space Administration.
+# All rights reserved.
+#
+# The GeoRef platform is licensed under the Apache License, Version 2.0
+# (the "License"); you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+# http://www.apache.org/licenses/LICENSE-2.0.
+#
+# Unless required by applicable law or agreed to in writing, software distributed
+# under the License is distributed on an "AS IS" BASIS, WITHOUT WARRANTIES OR
+# CONDITIONS OF ANY KIND, either express or implied. See the License for the
+# specific language governing permissions and limitations under the License.
+#__END_LICENSE__
+
+import time
+import collections
+
+DEFAULT_WINDOWS_SECS = (10, 60, 300)
+
+# indices into counter entries
+COUNT = 0
+BYTES = 1
+ATTACHMENT_BYTES = 2
+MAX_SIZE = 3
+INTERVAL_MAX_SIZE = 4
+
+
+class TrafficStats(object):
+    """
+    TrafficStats keeps rolling message counters for a set of keys (for
+    example topics) over several time windows.
+
+    Example usage:
+
+    stats = TrafficStats()
+    timer = ioloop.PeriodicCallback(stats.snapshot, 1000)
+    timer.start()
+    ...
+    stats.add('foo.bar', len(msg))
+    ...
+    stats.getStats()
+
+    add() is called for every message, so it only bumps running totals.
+    snapshot() should be called about once per second; it records a
+    copy of the totals so getStats() can compute rates over each window
+    by differencing against the snapshot from the start of the window.
+    """
+
+    def __init__(self, windowsSecs=DEFAULT_WINDOWS_SECS):
+        self.windowsSecs = sorted(windowsSecs)
+        self.totals = {}
+        self.history = collections.deque(maxlen=self.windowsSecs[-1] + 2)
+        self.startTime = time.time()
+
+    def add(self, key, size, attachmentBytes=0):
+        entry = self.totals.get(key)
+        if entry is None:
+            entry = [0, 0, 0, 0, 0]
+            self.totals[key] = entry
+        entry[COUNT] += 1
+        entry[BYTES] += size
+        entry[ATTACHMENT_BYTES] += attachmentBytes
+        if size > entry[INTERVAL_MAX_SIZE]:
+            entry[INTERVAL_MAX_SIZE] = size
+            if size > entry[MAX_SIZE]:
+                entry[MAX_SIZE] = size
+
+    def snapshot(self):
+        snap = {}
+        for key, entry in self.totals.iteritems():
+            snap[key] = (entry[COUNT],
+                         entry[BYTES],
+                         entry[ATTACHMENT_BYTES],
+                         entry[INTERVAL_MAX_SIZE])
+            entry[INTERVAL_MAX_SIZE] = 0
+        self.history.append((time.time(), snap))
+
+    def getWindowStart(self, now, windowSecs):
+        """
+        Returns the index of the oldest snapshot inside the window, or
+        None if there are no snapshots yet.
+        """
+        for i, (snapTime, _snap) in enumerate(self.history):
+            if now - snapTime <= windowSecs:
+                return i
+        return None
+
+    def getStats(self):
+        now = time.time()
+        result = {}
+        for key, entry in self.totals.iteritems():
+            result[key] = {'total': {'count': entry[COUNT],
+                                     'bytes': entry[BYTES],
+                                     'attachmentBytes': entry[ATTACHMENT_BYTES],
+                                     'maxSize': entry[MAX_SIZE]}}
+
+        history = list(self.history)
+        for windowSecs in self.windowsSecs:
+            windowName = '%ds' % windowSecs
+            startIndex = self.getWindowStart(now, windowSecs)
+            if startIndex is None:
+                startTime = self.startTime
+                startSnap = {}
+                inWindow = []
+            else:
+                startTime, startSnap = history[startIndex]
+                inWindow = history[(startIndex + 1):]
+            elapsed = max(now - startTime, 1e-6)
+            for key, entry in self.totals.iteritems():
+                start = startSnap.get(key, (0, 0, 0, 0))
+                maxSize = entry[INTERVAL_MAX_SIZE]
+                for _snapTime, snap in inWindow:
+                    if key in snap:
+                        maxSize = max(maxSize, snap[key][3])
+                result[key][windowName] = {
+                    'msgsPerSec': (entry[COUNT] - start[0]) / elapsed,
+                    'bytesPerSec': (entry[BYTES] - start[1]) / elapsed,
+                    'attachmentBytesPerSec': (entry[ATTACHMENT_BYTES] - start[2]) / elapsed,
+                    'maxSize': maxSize
+                }
+        return result
@@ -0,0 +1,97 @@
+#__BEGIN_LICENSE__
+# Copyright (c) 2017, United States Government, as represented by the
+# Administrator of the National Aeronautics and Space Administration.
+# All rights reserved.
+#
+# The GeoRef platform is licensed under the Apache License, Version 2.0
+# (the "License"); you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+# http://www.apache.org/licenses/LICENSE-2.0.
+#
+# Unless required by applicable law or agreed to in writing, software distributed
+# under the License is distributed on an "AS IS" BASIS, WITHOUT WARRANTIES OR
+# CONDITIONS OF ANY KIND, either express or implied. See the License for the
+# specific language governing permissions and limitations under the License.
+#__END_LICENSE__
+
+
+import unittest
+
+from geocamUtil.zmqUtil import trafficStats
+from geocamUtil.zmqUtil.trafficStats import TrafficStats
+
+
+class FakeClock(object):
+    def __init__(self):
+        self.now = 1000.0
+
+    def time(self):
+        return self.now
+
+
+class TrafficStatsTest(unittest.TestCase):
+    def setUp(self):
+        self.clock = FakeClock()
+        self.realTime = trafficStats.time
+        trafficStats.time = self.clock
+        self.stats = TrafficStats(windowsSecs=(10, 2))
+
+    def tearDown(self):
+        trafficStats.time = self.realTime
+
+    def test_noSnapshots(self):
+        self.stats.add('a', 100, attachmentBytes=40)
+        self.stats.add('a', 50)
+        self.clock.now += 2
+        result = self.stats.getStats()['a']
+        self.assertEqual({'count': 2, 'bytes': 150, 'attachmentBytes': 40, 'maxSize': 100},
+                         result['total'])
+        # rates are measured from when the stats were created
+        self.assertEqual({'msgsPerSec': 1.0,
+                          'bytesPerSec': 75.0,
+                          'attachmentBytesPerSec': 20.0,
+                          'maxSize': 100},
+                         result['2s'])
+
+    def test_windows(self):
+        # one message per second, each smaller than the one before
+        for k in xrange(1, 7):
+            self.clock.now = 1000 + k - 0.5
+            self.stats.add('a', 100 * (7 - k))
+            self.clock.now = 1000 + k
+            self.stats.snapshot()
+        self.clock.now = 1006.5
+        result = self.stats.getStats()['a']
+        self.assertEqual({'count': 6, 'bytes': 2100, 'attachmentBytes': 0, 'maxSize': 600},
+                         result['total'])
+
+        # the 2s window starts at the snapshot at 1005, the 10s window
+        # at the first snapshot
+        self.assertAlmostEqual(1 / 1.5, result['2s']['msgsPerSec'])
+        self.assertAlmostEqual(100 / 1.5, result['2s']['bytesPerSec'])
+        self.assertEqual(100, result['2s']['maxSize'])
+        self.assertAlmostEqual(5 / 5.5, result['10s']['msgsPerSec'])
+        self.assertAlmostEqual(1500 / 5.5, result['10s']['bytesPerSec'])
+        self.assertEqual(500, result['10s']['maxSize'])
+
+    def test_newKey(self):
+        self.stats.add('a', 10)
+        self.clock.now += 1
+        self.stats.snapshot()
+        # a key first seen after the window starts counts from zero
+        self.clock.now += 0.5
+        self.stats.add('b', 30)
+        self.clock.now += 0.5
+        result = self.stats.getStats()['b']
+        self.assertEqual(1.0, result['2s']['msgsPerSec'])
+        self.assertEqual(30, result['2s']['maxSize'])
+
+    def test_historyBounded(self):
+        for _i in xrange(20):
+            self.clock.now += 1
+            self.stats.snapshot()
+        self.assertEqual(12, len(self.stats.history))
+
+
+if __name__ == '__main__':
+    unittest.main()
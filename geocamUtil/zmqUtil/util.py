@@ -16,17 +16,36 @@
 # specific language governing permissions and limitations under the License.
 #__END_LICENSE__
 
+import os
 import re
+import sys
+import mmap
+import gzip
 import time
+import itertools
 import platform
 import datetime
+import calendar
+import uuid
+import heapq
+import hashlib
+import collections
 import email.parser
 
 from zmq.eventloop import ioloop
 
+from geocamUtil import anyjson as json
+from geocamUtil.zmqUtil.logIndex import LogIndex, getIndexPath, topicMatches, COMPRESSED_SUFFIX
+
 DEFAULT_CENTRAL_RPC_PORT = 7814
 DEFAULT_CENTRAL_SUBSCRIBE_PORT = 7815
 DEFAULT_CENTRAL_PUBLISH_PORT = 7816
+DEFAULT_BRIDGE_LINK_PORT = 7817
+
+# matches a record header and the topic of its message. the last group
+# is ':' if the topic ends at a colon. if it's empty, the message has no
+# colon and its topic is the whole message (see getMessageTopic()).
+LOG_HEADER_REGEX = re.compile(r'@@@ (\d+) (\d+) (\S+) ([^:\n]*)(:?)')
 
 
 def getTimestamp(posixTime=None):
@@ -48,6 +67,25 @@ def getTimestampFields(timestampStr):
     return timestampSeconds, timestampMicroseconds
 
 
+def parseTimestampArg(timeStr):
+    """
+    Parses a command-line time argument into microseconds since the
+    epoch. Accepts either an integer microsecond timestamp as found in
+    message logs or a UTC time in the format 'YYYY-MM-DD HH:MM:SS'
+    (optionally with 'T' as the separator and fractional seconds).
+    """
+    if re.match(r'^\d+$', timeStr):
+        return int(timeStr)
+    timeStr = timeStr.replace('T', ' ')
+    for fmt in ('%Y-%m-%d %H:%M:%S.%f', '%Y-%m-%d %H:%M:%S', '%Y-%m-%d %H:%M', '%Y-%m-%d'):
+        try:
+            dt = datetime.datetime.strptime(timeStr, fmt)
+        except ValueError:
+            continue
+        return getTimestamp(calendar.timegm(dt.timetuple())) + dt.microsecond
+    raise ValueError('can\'t parse time "%s"' % timeStr)
+
+
 def getShortHostName():
     node = platform.node()
     return node.split('.', 1)[0]
@@ -83,7 +121,88 @@ def parseEndpoint(endpoint,
     raise ValueError('can\'t resolve endpoint format "%s"' % endpoint)
 
 
+WIRE_MODES = ('single', 'multipart')
+
+
+class FrameAttachment(object):
+    """
+    An attachment to a message. In multipart wire mode, each attachment
+    travels as two extra frames: a JSON header with the filename and
+    content type, then the raw data. FrameAttachment has the same
+    accessors as the email.message.Message parts that parseMessageBody()
+    returns for MIME attachments, so callers can handle both formats
+    the same way.
+    """
+    def __init__(self, filename, contentType, data):
+        self.filename = filename
+        self.contentType = contentType
+        self.data = data
+
+    def get_filename(self):
+        return self.filename
+
+    def get_content_type(self):
+        return self.contentType
+
+    def get_payload(self):
+        return self.data
+
+
+def getAttachmentFrames(attachments):
+    frames = []
+    for attachment in attachments:
+        frames.append(json.dumps({'filename': attachment.get_filename(),
+                                  'contentType': attachment.get_content_type()}))
+        frames.append(attachment.get_payload())
+    return frames
+
+
+def parseAttachmentFrames(frames):
+    attachments = []
+    for i in xrange(0, len(frames) - 1, 2):
+        header = json.loads(frames[i])
+        # keep header fields as byte strings like the rest of the message
+        filename = header.get('filename')
+        if filename is not None:
+            filename = filename.encode('utf-8')
+        contentType = header.get('contentType', 'application/octet-stream').encode('utf-8')
+        attachments.append(FrameAttachment(filename, contentType, frames[i + 1]))
+    return attachments
+
+
+def formatMimeBody(jsonBody, attachments):
+    """
+    Returns a message body in the legacy single-frame format, with
+    @jsonBody and @attachments packed into a multipart/mixed MIME
+    document. Inverse of parseMessageBody().
+    """
+    boundary = str(uuid.uuid4())
+    parts = ['Content-Type: multipart/mixed; boundary="%s"\n\n' % boundary,
+             '--%s\n' % boundary,
+             'Content-Disposition: inline\n',
+             'Content-Type: application/json; charset="utf-8"\n\n',
+             jsonBody,
+             '\n']
+    for attachment in attachments:
+        parts.extend(['--%s\n' % boundary,
+                      'Content-Disposition: attachment; filename="%s"\n' % attachment.get_filename(),
+                      'Content-Type: %s\n' % attachment.get_content_type(),
+                      'Content-Transfer-Encoding: binary\n\n',
+                      attachment.get_payload(),
+                      '\n'])
+    parts.append('--%s--\n' % boundary)
+    return ''.join(parts)
+
+
 def hasAttachments(msg):
+    """
+    @msg is either a legacy single-frame message or the list of frames
+    of a multipart message. Attachments take two frames each, so a
+    single frame after the body is a bridge header (see
+    zmqBridge), not an attachment.
+    """
+    if isinstance(msg, list):
+        return len(msg) > 3
     colonIndex = msg.find(':')
     ctype = ':Content-Type: '
     return msg[colonIndex:(colonIndex + len(ctype))] == ctype
@@ -108,12 +227,46 @@ def parseMessageBody(body):
 
 
 def parseMessage(msg):
+    """
+    @msg is either a legacy single-frame message or the list of frames
+    of a multipart message.
+    """
+    if isinstance(msg, list):
+        return {'topic': msg[0][:-1],
+                'json': msg[1],
+                'attachments': parseAttachmentFrames(msg[2:])}
     topic, body = msg.split(':', 1)
     parsed = parseMessageBody(body)
     parsed['topic'] = topic
     return parsed
 
 
+def getMessageTopic(msg):
+    """
+    Returns the topic of @msg, a legacy single-frame message or the list
+    of frames of a multipart message. The topic of a single-frame message
+    is the part before the first colon, or the whole message if it has no
+    colon.
+    """
+    if isinstance(msg, list):
+        return msg[0][:-1]
+    colonIndex = msg.find(':')
+    if colonIndex == -1:
+        return msg
+    return msg[:colonIndex]
+
+
+def getMessageSize(msg):
+    """
+    Returns the size @msg would have as a legacy single-frame message
+    without attachments. For multipart messages, only the topic and
+    body frames are counted.
+    """
+    if isinstance(msg, list):
+        return len(msg[0]) + len(msg[1])
+    return len(msg)
+
+
 def zmqLoop():
     ioloop.IOLoop.instance().start()
 
@@ -124,18 +277,67 @@ class LogRecord(object):
         self.attachmentsPath = attachmentsPath
         self.msg = msg
 
+    @property
+    def topic(self):
+        return getMessageTopic(self.msg)
+
+    def getBuffer(self):
+        return self.msg
+
     def writeTo(self, stream):
         stream.write('@@@ %d %d %s ' % (self.timestamp, len(self.msg), self.attachmentsPath))
         stream.write(self.msg)
         stream.write('\n')
 
 
+class MmapLogRecord(object):
+    """
+    A log record whose message is a slice of a memory-mapped log. The
+    message is only copied out of the map if you access the msg
+    attribute. Use getBuffer() to get a zero-copy view.
+    """
+    __slots__ = ('timestamp', 'attachmentsPath', 'topic', 'buf', 'start', 'size')
+
+    def __init__(self, timestamp, attachmentsPath, topic, buf, start, size):
+        self.timestamp = timestamp
+        self.attachmentsPath = attachmentsPath
+        self.topic = topic
+        self.buf = buf
+        self.start = start
+        self.size = size
+
+    @property
+    def msg(self):
+        return self.buf[self.start:(self.start + self.size)]
+
+    def getBuffer(self):
+        return buffer(self.buf, self.start, self.size)
+
+    def writeTo(self, stream):
+        stream.write('@@@ %d %d %s ' % (self.timestamp, self.size, self.attachmentsPath))
+        stream.write(self.getBuffer())
+        stream.write('\n')
+
+
 class LogParser(object):
-    def __init__(self, logFile):
+    """
+    Reads records from a message log stream line by line. Messages
+    that contain newlines are reassembled using the message length
+    recorded in the header. If the log is a regular file, MmapLogParser
+    is faster. Every pass over the log starts from the beginning, so a
+    log that isn't seekable, such as stdin, can only be read once.
+    """
+    def __init__(self, logFile, index=None, logPath=None):
         self.logFile = logFile
+        self.index = index
+        self.logPath = logPath
+        self.started = False
 
-    def __iter__(self):
-        for lineNum, line in enumerate(self.logFile):
+    def close(self):
+        self.logFile.close()
+
+    def parseLines(self, lines):
+        for lineNum, line in lines:
             try:
                 sentinel, timestampStr, msgSizeStr, attachmentsPath, msg = line.split(' ', 4)
                 timestamp = int(timestampStr)
@@ -144,18 +346,228 @@ class LogParser(object):
                 print 'warning: bad log line parse in line %d' % (lineNum + 1)
                 print line
                 continue
-            msg = msg[:-1]  # chop newline
             if sentinel != '@@@':
                 print 'warning: bad sentinel in line %d' % (lineNum + 1)
                 print line
                 continue
+            while len(msg) <= msgSize:
+                # message contains newlines, read the rest of it
+                try:
+                    _lineNum, line = next(lines)
+                except StopIteration:
+                    break
+                msg += line
+            msg = msg[:-1]  # chop newline
             if len(msg) != msgSize:
                 print 'warning: bad message length %d != %d in line %d' % (len(msg), msgSize, lineNum + 1)
-                print line
-                continue
-            if attachmentsPath != '-':
-                print 'warning: zmqPlayback can not handle attachments in line %d' % (lineNum + 1)
-                print line
+                print msg
                 continue
 
             yield LogRecord(timestamp, attachmentsPath, msg)
+
+    def __iter__(self):
+        return self.iterRange(0, None)
+
+    def readLines(self, begin, end):
+        try:
+            self.logFile.seek(begin)
+        except IOError:
+            # not seekable, we can only read it once from the start
+            if begin != 0 or self.started:
+                raise ValueError('message log %s is not seekable and can only be read once, from the start'
+                                 % self.logPath)
+        self.started = True
+        offset = begin
+        lineNum = 0
+        while end is None or offset < end:
+            line = self.logFile.readline()
+            if not line:
+                break
+            offset += len(line)
+            yield lineNum, line
+            lineNum += 1
+
+    def iterRange(self, begin, end):
+        """
+        Yields the records between byte offsets @begin and @end of the
+        log. If @end is None, reads to the end of the log.
+        """
+        return self.parseLines(self.readLines(begin, end))
+
+    def select(self, startTime=None, endTime=None, topicPrefixes=None):
+        """
+        Yields the records with timestamps in the range [@startTime,
+        @endTime] whose topics match one of @topicPrefixes. Any of the
+        arguments may be None to skip that test. If the parser has an
+        index, only the parts of the log the index says may hold
+        matching records are read.
+        """
+        if topicPrefixes:
+            topicPrefixes = tuple(topicPrefixes)
+        if self.index is not None:
+            ranges = self.index.getRanges(startTime, endTime, topicPrefixes)
+            records = itertools.chain(*[self.iterRange(begin, end)
+                                        for begin, end in ranges])
+        else:
+            records = iter(self)
+        for rec in records:
+            if startTime is not None and rec.timestamp < startTime:
+                continue
+            if endTime is not None and rec.timestamp > endTime:
+                continue
+            if topicPrefixes and not topicMatches(rec.topic, topicPrefixes):
+                continue
+            yield rec
+
+
+class MmapLogParser(LogParser):
+    """
+    Reads records from a message log file by memory-mapping it. Each
+    record is framed using the message length recorded in its header,
+    so messages are never split or copied while parsing.
+    """
+    def __init__(self, logFile, index=None, logPath=None):
+        super(MmapLogParser, self).__init__(logFile, index, logPath)
+        if os.fstat(logFile.fileno()).st_size:
+            self.buf = mmap.mmap(logFile.fileno(), 0, access=mmap.ACCESS_READ)
+        else:
+            # can't map an empty file
+            self.buf = ''
+
+    def close(self):
+        if isinstance(self.buf, mmap.mmap):
+            self.buf.close()
+        super(MmapLogParser, self).close()
+
+    def resync(self, pos):
+        nextRecord = self.buf.find('\n@@@ ', pos)
+        if nextRecord == -1:
+            return len(self.buf)
+        return nextRecord + 1
+
+    def iterRange(self, begin, end):
+        buf = self.buf
+        bufSize = len(buf)
+        if end is None or end > bufSize:
+            end = bufSize
+        matchHeader = LOG_HEADER_REGEX.match
+        pos = begin
+        while pos < end:
+            m = matchHeader(buf, pos)
+            if m is None:
+                print 'warning: bad log header parse at offset %d' % pos
+                pos = self.resync(pos + 1)
+                continue
+            timestampStr, msgSizeStr, attachmentsPath, topic, colon = m.groups()
+            msgStart = m.start(4)
+            msgSize = int(msgSizeStr)
+            msgEnd = msgStart + msgSize
+            if buf[msgEnd:(msgEnd + 1)] != '\n':
+                print 'warning: bad message length %d at offset %d' % (msgSize, pos)
+                pos = self.resync(pos + 1)
+                continue
+            if not colon and m.end(4) != msgEnd:
+                # message has no colon but contains a newline, the topic
+                # is the whole message
+                topic = buf[msgStart:msgEnd]
+
+            yield MmapLogRecord(int(timestampStr), attachmentsPath, topic, buf, msgStart, msgSize)
+            pos = msgEnd + 1
+
+    def __iter__(self):
+        return self.iterRange(0, None)
+
+
+def openLogParser(logPath):
+    """
+    Returns a LogParser for the message log at @logPath, using the
+    sidecar index if there is one. Reads gzip-compressed log segments
+    transparently. Use '-' to read from stdin.
+    """
+    if logPath == '-':
+        return LogParser(sys.stdin, logPath=logPath)
+    index = LogIndex.load(getIndexPath(logPath))
+    if logPath.endswith(COMPRESSED_SUFFIX):
+        return LogParser(gzip.open(logPath, 'rb'), index=index, logPath=logPath)
+    return MmapLogParser(open(logPath, 'rb'), index=index, logPath=logPath)
+
+
+class MergedLogParser(object):
+    """
+    Merges the records of several message logs into one stream in
+    timestamp order, for example the logs of a bus recorded by more
+    than one central, or the segments of a rotated log. Each log is
+    read lazily and only one pending record per log is held in memory,
+    so memory use depends on the number of logs and not their size.
+    Records within each log are assumed to be in timestamp order, as
+    zmqCentral writes them.
+
+    If @dedupeWindowUsecs is set, a record is dropped if a record with
+    the same message and attachments came from a different log less
+    than that many microseconds earlier. Only the records inside the
+    window are remembered.
+    """
+    def __init__(self, parsers, dedupeWindowUsecs=None):
+        self.parsers = parsers
+        self.dedupeWindowUsecs = dedupeWindowUsecs
+        # the parser of the record most recently returned
+        self.currentParser = None
+        self.numDuplicates = 0
+
+    def close(self):
+        for parser in self.parsers:
+            parser.close()
+
+    def __iter__(self):
+        return self.select()
+
+    def select(self, startTime=None, endTime=None, topicPrefixes=None):
+        """
+        Same as LogParser.select(), applied to all of the logs.
+        """
+        heap = []
+        for i, parser in enumerate(self.parsers):
+            records = parser.select(startTime, endTime, topicPrefixes)
+            rec = next(records, None)
+            if rec is not None:
+                heap.append((rec.timestamp, i, rec, records))
+        heapq.heapify(heap)
+
+        window = self.dedupeWindowUsecs
+        seen = {}  # digest -> (timestamp, parser index)
+        recent = collections.deque()  # (timestamp, digest) in arrival order
+        while heap:
+            timestamp, i, rec, records = heap[0]
+            nextRec = next(records, None)
+            if nextRec is None:
+                heapq.heappop(heap)
+            else:
+                heapq.heapreplace(heap, (nextRec.timestamp, i, nextRec, records))
+
+            if window:
+                while recent and recent[0][0] < timestamp - window:
+                    oldTimestamp, oldDigest = recent.popleft()
+                    entry = seen.get(oldDigest)
+                    if entry is not None and entry[0] == oldTimestamp:
+                        del seen[oldDigest]
+                digest = hashlib.md5(rec.getBuffer()).digest() + rec.attachmentsPath
+                prev = seen.get(digest)
+                if prev is not None and prev[1] != i:
+                    self.numDuplicates += 1
+                    continue
+                seen[digest] = (timestamp, i)
+                recent.append((timestamp, digest))
+
+            self.currentParser = self.parsers[i]
+            yield rec
+
+
+def openLogParsers(logPaths, dedupeWindowUsecs=None):
+    """
+    Returns a parser that reads the message logs at @logPaths merged in
+    timestamp order. See MergedLogParser.
+    """
+    if len(logPaths) == 1 and not dedupeWindowUsecs:
+        return openLogParser(logPaths[0])
+    return MergedLogParser([openLogParser(logPath) for logPath in logPaths],
+                           dedupeWindowUsecs)
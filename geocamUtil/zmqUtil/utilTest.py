@@ -0,0 +1,259 @@
+#__BEGIN_LICENSE__
+# Copyright (c) 2017, United States Government, as represented by the
+# Administrator of the National Aeronautics and Space Administration.
+# All rights reserved.
+#
+# The GeoRef platform is licensed under the Apache License, Version 2.0
+# (the "License"); you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+# http://www.apache.org/licenses/LICENSE-2.0.
+#
+# Unless required by applicable law or agreed to in writing, software distributed
+# under the License is distributed on an "AS IS" BASIS, WITHOUT WARRANTIES OR
+# CONDITIONS OF ANY KIND, either express or implied. See the License for the
+# specific language governing permissions and limitations under the License.
+#__END_LICENSE__
+
+import os
+import sys
+import gzip
+import shutil
+import tempfile
+import unittest
+from cStringIO import StringIO
+
+from geocamUtil.zmqUtil.util import (openLogParser,
+                                     openLogParsers,
+                                     LogParser,
+                                     MmapLogParser,
+                                     MergedLogParser,
+                                     FrameAttachment,
+                                     getAttachmentFrames,
+                                     parseAttachmentFrames,
+                                     formatMimeBody,
+                                     parseMessageBody,
+                                     parseMessage,
+                                     hasAttachments,
+                                     getMessageSize,
+                                     getMessageTopic)
+
+ATTACHMENTS = [FrameAttachment('a.txt', 'text/plain', 'hello\nworld\n'),
+               FrameAttachment('b.bin', 'application/octet-stream', '\x00\x01--x\n')]
+
+
+def formatRecord(timestamp, msg, attachmentsPath='-'):
+    return '@@@ %d %d %s %s\n' % (timestamp, len(msg), attachmentsPath, msg)
+
+
+class LogTestCase(unittest.TestCase):
+    def setUp(self):
+        self.tmpDir = tempfile.mkdtemp(prefix='utilTest')
+        self.records = [(1000 + i, 'topic%d:{"i": %d}' % (i % 3, i))
+                        for i in xrange(100)]
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpDir)
+
+    def writeLog(self, name, records, compress=False):
+        """
+        Writes @records, a list of (timestamp, msg) pairs or strings of
+        raw log text, to a log in the temp dir and returns its path.
+        """
+        path = os.path.join(self.tmpDir, name)
+        if compress:
+            out = gzip.open(path, 'wb')
+        else:
+            out = open(path, 'wb')
+        for record in records:
+            if isinstance(record, tuple):
+                record = formatRecord(*record)
+            out.write(record)
+        out.close()
+        return path
+
+
+class LogParserTest(LogTestCase):
+    def test_selectTwiceCompressed(self):
+        parser = openLogParser(self.writeLog('log.txt.gz', self.records, compress=True))
+        self.assertEqual(None, parser.index)
+        expected = [msg for _timestamp, msg in self.records]
+        self.assertEqual(expected, [rec.msg for rec in parser.select()])
+        # a second pass starts over from the beginning
+        self.assertEqual(expected, [rec.msg for rec in parser.select()])
+        self.assertEqual(expected[50:], [rec.msg for rec in parser.select(1050)])
+        parser.close()
+
+    def test_notSeekable(self):
+        readFd, writeFd = os.pipe()
+        os.write(writeFd, ''.join([formatRecord(timestamp, msg) for timestamp, msg in self.records[:5]]))
+        os.close(writeFd)
+        parser = LogParser(os.fdopen(readFd, 'rb'), logPath='-')
+        self.assertEqual(5, len(list(parser.select())))
+        self.assertRaises(ValueError, list, parser.select())
+        parser.close()
+
+
+class MmapLogParserTest(LogTestCase):
+    def setUp(self):
+        super(MmapLogParserTest, self).setUp()
+        # the parser prints warnings about corrupt records
+        self.stdout = sys.stdout
+        sys.stdout = StringIO()
+
+    def tearDown(self):
+        sys.stdout = self.stdout
+        super(MmapLogParserTest, self).tearDown()
+
+    def parse(self, records):
+        parser = openLogParser(self.writeLog('log.txt', records))
+        self.assertTrue(isinstance(parser, MmapLogParser))
+        result = [(rec.timestamp, rec.attachmentsPath, rec.topic, rec.msg)
+                  for rec in parser]
+        parser.close()
+        return result
+
+    def test_framing(self):
+        records = self.records + [(2000, 'topic:{"a": "@@@ 1 2 - x:y"}'),
+                                  (2001, 'topic:')]
+        self.assertEqual([(timestamp, '-', 'topic%d' % (i % 3), msg)
+                          for i, (timestamp, msg) in enumerate(self.records)]
+                         + [(2000, '-', 'topic', 'topic:{"a": "@@@ 1 2 - x:y"}'),
+                            (2001, '-', 'topic', 'topic:')],
+                         self.parse(records))
+
+    def test_multiline(self):
+        records = [(1000, 'topic:line 1\n@@@ 1001 5 - fake\nline 3'),
+                   (1001, 'no colon\nsecond line: not a topic'),
+                   (1002, 'no colon'),
+                   formatRecord(1003, 'topic:{}', attachmentsPath='attach/1003')]
+        self.assertEqual([(1000, '-', 'topic', 'topic:line 1\n@@@ 1001 5 - fake\nline 3'),
+                          (1001, '-', 'no colon\nsecond line: not a topic',
+                           'no colon\nsecond line: not a topic'),
+                          (1002, '-', 'no colon', 'no colon'),
+                          (1003, 'attach/1003', 'topic', 'topic:{}')],
+                         self.parse(records))
+
+    def test_resync(self):
+        records = [(1000, 'topic:0'),
+                   '@@@ garbage\n',
+                   (1001, 'topic:1'),
+                   # length runs past the end of the message
+                   '@@@ 1002 50 - topic:2\n',
+                   (1003, 'topic:3'),
+                   # length stops short of the end of the message
+                   '@@@ 1004 3 - topic:4\n',
+                   (1005, 'topic:5')]
+        self.assertEqual(['topic:0', 'topic:1', 'topic:3', 'topic:5'],
+                         [msg for _timestamp, _path, _topic, msg in self.parse(records)])
+        self.assertEqual(3, sys.stdout.getvalue().count('warning'))
+
+    def test_empty(self):
+        self.assertEqual([], self.parse([]))
+
+
+class MergedLogParserTest(LogTestCase):
+    def openMerged(self, logs, dedupeWindowUsecs=None):
+        paths = [self.writeLog('log%d.txt' % i, records)
+                 for i, records in enumerate(logs)]
+        return openLogParsers(paths, dedupeWindowUsecs)
+
+    def test_merge(self):
+        parser = self.openMerged([self.records[0::2], self.records[1::2]])
+        self.assertTrue(isinstance(parser, MergedLogParser))
+        self.assertEqual(self.records, [(rec.timestamp, rec.msg) for rec in parser])
+        self.assertEqual([rec.msg for rec in parser.select(1010, 1019, ['topic1:'])],
+                         [msg for timestamp, msg in self.records[10:20] if msg.startswith('topic1:')])
+        parser.close()
+
+    def test_currentParser(self):
+        parser = self.openMerged([[(1000, 'a:0'), (1002, 'a:2')], [(1001, 'b:1')]])
+        logNames = []
+        for _rec in parser:
+            logNames.append(os.path.basename(parser.currentParser.logPath))
+        self.assertEqual(['log0.txt', 'log1.txt', 'log0.txt'], logNames)
+        parser.close()
+
+    def test_dedupe(self):
+        parser = self.openMerged([[(1000, 'x:1'), (1000, 'x:1'), (1020, 'y:1'), (1100, 'z:1')],
+                                  [(1005, 'x:1'), (1015, 'x:1'), (1040, 'y:1'), (1100, 'z:2')]],
+                                 dedupeWindowUsecs=30)
+        # copies from the other log within 30 usecs are dropped,
+        # repeats within the same log are not
+        self.assertEqual([(1000, 'x:1'), (1000, 'x:1'), (1020, 'y:1'), (1100, 'z:1'), (1100, 'z:2')],
+                         [(rec.timestamp, rec.msg) for rec in parser])
+        self.assertEqual(3, parser.numDuplicates)
+        parser.close()
+
+    def test_dedupeWindowExpires(self):
+        parser = self.openMerged([[(1000, 'x:1'), (1050, 'y:1')],
+                                  [(1031, 'x:1'), (1060, 'y:1')]],
+                                 dedupeWindowUsecs=30)
+        # the first x:1 has left the window by the time the second
+        # arrives, and the second y:1 is compared against the first
+        self.assertEqual([(1000, 'x:1'), (1031, 'x:1'), (1050, 'y:1')],
+                         [(rec.timestamp, rec.msg) for rec in parser])
+        parser.close()
+
+    def test_dedupeAttachments(self):
+        paths = [self.writeLog('log0.txt', [formatRecord(1000, 'x:1', 'attach/a')]),
+                 self.writeLog('log1.txt', [formatRecord(1001, 'x:1', 'attach/b'),
+                                            formatRecord(1002, 'x:1', 'attach/a')])]
+        parser = openLogParsers(paths, dedupeWindowUsecs=30)
+        self.assertEqual(['attach/a', 'attach/b'], [rec.attachmentsPath for rec in parser])
+        parser.close()
+
+    def test_singleLog(self):
+        path = self.writeLog('log0.txt', self.records)
+        for dedupeWindowUsecs, parserClass in ((None, MmapLogParser), (1000, MergedLogParser)):
+            parser = openLogParsers([path], dedupeWindowUsecs)
+            self.assertTrue(isinstance(parser, parserClass))
+            parser.close()
+
+
+class MultipartTest(unittest.TestCase):
+    def getFields(self, attachments):
+        return [(a.get_filename(), a.get_content_type(), a.get_payload())
+                for a in attachments]
+
+    def test_attachmentFrames(self):
+        frames = getAttachmentFrames(ATTACHMENTS)
+        self.assertEqual(4, len(frames))
+        self.assertEqual(self.getFields(ATTACHMENTS),
+                         self.getFields(parseAttachmentFrames(frames)))
+        # the header fields are optional
+        self.assertEqual([(None, 'application/octet-stream', 'data')],
+                         self.getFields(parseAttachmentFrames(['{}', 'data'])))
+
+    def test_mimeBody(self):
+        parsed = parseMessageBody(formatMimeBody('{"x": 1}', ATTACHMENTS))
+        self.assertEqual('{"x": 1}', parsed['json'])
+        self.assertEqual(self.getFields(ATTACHMENTS), self.getFields(parsed['attachments']))
+        self.assertEqual({'json': '{"x": 1}', 'attachments': []}, parseMessageBody('{"x": 1}'))
+
+    def test_parseMessage(self):
+        frames = ['topic:', '{"x": 1}'] + getAttachmentFrames(ATTACHMENTS)
+        legacy = 'topic:' + formatMimeBody('{"x": 1}', ATTACHMENTS)
+        for msg in (frames, legacy):
+            parsed = parseMessage(msg)
+            self.assertEqual('topic', parsed['topic'])
+            self.assertEqual('{"x": 1}', parsed['json'])
+            self.assertEqual(self.getFields(ATTACHMENTS), self.getFields(parsed['attachments']))
+            self.assertTrue(hasAttachments(msg))
+
+        self.assertFalse(hasAttachments(['topic:', '{"x": 1}']))
+        self.assertFalse(hasAttachments('topic:{"x": 1}'))
+        self.assertFalse(hasAttachments('topic:Content-Type is not a header'))
+
+    def test_sizeAndTopic(self):
+        frames = ['topic:', '{"x": 1}'] + getAttachmentFrames(ATTACHMENTS)
+        # attachment frames don't count, so multipart and legacy
+        # messages without attachments are logged the same way
+        self.assertEqual(len('topic:{"x": 1}'), getMessageSize(frames))
+        self.assertEqual(len('topic:{"x": 1}'), getMessageSize('topic:{"x": 1}'))
+        self.assertEqual('topic', getMessageTopic(frames))
+        self.assertEqual('topic', getMessageTopic('topic:{"x": 1}'))
+        self.assertEqual('no colon', getMessageTopic('no colon'))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,311 @@
+#!/usr/bin/env python
+#__BEGIN_LICENSE__
+# Copyright (c) 2017, United States Government, as represented by the
+# Administrator of the National Aeronautics and Space Administration.
+# All rights reserved.
+#
+# The GeoRef platform is licensed under the Apache License, Version 2.0
+# (the "License"); you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+# http://www.apache.org/licenses/LICENSE-2.0.
+#
+# Unless required by applicable law or agreed to in writing, software distributed
+# under the License is distributed on an "AS IS" BASIS, WITHOUT WARRANTIES OR
+# CONDITIONS OF ANY KIND, either express or implied. See the License for the
+# specific language governing permissions and limitations under the License.
+#__END_LICENSE__
+
+"""
+zmqBridge forwards a subset of topics between the zmqCentral instances
+of different hosts.
+
+Run one bridge next to each central. A bridge subscribes to its local
+central and exports allowed topics on its link endpoint. It connects to
+the link endpoints of its peer bridges and publishes the messages they
+export to its local central. Link messages have three frames:
+
+  ['topic:', header, body]
+
+where the header is a JSON object with the list of bridge ids the
+message has passed through ('path') and a flag saying whether the body
+is zlib-compressed ('z').
+
+A bridge publishes imported messages to its local central with a
+header holding their path as an extra frame after the body:
+
+  ['topic:', body, header]
+
+Subscribers ignore the header (see ZmqSubscriber.subscribeBridge()), but
+it lets the bridge recognize its imports when central echoes them back,
+even when a local module publishes an identical message. By default a
+bridge doesn't export its imports again, so a message crosses each link
+at most once. To pass messages on across more than one hop, for example
+along a chain of bridges, run the bridges in the middle with --relay. A
+relayed message keeps its path, and a bridge drops any message whose
+path already contains its own id, so messages can't loop forever in a ring.
+"""
+
+# pylint: disable=E1101
+
+import time
+import zlib
+import logging
+
+import zmq
+from zmq.eventloop.zmqstream import ZMQStream
+from zmq.eventloop import ioloop
+ioloop.install()
+
+from geocamUtil import anyjson as json
+from geocamUtil.zmqUtil.util import (zmqLoop,
+                                     parseEndpoint,
+                                     getShortHostName,
+                                     DEFAULT_BRIDGE_LINK_PORT)
+from geocamUtil.zmqUtil.subscriber import ZmqSubscriber
+from geocamUtil.zmqUtil.publisher import ZmqPublisher
+
+THIS_MODULE = 'zmqBridge'
+DEFAULT_DENY = ('central.',)
+
+
+class TokenBucket(object):
+    """
+    Rate limiter that allows an average of @rate units per second with
+    bursts of up to @burst units. A rate of 0 means no limit.
+    """
+
+    def __init__(self, rate, burst=None):
+        self.rate = rate
+        if burst is None:
+            burst = rate
+        self.burst = burst
+        self.tokens = burst
+        self.lastTime = time.time()
+
+    def consume(self, amount):
+        if not self.rate:
+            return True
+        now = time.time()
+        self.tokens = min(self.burst, self.tokens + (now - self.lastTime) * self.rate)
+        self.lastTime = now
+        if self.tokens < amount:
+            return False
+        self.tokens -= amount
+        return True
+
+
+def getCoveringPrefixes(prefixes):
+    """
+    Returns @prefixes without the entries that are already covered by a
+    shorter prefix in the list, so that no message matches twice.
+    """
+    result = []
+    for prefix in sorted(set(prefixes)):
+        if not (result and prefix.startswith(result[-1])):
+            result.append(prefix)
+    return result
+
+
+class ZmqBridge(object):
+    def __init__(self, bridgeId, subscriber, publisher,
+                 linkEndpoint,
+                 peers=None,
+                 allow=None,
+                 deny=DEFAULT_DENY,
+                 compressLevel=0,
+                 compressMinBytes=256,
+                 maxBytesPerSec=0,
+                 burstBytes=None,
+                 relay=False,
+                 context=None):
+        self.bridgeId = bridgeId
+        self.subscriber = subscriber
+        self.publisher = publisher
+        self.linkEndpoint = linkEndpoint
+        if peers is None:
+            peers = []
+        self.peers = peers
+        if not allow:
+            allow = ['']
+        self.allow = getCoveringPrefixes(allow)
+        self.deny = tuple(deny)
+        self.compressLevel = compressLevel
+        self.compressMinBytes = compressMinBytes
+        self.bucket = TokenBucket(maxBytesPerSec, burstBytes)
+        self.relay = relay
+
+        if context is None:
+            context = zmq.Context.instance()
+        self.context = context
+
+        self.exportStream = None
+        self.importStream = None
+        self.statsTimer = None
+
+        self.stats = {'exported': 0,
+                      'exportedBytes': 0,
+                      'rateDropped': 0,
+                      'imported': 0,
+                      'importedBytes': 0,
+                      'loopDropped': 0,
+                      'notRelayed': 0,
+                      'denied': 0,
+                      'badMessages': 0}
+
+    def isDenied(self, topic):
+        return (topic + ':').startswith(self.deny)
+
+    def handleLocalMessage(self, topic, body, bridgeHeader):
+        if self.isDenied(topic):
+            self.stats['denied'] += 1
+            return
+        path = []
+        if bridgeHeader is not None:
+            if not self.relay:
+                # imported from a peer, don't send it back over the link
+                self.stats['notRelayed'] += 1
+                return
+            try:
+                path = [str(bridgeId) for bridgeId in json.loads(bridgeHeader)['path']]
+            except:  # pylint: disable=W0702
+                logging.warning('zmqBridge: could not parse bridge header on %s', topic)
+                self.stats['badMessages'] += 1
+                return
+        if self.bridgeId in path:
+            # came from the link and would go straight back out
+            self.stats['loopDropped'] += 1
+            return
+
+        header = {'path': path + [self.bridgeId]}
+        if self.compressLevel and len(body) >= self.compressMinBytes:
+            compressed = zlib.compress(body, self.compressLevel)
+            if len(compressed) < len(body):
+                body = compressed
+                header['z'] = 1
+        frames = [topic + ':', json.dumps(header), body]
+        size = len(frames[0]) + len(frames[1]) + len(body)
+        if not self.bucket.consume(size):
+            self.stats['rateDropped'] += 1
+            return
+        self.exportStream.send_multipart(frames)
+        self.stats['exported'] += 1
+        self.stats['exportedBytes'] += size
+
+    def handleLinkMessage(self, frames):
+        try:
+            topicFrame, headerText, body = frames
+            header = json.loads(headerText)
+            path = [str(bridgeId) for bridgeId in header['path']]
+            if header.get('z'):
+                body = zlib.decompress(body)
+        except:  # pylint: disable=W0702
+            logging.warning('zmqBridge: could not parse link message %s', repr(frames[0][:80]))
+            self.stats['badMessages'] += 1
+            return
+
+        topic = topicFrame[:-1]
+        if self.bridgeId in path:
+            self.stats['loopDropped'] += 1
+            return
+        if self.isDenied(topic):
+            self.stats['denied'] += 1
+            return
+        self.publisher.sendFrames([topicFrame, body, json.dumps({'path': path})], topic)
+        self.stats['imported'] += 1
+        self.stats['importedBytes'] += len(body)
+
+    def logStats(self):
+        logging.info('zmqBridge: %s', json.dumps(self.stats, sort_keys=True))
+
+    def start(self):
+        self.exportStream = ZMQStream(self.context.socket(zmq.PUB))
+        self.exportStream.bind(self.linkEndpoint)
+        logging.info('zmqBridge: exporting on %s', self.linkEndpoint)
+
+        self.importStream = ZMQStream(self.context.socket(zmq.SUB))
+        for prefix in self.allow:
+            self.importStream.setsockopt(zmq.SUBSCRIBE, prefix)
+        for peer in self.peers:
+            self.connectPeer(peer)
+        self.importStream.on_recv(self.handleLinkMessage)
+
+        for prefix in self.allow:
+            self.subscriber.subscribeBridge(prefix, self.handleLocalMessage)
+
+        self.statsTimer = ioloop.PeriodicCallback(self.logStats, 60000)
+        self.statsTimer.start()
+
+    def connectPeer(self, peer):
+        self.importStream.connect(peer)
+        logging.info('zmqBridge: importing from %s', peer)
+
+    def stop(self):
+        self.statsTimer.stop()
+        self.importStream.close()
+        self.exportStream.close()
+
+
+def main():
+    import optparse
+    parser = optparse.OptionParser('usage: %prog')
+    parser.add_option('--bridgeId',
+                      default=getShortHostName(),
+                      help='Unique id of this bridge, used to prevent message loops [%default]')
+    parser.add_option('-l', '--linkEndpoint',
+                      default='tcp://*:%d' % DEFAULT_BRIDGE_LINK_PORT,
+                      help='Endpoint to export messages to peer bridges on [%default]')
+    parser.add_option('--peer',
+                      default=[], action='append',
+                      help='Link endpoint of a peer bridge to import messages from (can specify multiple times)')
+    parser.add_option('-a', '--allow',
+                      default=[], action='append',
+                      help='Topic prefix to forward in both directions (can specify multiple times) [all topics]')
+    parser.add_option('-x', '--deny',
+                      default=[], action='append',
+                      help='Topic prefix never to forward, overriding --allow (can specify multiple times). Always includes %s' % ', '.join(DEFAULT_DENY))
+    parser.add_option('--relay',
+                      action='store_true', default=False,
+                      help='Also export messages imported from peers, to forward them across multiple hops')
+    parser.add_option('-z', '--compressLevel',
+                      default=0, type='int',
+                      help='zlib level for compressing exported message bodies, or 0 for no compression [%default]')
+    parser.add_option('--compressMinBytes',
+                      default=256, type='int',
+                      help='Only compress message bodies at least this large [%default]')
+    parser.add_option('--maxBytesPerSec',
+                      default=0, type='int',
+                      help='Drop exported messages above this average rate, or 0 for no limit [%default]')
+    parser.add_option('--burstBytes',
+                      type='int',
+                      help='Max burst size for --maxBytesPerSec [one second of traffic]')
+    ZmqSubscriber.addOptions(parser, THIS_MODULE)
+    ZmqPublisher.addOptions(parser, THIS_MODULE)
+    opts, args = parser.parse_args()
+    if args:
+        parser.error('expected no args')
+    logging.basicConfig(level=logging.DEBUG)
+
+    subscriber = ZmqSubscriber(**ZmqSubscriber.getOptionValues(opts))
+    subscriber.start()
+    publisher = ZmqPublisher(**ZmqPublisher.getOptionValues(opts))
+    publisher.start()
+
+    deny = DEFAULT_DENY + tuple(opts.deny)
+    peers = [parseEndpoint(peer, defaultPort=DEFAULT_BRIDGE_LINK_PORT)
+             for peer in opts.peer]
+    bridge = ZmqBridge(opts.bridgeId, subscriber, publisher,
+                       linkEndpoint=opts.linkEndpoint,
+                       peers=peers,
+                       allow=opts.allow,
+                       deny=deny,
+                       compressLevel=opts.compressLevel,
+                       compressMinBytes=opts.compressMinBytes,
+                       maxBytesPerSec=opts.maxBytesPerSec,
+                       burstBytes=opts.burstBytes,
+                       relay=opts.relay)
+    bridge.start()
+    zmqLoop()
+
+
+if __name__ == '__main__':
+    main()
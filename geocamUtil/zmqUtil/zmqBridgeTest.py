@@ -0,0 +1,139 @@
+#__BEGIN_LICENSE__
+# Copyright (c) 2017, United States Government, as represented by the
+# Administrator of the National Aeronautics and Space Administration.
+# All rights reserved.
+#
+# The GeoRef platform is licensed under the Apache License, Version 2.0
+# (the "License"); you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+# http://www.apache.org/licenses/LICENSE-2.0.
+#
+# Unless required by applicable law or agreed to in writing, software distributed
+# under the License is distributed on an "AS IS" BASIS, WITHOUT WARRANTIES OR
+# CONDITIONS OF ANY KIND, either express or implied. See the License for the
+# specific language governing permissions and limitations under the License.
+#__END_LICENSE__
+
+import time
+import unittest
+
+import zmq
+from zmq.eventloop import ioloop
+
+from geocamUtil import anyjson as json
+from geocamUtil.zmqUtil.util import hasAttachments
+from geocamUtil.zmqUtil.subscriber import ZmqSubscriber
+from geocamUtil.zmqUtil.zmqBridge import ZmqBridge
+
+TEST_TIMEOUT_SECS = 5
+
+
+class LocalCentral(object):
+    """
+    Stands in for the subscriber and publisher a bridge uses to talk to
+    its local central. Published messages are echoed back to the
+    subscribers, the way central would.
+    """
+    def __init__(self):
+        self.handlers = []
+        self.published = []
+
+    def subscribeBridge(self, topicPrefix, handler):
+        self.handlers.append((topicPrefix, handler))
+
+    def sendFrames(self, frames, topic):
+        topicFrame, body, bridgeHeader = frames
+        self.published.append((topic, body))
+        ioloop.IOLoop.instance().add_callback(self.deliver, topic, body, bridgeHeader)
+
+    def deliver(self, topic, body, bridgeHeader=None):
+        for topicPrefix, handler in self.handlers:
+            if (topic + ':').startswith(topicPrefix):
+                handler(topic, body, bridgeHeader)
+
+
+class ZmqBridgeTest(unittest.TestCase):
+    def setUp(self):
+        self.centralA = LocalCentral()
+        self.centralB = LocalCentral()
+        self.bridgeA = ZmqBridge('a', self.centralA, self.centralA,
+                                 linkEndpoint='tcp://127.0.0.1:*')
+        self.bridgeB = ZmqBridge('b', self.centralB, self.centralB,
+                                 linkEndpoint='tcp://127.0.0.1:*')
+        self.bridgeA.start()
+        self.bridgeB.start()
+        self.bridgeA.connectPeer(self.getLinkEndpoint(self.bridgeB))
+        self.bridgeB.connectPeer(self.getLinkEndpoint(self.bridgeA))
+
+    def tearDown(self):
+        self.bridgeA.stop()
+        self.bridgeB.stop()
+
+    def getLinkEndpoint(self, bridge):
+        return bridge.exportStream.getsockopt(zmq.LAST_ENDPOINT)
+
+    def runUntil(self, done):
+        loop = ioloop.IOLoop.instance()
+        deadline = time.time() + TEST_TIMEOUT_SECS
+
+        def check():
+            if done() or time.time() > deadline:
+                # give any echo a chance to go back over the link
+                loop.add_timeout(time.time() + 0.3, loop.stop)
+            else:
+                loop.add_timeout(time.time() + 0.05, check)
+        loop.add_callback(check)
+        loop.start()
+
+    def publishUntil(self, central, bridge, stat):
+        def publish():
+            # repeat until the link is up, since PUB drops messages
+            # sent before the peer connects
+            if not bridge.stats[stat]:
+                central.deliver('vehicle.pose', '{"x": 1}')
+                ioloop.IOLoop.instance().add_timeout(time.time() + 0.05, publish)
+        ioloop.IOLoop.instance().add_callback(publish)
+        self.runUntil(lambda: bridge.stats[stat])
+
+    def test_importedNotExported(self):
+        self.publishUntil(self.centralA, self.bridgeB, 'imported')
+
+        self.assertTrue(self.bridgeB.stats['imported'] > 0)
+        self.assertEqual(('vehicle.pose', '{"x": 1}'), self.centralB.published[0])
+        self.assertEqual(0, self.bridgeB.stats['exported'])
+        self.assertEqual(self.bridgeB.stats['imported'], self.bridgeB.stats['notRelayed'])
+        self.assertEqual(0, self.bridgeA.stats['loopDropped'])
+        self.assertEqual(0, self.bridgeA.stats['imported'])
+
+    def test_identicalLocalExported(self):
+        # b imports a message, then a local module publishes the same
+        # message before central has echoed the import back
+        body = '{"x": 1}'
+        self.bridgeB.handleLinkMessage(['vehicle.pose:', json.dumps({'path': ['a']}), body])
+        self.centralB.deliver('vehicle.pose', body)
+        self.runUntil(lambda: self.bridgeB.stats['notRelayed'])
+
+        self.assertEqual(1, self.bridgeB.stats['imported'])
+        self.assertEqual(1, self.bridgeB.stats['notRelayed'])
+        self.assertEqual(1, self.bridgeB.stats['exported'])
+
+    def test_subscriberBridgeHeader(self):
+        subscriber = ZmqSubscriber('zmqBridgeTest')
+        received = []
+        subscriber.subscribeRaw('vehicle.', lambda topic, body: received.append((topic, body)))
+        subscriber.subscribeBridge('vehicle.',
+                                   lambda topic, body, header: received.append((topic, body, header)))
+        header = json.dumps({'path': ['a']})
+
+        subscriber.routeFrames(['vehicle.pose:', '{"x": 1}', header])
+        subscriber.routeFrames(['vehicle.pose:', '{"x": 2}'])
+        self.assertEqual([('vehicle.pose', '{"x": 1}'),
+                          ('vehicle.pose', '{"x": 1}', header),
+                          ('vehicle.pose', '{"x": 2}'),
+                          ('vehicle.pose', '{"x": 2}', None)],
+                         received)
+        self.assertFalse(hasAttachments(['vehicle.pose:', '{"x": 1}', header]))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -22,7 +22,8 @@ import datetime
 import time
 import traceback
 import atexit
-import random
+import multiprocessing
+import collections
 
 import zmq
 from zmq.eventloop.zmqstream import ZMQStream
@@ -36,8 +37,16 @@ from geocamUtil.zmqUtil.util import (DEFAULT_CENTRAL_RPC_PORT,
                                      DEFAULT_CENTRAL_PUBLISH_PORT,
                                      getTimestamp,
                                      parseEndpoint,
-                                     hasAttachments,
-                                     parseMessage)
+                                     parseMessage,
+                                     hasAttachments)
+from geocamUtil.zmqUtil.attachmentStore import storeMessageAttachments
+from geocamUtil.zmqUtil.trafficStats import TrafficStats
+from geocamUtil.zmqUtil.messageCodec import decodeBody
+from geocamUtil.zmqUtil.logIndex import DEFAULT_CHECKPOINT_RECORDS
+from geocamUtil.zmqUtil.logWriter import (MessageLogWriter,
+                                          SYNC_POLICIES,
+                                          DEFAULT_QUEUE_SIZE,
+                                          DEFAULT_SYNC_PERIOD_SECS)
 
 # pylint: disable=E1101
 
@@ -53,6 +62,21 @@ class ZmqCentral(object):
         self.info = {}
         self.messageLogPath = None
         self.messageLog = None
+        self.logStatsTimer = None
+        self.lastLogDropped = 0
+        self.lastAttachmentsDropped = 0
+        self.attachmentPool = None
+        self.pendingLogRecords = collections.deque()
+        self.topicStats = None
+        self.moduleStats = None
+        self.statsTimer = None
+        self.statsPublishTimer = None
+        self.attachmentStats = {'submitted': 0,
+                                'completed': 0,
+                                'dropped': 0,
+                                'failed': 0,
+                                'bytes': 0,
+                                'bytesWritten': 0}
         self.rpcStream = None
         self.disconnectTimer = None
         self.injectStream = None
@@ -74,43 +98,90 @@ class ZmqCentral(object):
                                   json.dumps({'timestamp': str(getTimestamp())})))
 
     def logMessage(self, msg, posixTime=None, attachmentDir='-'):
-        mlog = self.messageLog
-        mlog.write('@@@ %d %d %s ' % (getTimestamp(posixTime), len(msg), attachmentDir))
-        mlog.write(msg)
-        mlog.write('\n')
-
-    def logMessageWithAttachments0(self, msg):
-        parsed = parseMessage(msg)
-        posixTime = time.time()
-
-        # construct attachment directory
-        dt = datetime.datetime.utcfromtimestamp(posixTime)
-        dateText = dt.strftime('%Y-%m-%d')
-        timeText = dt.strftime('%H-%M-%S') + '.%06d' % dt.microsecond
-        uniq = '%08x' % random.getrandbits(32)
-        attachmentSuffix = os.path.join('attachments',
-                                        dateText,
-                                        timeText,
-                                        parsed['topic'],
-                                        uniq)
-        attachmentPath = os.path.join(self.logDir, attachmentSuffix)
-        os.makedirs(attachmentPath)
-
-        # write attachments to attachment directory
-        for attachment in parsed['attachments']:
-            fullName = os.path.join(attachmentPath, attachment.get_filename())
-            open(fullName, 'wb').write(attachment.get_payload())
-
-        # log message with a pointer to the attachment directory
-        self.logMessage(':'.join((parsed['topic'], parsed['json'])),
-                        posixTime,
-                        attachmentSuffix)
+        if self.pendingLogRecords:
+            # wait behind the messages whose attachments are still
+            # being stored, to keep the log in timestamp order
+            if posixTime is None:
+                posixTime = time.time()
+            self.pendingLogRecords.append({'posixTime': posixTime,
+                                           'msg': msg,
+                                           'ref': attachmentDir,
+                                           'done': True})
+            return
+        self.messageLog.write(getTimestamp(posixTime), attachmentDir, msg)
+
+    def flushPendingLogRecords(self):
+        """
+        Writes the pending records at the head of the queue that are
+        ready, stopping at the first one still waiting for its
+        attachments.
+        """
+        pending = self.pendingLogRecords
+        while pending and pending[0]['done']:
+            record = pending.popleft()
+            if record['msg'] is not None:
+                self.messageLog.write(getTimestamp(record['posixTime']),
+                                      record['ref'],
+                                      record['msg'])
+
+    def logStoredAttachments(self, record, result):
+        """
+        Called on the ioloop thread with the result of
+        storeMessageAttachments() for pending log @record.
+        """
+        if record['done']:
+            # already handled at shutdown
+            return
+        record['done'] = True
+        self.attachmentStats['completed'] += 1
+        if 'error' in result:
+            self.attachmentStats['failed'] += 1
+            logging.warning(result['error'])
+            logging.warning('[error while storing message attachments at time %s]', getTimestamp())
+        else:
+            self.attachmentStats['bytes'] += result['bytes']
+            self.attachmentStats['bytesWritten'] += result['bytesWritten']
+            record['msg'] = result['msg']
+            record['ref'] = result['ref']
+        self.flushPendingLogRecords()
 
     def logMessageWithAttachments(self, msg):
-        try:
-            return self.logMessageWithAttachments0(msg)
-        except:  # pylint: disable=W0702
-            self.logException('logging message with attachments')
+        posixTime = time.time()
+        stats = self.attachmentStats
+        if (self.attachmentPool is not None
+                and stats['submitted'] - stats['completed'] >= self.opts.attachmentQueueSize):
+            # workers are behind, log the message without its attachments
+            stats['dropped'] += 1
+            try:
+                parsed = parseMessage(msg)
+            except:  # pylint: disable=W0702
+                logging.warning('[could not parse message with attachments at time %s]', getTimestamp())
+                return
+            self.logMessage(':'.join((parsed['topic'], parsed['json'])), posixTime)
+            return
+
+        stats['submitted'] += 1
+        record = {'posixTime': posixTime,
+                  'msg': None,
+                  'ref': '-',
+                  'done': False}
+        self.pendingLogRecords.append(record)
+        if self.attachmentPool is None:
+            self.logStoredAttachments(record, storeMessageAttachments(self.logDir, msg))
+            return
+
+        # the pool calls back on its result thread, hand the result to
+        # the ioloop so stats and the pending queue stay single-threaded
+        loop = ioloop.IOLoop.instance()
+        record['result'] = self.attachmentPool.apply_async(
+            storeMessageAttachments,
+            (self.logDir, msg),
+            callback=lambda result: loop.add_callback(self.logStoredAttachments, record, result))
+
+    def getAttachmentStats(self):
+        result = self.attachmentStats.copy()
+        result['queueDepth'] = result['submitted'] - result['completed']
+        return result
 
     def handleHeartbeat(self, params):
         moduleName = params['module'].encode('utf-8')
@@ -132,6 +203,56 @@ class ZmqCentral(object):
     def handleInfo(self):
         return self.info
 
+    def countMessage(self, topic, msg, msgHasAttachments):
+        # central can't see which module sent a message, so we attribute
+        # it to the first component of the topic, which by convention is
+        # the name of the publishing module or bridge
+        if isinstance(msg, list):
+            size = sum([len(frame) for frame in msg])
+            attachmentBytes = size - len(msg[0]) - len(msg[1])
+        else:
+            size = len(msg)
+            if msgHasAttachments:
+                attachmentBytes = size
+            else:
+                attachmentBytes = 0
+        self.topicStats.add(topic, size, attachmentBytes)
+        self.moduleStats.add(topic.split('.', 1)[0], size, attachmentBytes)
+
+    def handleStats(self):
+        result = {'timestamp': str(getTimestamp())}
+        if self.topicStats:
+            result['topics'] = self.topicStats.getStats()
+            result['modules'] = self.moduleStats.getStats()
+        if self.messageLog:
+            result['messageLog'] = self.messageLog.getStats()
+            result['attachments'] = self.getAttachmentStats()
+        result['drops'] = self.getDropStats()
+        return result
+
+    def getDropStats(self):
+        """
+        Returns the number of messages dropped at each point where
+        central can count them. Publishers only report drops when they
+        run with --countDrops; libzmq drops at the forwarder and monitor
+        high-water marks are silent.
+        """
+        result = {}
+        if self.messageLog:
+            result['messageLog'] = self.messageLog.numDropped
+            result['attachments'] = self.attachmentStats['dropped']
+        result['publishers'] = dict(((moduleName, info['dropped'])
+                                     for moduleName, info in self.info.iteritems()
+                                     if 'dropped' in info))
+        return result
+
+    def handleStatsTimer(self):
+        self.topicStats.snapshot()
+        self.moduleStats.snapshot()
+
+    def publishStats(self):
+        self.injectStream.send('central.stats:%s' % json.dumps(self.handleStats()))
+
     def logException(self, whileClause):
         errClass, errObject, errTB = sys.exc_info()[:3]
         errText = '%s.%s: %s' % (errClass.__module__,
@@ -142,18 +263,35 @@ class ZmqCentral(object):
         logging.warning('[error while %s at time %s]', whileClause, getTimestamp())
 
     def handleMessages(self, messages):
-        for msg in messages:
-            if self.messageLog:
-                if hasAttachments(msg):
-                    self.logMessageWithAttachments(msg)
+        # @messages holds the frames of one message: a single frame in
+        # the legacy wire format, or [topic, body, attachments...] in
+        # multipart wire mode
+        if len(messages) == 1:
+            msg = messages[0]
+            topic = msg[:msg.find(':')]
+        else:
+            msg = messages
+            topic = msg[0][:-1]
+
+        msgHasAttachments = hasAttachments(msg)
+        if self.topicStats:
+            self.countMessage(topic, msg, msgHasAttachments)
+        if self.messageLog:
+            if msgHasAttachments:
+                self.logMessageWithAttachments(msg)
+            elif msg is messages:
+                self.logMessage(msg[:2])
+            else:
+                self.logMessage(msg)
+        if topic.startswith('central.heartbeat.'):
+            try:
+                if msg is messages:
+                    body = msg[1]
                 else:
-                    self.logMessage(msg)
-            if msg.startswith('central.heartbeat.'):
-                try:
                     _topic, body = msg.split(':', 1)
-                    self.handleHeartbeat(json.loads(body))
-                except:  # pylint: disable=W0702
-                    self.logException('handling heartbeat')
+                self.handleHeartbeat(decodeBody(body))
+            except:  # pylint: disable=W0702
+                self.logException('handling heartbeat')
 
     def handleRpcCall(self, messages):
         for msg in messages:
@@ -169,6 +307,8 @@ class ZmqCentral(object):
                 _params = call['params']
                 if method == 'info':
                     result = self.handleInfo()
+                elif method == 'stats':
+                    result = self.handleStats()
                 else:
                     raise ValueError('unknown method %s' % method)
                 self.rpcStream.send(json.dumps({'result': result,
@@ -195,6 +335,23 @@ class ZmqCentral(object):
             self.announceDisconnect(moduleName)
             del self.info[moduleName]
 
+    def handleLogStatsTimer(self):
+        stats = self.messageLog.getStats()
+        if stats['dropped'] > self.lastLogDropped:
+            logging.warning('message log writer dropped %d records (queue depth %d, %d dropped total)',
+                            stats['dropped'] - self.lastLogDropped,
+                            stats['queueDepth'],
+                            stats['dropped'])
+            self.lastLogDropped = stats['dropped']
+
+        stats = self.getAttachmentStats()
+        if stats['dropped'] > self.lastAttachmentsDropped:
+            logging.warning('attachment pool dropped the attachments of %d messages (queue depth %d, %d dropped total)',
+                            stats['dropped'] - self.lastAttachmentsDropped,
+                            stats['queueDepth'],
+                            stats['dropped'])
+            self.lastAttachmentsDropped = stats['dropped']
+
     def readyLog(self, pathTemplate, timestamp):
         if '%s' in pathTemplate:
             timeText = timestamp.strftime('%Y-%m-%d-%H-%M-%S')
@@ -208,9 +365,12 @@ class ZmqCentral(object):
             latestPath = os.path.join(self.logDir, pathTemplate % 'latest')
             if os.path.islink(latestPath):
                 os.unlink(latestPath)
-        os.symlink(logFile, latestPath)
+            os.symlink(logFile, latestPath)
         return logPath
 
+    def readyMessageLogSegment(self):
+        return self.readyLog(self.opts.messageLog, datetime.datetime.utcnow())
+
     def start(self):
         # respect --bindInterface argument
         self.opts.rpcEndpoint = self.opts.rpcEndpoint.format(bindInterface=self.opts.bindInterface)
@@ -222,7 +382,15 @@ class ZmqCentral(object):
         self.logDir = os.path.abspath(self.opts.logDir)
         if self.opts.messageLog != 'none':
             self.messageLogPath = self.readyLog(self.opts.messageLog, now)
-            self.messageLog = open(self.messageLogPath, 'a')
+            self.messageLog = MessageLogWriter(self.messageLogPath,
+                                               indexCheckpoint=self.opts.indexCheckpoint,
+                                               queueSize=self.opts.logQueueSize,
+                                               sync=self.opts.logSync,
+                                               syncPeriodSecs=self.opts.logSyncPeriod,
+                                               rotateBytes=int(self.opts.logRotateMegabytes * 1024 * 1024),
+                                               rotateSecs=self.opts.logRotateMinutes * 60,
+                                               getSegmentPath=self.readyMessageLogSegment,
+                                               compress=(self.opts.logCompress == 'gzip'))
         if self.opts.consoleLog != 'none':
             self.consoleLogPath = self.readyLog(self.opts.consoleLog, now)
 
@@ -263,6 +431,16 @@ class ZmqCentral(object):
             os.dup2(nullFd, 2)
 
         try:
+            # start attachment workers before any threads or zmq sockets exist
+            if self.messageLog and self.opts.attachmentWorkers > 0:
+                self.attachmentPool = multiprocessing.Pool(self.opts.attachmentWorkers)
+
+            # start the log writer thread (after forking, threads don't survive fork)
+            if self.messageLog:
+                self.messageLog.start()
+                self.logStatsTimer = ioloop.PeriodicCallback(self.handleLogStatsTimer, 10000)
+                self.logStatsTimer.start()
+
             # set up zmq
             self.context = zmq.Context.instance()
             self.rpcStream = ZMQStream(self.context.socket(zmq.REP))
@@ -270,11 +448,21 @@ class ZmqCentral(object):
             logging.info('bound rpcEndpoint %s', self.opts.rpcEndpoint)
             self.rpcStream.on_recv(self.handleRpcCall)
 
-            self.forwarder = ThreadDevice(zmq.FORWARDER, zmq.SUB, zmq.PUB)
-            self.forwarder.setsockopt_in(zmq.IDENTITY, THIS_MODULE)
-            self.forwarder.setsockopt_out(zmq.IDENTITY, THIS_MODULE)
-            self.forwarder.setsockopt_in(zmq.SUBSCRIBE, '')
-            # self.forwarder.setsockopt_out(zmq.HWM, self.opts.highWaterMark)
+            if self.opts.proxyMode == 'xpub':
+                # XSUB/XPUB pass subscriptions from downstream subscribers
+                # up to the publishers, which then only send topics that
+                # somebody wants
+                self.forwarder = ThreadDevice(zmq.FORWARDER, zmq.XSUB, zmq.XPUB)
+                self.forwarder.setsockopt_in(zmq.IDENTITY, THIS_MODULE)
+                self.forwarder.setsockopt_out(zmq.IDENTITY, THIS_MODULE)
+            else:
+                self.forwarder = ThreadDevice(zmq.FORWARDER, zmq.SUB, zmq.PUB)
+                self.forwarder.setsockopt_in(zmq.IDENTITY, THIS_MODULE)
+                self.forwarder.setsockopt_out(zmq.IDENTITY, THIS_MODULE)
+                self.forwarder.setsockopt_in(zmq.SUBSCRIBE, '')
+            if self.opts.highWaterMark is not None:
+                self.forwarder.setsockopt_in(zmq.RCVHWM, self.opts.highWaterMark)
+                self.forwarder.setsockopt_out(zmq.SNDHWM, self.opts.highWaterMark)
             self.forwarder.bind_in(self.opts.subscribeEndpoint)
             logging.info('bound subscribeEndpoint %s', self.opts.subscribeEndpoint)
             self.forwarder.bind_in(INJECT_ENDPOINT)
@@ -293,8 +481,19 @@ class ZmqCentral(object):
             self.forwarder.start()
             time.sleep(0.1)  # wait for forwarder to bind sockets
 
-            self.monStream = ZMQStream(self.context.socket(zmq.SUB))
-            self.monStream.setsockopt(zmq.SUBSCRIBE, '')
+            monSocket = self.context.socket(zmq.SUB)
+            if self.opts.highWaterMark is not None:
+                monSocket.setsockopt(zmq.RCVHWM, self.opts.highWaterMark)
+            self.monStream = ZMQStream(monSocket)
+            if self.opts.proxyMode == 'xpub' and not self.messageLog:
+                # in xpub mode the monitor's subscriptions also travel
+                # upstream, so only ask for everything when we need to
+                # log everything. without a message log the monitor only
+                # needs heartbeats, and traffic stats only cover topics
+                # that some subscriber asked for.
+                self.monStream.setsockopt(zmq.SUBSCRIBE, 'central.')
+            else:
+                self.monStream.setsockopt(zmq.SUBSCRIBE, '')
             self.monStream.connect(MONITOR_ENDPOINT)
             self.monStream.on_recv(self.handleMessages)
 
@@ -304,6 +503,16 @@ class ZmqCentral(object):
             self.disconnectTimer = ioloop.PeriodicCallback(self.handleDisconnectTimer, 5000)
             self.disconnectTimer.start()
 
+            if self.opts.stats:
+                self.topicStats = TrafficStats()
+                self.moduleStats = TrafficStats()
+                self.statsTimer = ioloop.PeriodicCallback(self.handleStatsTimer, 1000)
+                self.statsTimer.start()
+                if self.opts.statsPublishPeriod > 0:
+                    self.statsPublishTimer = ioloop.PeriodicCallback(self.publishStats,
+                                                                     self.opts.statsPublishPeriod * 1000)
+                    self.statsPublishTimer.start()
+
         except:  # pylint: disable=W0702
             errClass, errObject, errTB = sys.exc_info()[:3]
             errText = '%s.%s: %s' % (errClass.__module__,
@@ -315,8 +524,17 @@ class ZmqCentral(object):
             sys.exit(1)
 
     def shutdown(self):
+        if self.attachmentPool:
+            self.attachmentPool.close()
+            self.attachmentPool.join()
+            self.attachmentPool = None
+            # the ioloop is no longer running, so collect the remaining
+            # results here
+            for record in list(self.pendingLogRecords):
+                if not record['done']:
+                    self.logStoredAttachments(record, record['result'].get())
         if self.messageLog:
-            self.messageLog.close()
+            self.messageLog.stop()
             self.messageLog = None
 
 
@@ -339,24 +557,64 @@ def main():
                       default=[],
                       action='append',
                       help='Non-central-aware publisher to subscribe to (format "<moduleName>@<endpoint>"; can specify multiple times)')
+    parser.add_option('--proxyMode',
+                      default='forwarder', type='choice', choices=('forwarder', 'xpub'),
+                      help=('How central forwards messages: "forwarder" receives every message'
+                            ' from every publisher; "xpub" passes subscriptions upstream so'
+                            ' publishers only send topics that have subscribers [%default]'))
     parser.add_option('-d', '--logDir',
                       default='log',
                       help='Directory to place logs in [%default]')
     parser.add_option('-m', '--messageLog',
                       default='zmqCentral-messages-%s.txt',
                       help='Log file for message traffic, or "none" [%default]')
+    parser.add_option('--indexCheckpoint',
+                      default=DEFAULT_CHECKPOINT_RECORDS, type='int',
+                      help='Max records between checkpoints in the message log index, or 0 to disable the index [%default]')
+    parser.add_option('--logQueueSize',
+                      default=DEFAULT_QUEUE_SIZE, type='int',
+                      help='Max records waiting to be written to the message log before new records are dropped [%default]')
+    parser.add_option('--logSync',
+                      default='none', type='choice', choices=SYNC_POLICIES,
+                      help='When to fsync the message log: %s [%%default]' % ', '.join(SYNC_POLICIES))
+    parser.add_option('--logSyncPeriod',
+                      default=DEFAULT_SYNC_PERIOD_SECS, type='float',
+                      help='Seconds between fsyncs with --logSync=periodic [%default]')
+    parser.add_option('--logRotateMegabytes',
+                      default=0, type='float',
+                      help='Start a new message log segment when the current one reaches this size, or 0 for no size limit [%default]')
+    parser.add_option('--logRotateMinutes',
+                      default=0, type='float',
+                      help='Start a new message log segment after this many minutes, or 0 for no time limit [%default]')
+    parser.add_option('--logCompress',
+                      default='gzip', type='choice', choices=('gzip', 'none'),
+                      help='How to compress closed message log segments: gzip or none [%default]')
+    parser.add_option('--attachmentWorkers',
+                      default=2, type='int',
+                      help='Number of worker processes that store message attachments, or 0 to store them inline [%default]')
+    parser.add_option('--attachmentQueueSize',
+                      default=1000, type='int',
+                      help='Max messages waiting for attachment workers before new ones are logged without their attachments [%default]')
+    parser.add_option('--noStats',
+                      action='store_false', dest='stats', default=True,
+                      help='Do not keep per-topic traffic statistics for the "stats" RPC method')
+    parser.add_option('--statsPublishPeriod',
+                      default=0, type='float',
+                      help='If positive, publish traffic statistics on the central.stats topic with this period (seconds) [%default]')
     parser.add_option('-c', '--consoleLog',
                       default='zmqCentral-console-%s.txt',
                       help='Log file for debugging zmqCentral [%default]')
     parser.add_option('-f', '--foreground',
                       action='store_true', default=False,
                       help='Do not daemonize zmqCentral on startup')
-    #parser.add_option('--highWaterMark',
-    #                  default=10000, type='int',
-    #                  help='High-water mark for publish socket (see 0MQ docs) [%default]')
+    parser.add_option('--highWaterMark',
+                      type='int',
+                      help='High-water mark for the forwarder and monitor sockets (see 0MQ docs) [libzmq default]')
     opts, args = parser.parse_args()
     if args:
         parser.error('expected no args')
+    if (opts.logRotateMegabytes or opts.logRotateMinutes) and '%s' not in opts.messageLog:
+        parser.error('message log rotation requires a --messageLog template containing %s')
     zc = ZmqCentral(opts)
     zc.start()
     atexit.register(zc.shutdown)
@@ -15,23 +15,153 @@
 # specific language governing permissions and limitations under the License.
 #__END_LICENSE__
 
+"""
+Prints the messages whose topics start with <prefix> and that match an
+optional filter expression (-e), for example:
+
+  zmqGrep.py -e 'battery.level < 20' rover.
+
+See geocamUtil.zmqUtil.messageFilter for the expression syntax.
+
+With --replay, searches message logs instead of listening to the bus.
+Each log is read through its time/topic index if it has one. With
+--jobs N, the logs are split into chunks of about 16 MB that are
+searched in N worker processes, so a worker never holds more than one
+chunk's matches. Compressed segments can't be split and are searched
+whole. The matches are printed chunk by chunk, in the order the logs
+were given, so they are in time order within each log but logs that
+overlap in time are not merged, and --replayDedupeMsecs is not
+supported.
+"""
+
+import os
 import logging
+import multiprocessing
 
 from zmq.eventloop import ioloop
 ioloop.install()
 
-from geocamUtil.zmqUtil.util import zmqLoop
+from geocamUtil.zmqUtil.util import zmqLoop, openLogParser, parseTimestampArg
+from geocamUtil.zmqUtil.logIndex import (LogIndex,
+                                         getIndexPath,
+                                         topicMatches,
+                                         COMPRESSED_SUFFIX)
 from geocamUtil.zmqUtil.subscriber import ZmqSubscriber
 from geocamUtil import anyjson as json
+from geocamUtil.zmqUtil.messageCodec import toJsonBody
+from geocamUtil.zmqUtil.messageFilter import MessageFilter, decodeMessageBody
+
+CHUNK_BYTES = 16 * 1024 * 1024
 
 
-def handleMessagePretty(topic, obj):
-    print topic
-    print json.dumps(obj, sort_keys=True, indent=4)
+def formatMessage(topic, body, pretty=False):
+    if pretty:
+        try:
+            obj = decodeMessageBody(body)
+        except ValueError:
+            pass
+        else:
+            return '%s\n%s' % (topic, json.dumps(obj, sort_keys=True, indent=4))
+    # show binary codecs as JSON
+    return '%s: %s' % (topic, toJsonBody(body))
 
 
-def handleMessageSimple(topic, body):
-    print '%s: %s' % (topic, body)
+def getChunks(logPath, startTime, endTime, prefix):
+    """
+    Returns a list of (begin, end, aligned) byte ranges that together
+    cover the parts of the log at @logPath that may hold matching
+    records, each about CHUNK_BYTES long. If aligned is False, begin
+    may fall inside a record and the chunk starts at the next record.
+    Compressed logs are returned as a single (None, None, True) chunk
+    since they can't be read from the middle.
+    """
+    if logPath.endswith(COMPRESSED_SUFFIX):
+        return [(None, None, True)]
+    size = os.path.getsize(logPath)
+    index = LogIndex.load(getIndexPath(logPath))
+    if index is None:
+        tail = 0
+        chunks = []
+    else:
+        # split at index block boundaries, which are record boundaries
+        topicPrefixes = None
+        if prefix:
+            topicPrefixes = [prefix]
+        ranges = index.getRanges(startTime, endTime, topicPrefixes)
+        indexedRanges = [r for r in ranges if r[1] is not None]
+        tail = ranges[-1][0]
+        blockOffsets = [block['offset'] for block in index.blocks]
+        chunks = []
+        for begin, end in indexedRanges:
+            chunkBegin = begin
+            for offset in blockOffsets:
+                if offset >= chunkBegin + CHUNK_BYTES and offset < end:
+                    chunks.append((chunkBegin, offset, True))
+                    chunkBegin = offset
+            chunks.append((chunkBegin, end, True))
+
+    # unindexed tail of the log, split anywhere
+    for begin in xrange(tail, size, CHUNK_BYTES):
+        chunks.append((begin, min(begin + CHUNK_BYTES, size), begin == tail))
+    return chunks
+
+
+def searchLog(logPath, begin, end, aligned, prefix, expr, startTime, endTime, pretty):
+    """
+    Returns the formatted messages that match in the chunk of the log
+    at @logPath from byte offset @begin to @end, as returned by
+    getChunks().
+    """
+    messageFilter = None
+    if expr:
+        messageFilter = MessageFilter(expr)
+    topicPrefixes = None
+    if prefix:
+        topicPrefixes = (prefix,)
+    matches = []
+    parser = openLogParser(logPath)
+    if begin is None:
+        records = parser.select(startTime, endTime, topicPrefixes)
+    else:
+        if not aligned and begin > 0:
+            begin = parser.resync(begin - 1)
+        records = parser.iterRange(begin, end)
+    for rec in records:
+        if startTime is not None and rec.timestamp < startTime:
+            continue
+        if endTime is not None and rec.timestamp > endTime:
+            continue
+        if topicPrefixes and not topicMatches(rec.topic, topicPrefixes):
+            continue
+        topic = rec.topic
+        if messageFilter is not None and not messageFilter.matchesTopic(topic):
+            continue
+        body = rec.msg[(len(topic) + 1):]
+        if messageFilter is None or messageFilter.matches(topic, body):
+            matches.append(formatMessage(topic, body, pretty))
+    parser.close()
+    return matches
+
+
+def searchLogWorker(args):
+    return searchLog(*args)
+
+
+def searchLogs(opts, prefix):
+    startTime = opts.replayStart and parseTimestampArg(opts.replayStart)
+    endTime = opts.replayEnd and parseTimestampArg(opts.replayEnd)
+    jobs = [(logPath, begin, end, aligned, prefix, opts.expr, startTime, endTime, opts.pretty)
+            for logPath in opts.replay
+            for begin, end, aligned in getChunks(logPath, startTime, endTime, prefix)]
+    pool = multiprocessing.Pool(opts.jobs)
+    numMatches = 0
+    for matches in pool.imap(searchLogWorker, jobs):
+        for match in matches:
+            print match
+        numMatches += len(matches)
+    pool.close()
+    pool.join()
+    print '=== %d matches in %d logs' % (numMatches, len(opts.replay))
 
 
 def main():
@@ -40,24 +170,47 @@ def main():
     parser.add_option('-p', '--pretty',
                       action='store_true', default=False,
                       help='Pretty-print JSON objects')
+    parser.add_option('-e', '--expr',
+                      help='Only print messages matching this filter expression')
+    parser.add_option('-j', '--jobs',
+                      type='int', default=1,
+                      help='With --replay, number of worker processes to search the logs with [%default]')
     ZmqSubscriber.addOptions(parser, 'zmqGrep')
     opts, args = parser.parse_args()
     if len(args) != 1:
         parser.error('expected exactly 1 arg')
+    messageFilter = None
+    if opts.expr:
+        try:
+            messageFilter = MessageFilter(opts.expr)
+        except ValueError, err:
+            parser.error(str(err))
     logging.basicConfig(level=logging.DEBUG)
 
-    # set up networking
+    topic = args[0]
+    if opts.replay and opts.jobs > 1:
+        if opts.replayDedupeMsecs:
+            parser.error('--replayDedupeMsecs is not supported with --jobs > 1')
+        if '-' in opts.replay:
+            parser.error('can not search stdin with --jobs > 1')
+        searchLogs(opts, topic)
+        return
+
+    # set up networking, unless we are only searching message logs
     s = ZmqSubscriber(**ZmqSubscriber.getOptionValues(opts))
-    s.start()
+    if not opts.replay:
+        s.start()
 
     # subscribe to the message we want
-    topic = args[0]
-    if opts.pretty:
-        s.subscribeJson(topic, handleMessagePretty)
-    else:
-        s.subscribeRaw(topic, handleMessageSimple)
+    def handleMessage(topic, body):
+        if messageFilter is None or messageFilter.matches(topic, body):
+            print formatMessage(topic, body, opts.pretty)
+    s.subscribeRaw(topic, handleMessage)
 
-    zmqLoop()
+    if opts.replay:
+        s.replay()
+    else:
+        zmqLoop()
 
 
 if __name__ == '__main__':
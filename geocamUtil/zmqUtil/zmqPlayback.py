@@ -15,73 +15,364 @@
 # specific language governing permissions and limitations under the License.
 #__END_LICENSE__
 
+"""
+Replays zmqCentral message logs. Several logs, for example from
+centrals on different hosts, are merged in timestamp order. By default
+messages are sent as fast as possible, as zmqPlayback always has. With
+--speed, messages are sent at the pace they were originally logged,
+scaled by the given factor (for example 1 for real time or 10 for ten
+times faster).
+Sends are scheduled on the ioloop in bounded batches, so the process
+stays responsive while a replay is running.
+
+With --rpcEndpoint, the replay can be controlled while it runs by
+sending JSON requests to a REP socket, in the same format as central's
+RPC endpoint: {"method": ..., "params": {...}, "id": ...}. Methods:
+
+  pause, resume
+  seek     params: {"logTime": <microsecond timestamp or UTC time string>}
+  speed    params: {"speed": <factor or "max">}
+  status
+"""
+
+import os
 import sys
+import time
 import logging
+import mimetypes
 
+import zmq
+from zmq.eventloop.zmqstream import ZMQStream
 from zmq.eventloop import ioloop
 ioloop.install()
 
-from geocamUtil.zmqUtil.util import zmqLoop, LogParser
+from geocamUtil import anyjson as json
+from geocamUtil.zmqUtil.util import (zmqLoop,
+                                     openLogParsers,
+                                     parseTimestampArg,
+                                     parseEndpoint,
+                                     FrameAttachment)
 from geocamUtil.zmqUtil.publisher import ZmqPublisher
+from geocamUtil.zmqUtil.attachmentStore import getAttachmentFiles
+
+# max records to send in one ioloop callback. a replay that is behind
+# schedule or running at max speed yields to the ioloop between batches.
+DEFAULT_MAX_BATCH = 500
+
+# gives the publisher a chance to connect to central before publishing
+START_DELAY_SECS = 0.1
+
+
+def parseSpeed(speed):
+    """
+    Returns the speed factor for @speed, a number or 'max'. Max speed is
+    represented as 0.
+    """
+    if speed == 'max':
+        return 0
+    speed = float(speed)
+    if speed <= 0:
+        raise ValueError('speed must be positive or "max", got %s' % speed)
+    return speed
+
+
+def parseTime(timeValue):
+    if isinstance(timeValue, basestring):
+        return parseTimestampArg(timeValue)
+    return int(timeValue)
+
+
+def getContentType(filename):
+    return mimetypes.guess_type(filename)[0] or 'application/octet-stream'
 
 
 class ZmqPlayback(object):
-    def __init__(self, logPath, opts):
-        self.logPath = logPath
-        self.logFile = None
+    def __init__(self, logPaths, opts):
+        self.logPaths = logPaths
         self.log = None
         self.opts = opts
         self.publisher = ZmqPublisher(**ZmqPublisher.getOptionValues(opts))
-        self.publishTimer = None
-        print 'topics:', self.opts.topic
+        self.topics = opts.topic
+        self.startTime = None
+        if opts.start:
+            self.startTime = parseTimestampArg(opts.start)
+        self.endTime = None
+        if opts.end:
+            self.endTime = parseTimestampArg(opts.end)
+        self.speed = parseSpeed(opts.speed)
+        self.maxBatch = opts.maxBatch
+        self.attachmentsDir = opts.attachmentsDir
+        self.dedupeWindowUsecs = None
+        if opts.dedupeMsecs:
+            self.dedupeWindowUsecs = opts.dedupeMsecs * 1000
+
+        self.records = None
+        self.nextRecord = None
+        self.paused = False
+        self.pausedLogTime = None
+        self.done = False
+        self.count = 0
+
+        # the schedule maps log time to wall clock time through this
+        # anchor point. None means anchor at the next record sent.
+        self.anchorLogTime = None
+        self.anchorWallTime = None
+        self.sendTimeout = None
+
+        self.rpcStream = None
+        logging.debug('zmqPlayback: topics %s', self.topics)
+
+    @classmethod
+    def addOptions(cls, parser):
+        parser.add_option('-t', '--topic',
+                          action='append',
+                          help='Only print specified topics, can specify multiple times')
+        parser.add_option('--start',
+                          help='Skip messages before this time (UTC "YYYY-MM-DD HH:MM:SS" or microsecond timestamp)')
+        parser.add_option('--end',
+                          help='Skip messages after this time (UTC "YYYY-MM-DD HH:MM:SS" or microsecond timestamp)')
+        parser.add_option('--speed',
+                          default='max',
+                          help='Playback speed relative to the original timing, or "max" to send as fast as possible [%default]')
+        parser.add_option('--maxBatch',
+                          type='int', default=DEFAULT_MAX_BATCH,
+                          help='Max messages to send in one ioloop callback [%default]')
+        parser.add_option('--attachmentsDir',
+                          help='Directory where zmqCentral stored attachments [directory of each log]')
+        parser.add_option('--dedupeMsecs',
+                          type='int',
+                          help='When merging logs, drop a message if the same message came from another log within this many msecs [no dedupe]')
+        parser.add_option('--rpcEndpoint',
+                          help='Endpoint to accept pause/resume/seek/speed/status requests on [disabled]')
+        ZmqPublisher.addOptions(parser, 'zmqPlayback')
 
     def start(self):
         self.publisher.start()
 
-        # the delay gives a chance to connect to central before publishing
-        self.publishTimer = ioloop.DelayedCallback(self.playLog, 100)
-        self.publishTimer.start()
-
-    def playLog(self):
-        self.logFile = open(self.logPath, 'rb')
-        self.log = LogParser(self.logFile)
-        i = 0
-        for rec in self.log:
-            topicMatch = False
-            if self.opts.topic:
-                for topic in self.opts.topic:
-                    if rec.msg.startswith(topic):
-                        topicMatch = True
-                        break
+        if self.opts.rpcEndpoint:
+            self.rpcStream = ZMQStream(self.publisher.context.socket(zmq.REP))
+            self.rpcStream.bind(parseEndpoint(self.opts.rpcEndpoint))
+            self.rpcStream.on_recv(self.handleRpcCall)
+
+        self.log = openLogParsers(self.logPaths, self.dedupeWindowUsecs)
+        self.seek(None)
+        # anchor the schedule when the first record is actually sent
+        self.anchorLogTime = None
+        self.scheduleSend(time.time() + START_DELAY_SECS)
+
+    def scheduleSend(self, wallTime):
+        loop = ioloop.IOLoop.instance()
+        if self.sendTimeout is not None:
+            loop.remove_timeout(self.sendTimeout)
+        self.sendTimeout = loop.add_timeout(wallTime, self.sendDue)
+
+    def cancelSend(self):
+        if self.sendTimeout is not None:
+            ioloop.IOLoop.instance().remove_timeout(self.sendTimeout)
+            self.sendTimeout = None
+
+    def reanchor(self, logTime):
+        self.anchorLogTime = logTime
+        self.anchorWallTime = time.time()
+
+    def getLogTime(self):
+        """
+        Returns the log time the replay has reached, or None if there are
+        no more records.
+        """
+        if self.paused:
+            return self.pausedLogTime
+        if self.anchorLogTime is None or not self.speed:
+            if self.nextRecord is None:
+                return None
+            return self.nextRecord.timestamp
+        return self.anchorLogTime + int((time.time() - self.anchorWallTime) * 1e+6 * self.speed)
+
+    def sendDue(self):
+        """
+        Sends the records that are due, up to maxBatch of them, then
+        schedules the next call.
+        """
+        self.sendTimeout = None
+        if self.paused:
+            return
+        now = time.time()
+        numSent = 0
+        while self.nextRecord is not None:
+            rec = self.nextRecord
+            if self.speed:
+                if self.anchorLogTime is None:
+                    self.reanchor(rec.timestamp)
+                    now = self.anchorWallTime
+                dueTime = (self.anchorWallTime
+                           + (rec.timestamp - self.anchorLogTime) / (1e+6 * self.speed))
+                if dueTime > now:
+                    self.scheduleSend(dueTime)
+                    return
+            if numSent >= self.maxBatch:
+                self.scheduleSend(now)
+                return
+            self.publishRecord(rec)
+            numSent += 1
+            self.nextRecord = next(self.records, None)
+        self.finish()
+
+    def publishRecord(self, rec):
+        if rec.attachmentsPath != '-':
+            self.publishWithAttachments(rec)
+        elif self.publisher.wireMode == 'single':
+            # send the logged message as-is, without copying it
+            self.publisher.sendFrames((rec.getBuffer(),), rec.topic)
+        else:
+            self.publisher.sendRaw(rec.topic, rec.msg[(len(rec.topic) + 1):])
+
+        if self.count % 100 == 0:
+            sys.stdout.write('.')
+            sys.stdout.flush()
+        self.count += 1
+
+    def getAttachmentsDir(self):
+        if self.attachmentsDir is not None:
+            return self.attachmentsDir
+        # attachments are stored next to the log the record came from
+        parser = getattr(self.log, 'currentParser', self.log)
+        return os.path.dirname(os.path.abspath(parser.logPath))
+
+    def publishWithAttachments(self, rec):
+        attachments = []
+        try:
+            for filename, path in getAttachmentFiles(self.getAttachmentsDir(), rec.attachmentsPath):
+                with open(path, 'rb') as attachmentFile:
+                    data = attachmentFile.read()
+                attachments.append(FrameAttachment(filename, getContentType(filename), data))
+        except (IOError, OSError), err:
+            logging.warning('zmqPlayback: skipping message at time %d, could not read attachments: %s',
+                            rec.timestamp, err)
+            return
+        self.publisher.sendAttachments(rec.topic, rec.msg[(len(rec.topic) + 1):], attachments)
+
+    def finish(self):
+        if not self.done:
+            self.done = True
+            self.publisher.flush()
+            print
+            print 'message count:', self.count
+            if getattr(self.log, 'numDuplicates', 0):
+                print 'duplicates dropped:', self.log.numDuplicates
+
+    def pause(self):
+        if not self.paused:
+            self.pausedLogTime = self.getLogTime()
+            self.paused = True
+            self.cancelSend()
+
+    def resume(self):
+        if self.paused:
+            self.paused = False
+            if self.pausedLogTime is None:
+                self.anchorLogTime = None
             else:
-                topicMatch = True
+                self.reanchor(self.pausedLogTime)
+            self.scheduleSend(time.time())
 
-            if topicMatch:
-                self.publisher.pubStream.send(rec.msg)
-                if i % 100 == 0:
-                    sys.stdout.write('.')
-                    sys.stdout.flush()
-                i += 1
-        print
-        print 'message count:', i
+    def setSpeed(self, speed):
+        logTime = self.getLogTime()
+        self.speed = speed
+        if not self.paused:
+            if logTime is None:
+                self.anchorLogTime = None
+            else:
+                self.reanchor(logTime)
+            self.scheduleSend(time.time())
+
+    def seek(self, logTime):
+        """
+        Continues the replay from the first record at or after @logTime,
+        using the log index if there is one. If @logTime is None, starts
+        from the beginning of the replay window.
+        """
+        if self.startTime is not None and (logTime is None or logTime < self.startTime):
+            logTime = self.startTime
+        self.records = self.log.select(logTime, self.endTime, self.topics)
+        self.nextRecord = next(self.records, None)
+        self.done = False
+        if logTime is None and self.nextRecord is not None:
+            logTime = self.nextRecord.timestamp
+        if self.paused:
+            self.pausedLogTime = logTime
+        else:
+            if logTime is None:
+                self.anchorLogTime = None
+            else:
+                self.reanchor(logTime)
+            self.scheduleSend(time.time())
+
+    def handle_pause(self):
+        self.pause()
+        return self.handle_status()
+
+    def handle_resume(self):
+        self.resume()
+        return self.handle_status()
+
+    def handle_seek(self, logTime):
+        self.seek(parseTime(logTime))
+        return self.handle_status()
+
+    def handle_speed(self, speed):
+        self.setSpeed(parseSpeed(speed))
+        return self.handle_status()
+
+    def handle_status(self):
+        return {'paused': self.paused,
+                'speed': self.speed or 'max',
+                'logTime': self.getLogTime(),
+                'count': self.count,
+                'done': self.done}
+
+    def handleRpcCall(self, messages):
+        for msg in messages:
+            callId = None
+            try:
+                call = json.loads(msg)
+                callId = call.get('id')
+                handler = getattr(self, 'handle_%s' % call['method'], None)
+                if handler is None:
+                    raise ValueError('unknown method %s' % call['method'])
+                params = dict(((str(k), v) for k, v in call.get('params', {}).iteritems()))
+                result = handler(**params)
+                self.rpcStream.send(json.dumps({'result': result,
+                                                'error': None,
+                                                'id': callId}))
+            except:  # pylint: disable=W0702
+                logging.exception('zmqPlayback: error handling rpc message')
+                errClass, errObject = sys.exc_info()[:2]
+                errText = '%s.%s: %s' % (errClass.__module__,
+                                         errClass.__name__,
+                                         str(errObject))
+                self.rpcStream.send(json.dumps({'result': None,
+                                                'error': errText,
+                                                'id': callId}))
 
 
 def main():
     import optparse
-    parser = optparse.OptionParser('usage: %prog <zmqCentral-messages-xxx.txt>')
-    parser.add_option('-t', '--topic',
-                      action='append',
-                      help='Only print specified topics, can specify multiple times')
-    ZmqPublisher.addOptions(parser, 'zmqPlayback')
+    parser = optparse.OptionParser('usage: %prog <zmqCentral-messages-xxx.txt> [<messages2.txt> ...]')
+    ZmqPlayback.addOptions(parser)
     opts, args = parser.parse_args()
-    if len(args) != 1:
-        parser.error('expected exactly 1 arg')
+    if not args:
+        parser.error('expected at least 1 log file argument')
+    try:
+        parseSpeed(opts.speed)
+    except ValueError:
+        parser.error('--speed must be a positive number or "max"')
     logging.basicConfig(level=logging.DEBUG)
 
-    pb = ZmqPlayback(args[0], opts)
+    pb = ZmqPlayback(args, opts)
     pb.start()
 
     zmqLoop()
 
+
 if __name__ == '__main__':
     main()
@@ -0,0 +1,180 @@
+#__BEGIN_LICENSE__
+# Copyright (c) 2017, United States Government, as represented by the
+# Administrator of the National Aeronautics and Space Administration.
+# All rights reserved.
+#
+# The GeoRef platform is licensed under the Apache License, Version 2.0
+# (the "License"); you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+# http://www.apache.org/licenses/LICENSE-2.0.
+#
+# Unless required by applicable law or agreed to in writing, software distributed
+# under the License is distributed on an "AS IS" BASIS, WITHOUT WARRANTIES OR
+# CONDITIONS OF ANY KIND, either express or implied. See the License for the
+# specific language governing permissions and limitations under the License.
+#__END_LICENSE__
+
+import os
+import sys
+import gzip
+import shutil
+import optparse
+import tempfile
+import unittest
+import StringIO
+
+from geocamUtil import anyjson as json
+from geocamUtil.zmqUtil import zmqPlayback
+from geocamUtil.zmqUtil.zmqPlayback import ZmqPlayback
+from geocamUtil.zmqUtil.util import openLogParsers
+
+NUM_RECORDS = 10
+
+
+class FakeClock(object):
+    def __init__(self):
+        self.now = 1000.0
+
+    def time(self):
+        return self.now
+
+
+class FakePublisher(object):
+    wireMode = 'single'
+
+    def __init__(self):
+        self.sent = []
+
+    def sendFrames(self, frames, topic):
+        self.sent.append(''.join([str(frame) for frame in frames]))
+
+    def flush(self):
+        pass
+
+
+class ZmqPlaybackTest(unittest.TestCase):
+    """
+    Drives the replay scheduler directly with a fake clock instead of
+    running the ioloop.
+    """
+    def setUp(self):
+        self.tmpDir = tempfile.mkdtemp(prefix='zmqPlaybackTest')
+        # one record per second of log time, in a compressed segment
+        # without an index
+        self.logPath = os.path.join(self.tmpDir, 'log.txt.gz')
+        out = gzip.open(self.logPath, 'wb')
+        for i in xrange(NUM_RECORDS):
+            msg = 'rec:{"i": %d}' % i
+            out.write('@@@ %d %d - %s\n' % ((i + 1) * 1000000, len(msg), msg))
+        out.close()
+
+        self.clock = FakeClock()
+        self.realTime = zmqPlayback.time
+        zmqPlayback.time = self.clock
+        self.realStdout = sys.stdout
+        sys.stdout = StringIO.StringIO()
+
+        self.scheduled = []
+        self.pb = self.makePlayback('--speed', '1')
+
+    def tearDown(self):
+        sys.stdout = self.realStdout
+        zmqPlayback.time = self.realTime
+        self.pb.log.close()
+        shutil.rmtree(self.tmpDir)
+
+    def makePlayback(self, *args):
+        parser = optparse.OptionParser()
+        ZmqPlayback.addOptions(parser)
+        opts, _args = parser.parse_args(list(args))
+        pb = ZmqPlayback([self.logPath], opts)
+        pb.publisher = FakePublisher()
+        pb.scheduleSend = self.scheduled.append
+        pb.cancelSend = lambda: None
+        pb.log = openLogParsers(pb.logPaths)
+        pb.seek(None)
+        pb.anchorLogTime = None
+        return pb
+
+    def getSent(self):
+        return [json.loads(msg.split(':', 1)[1])['i'] for msg in self.pb.publisher.sent]
+
+    def test_schedule(self):
+        pb = self.pb
+        pb.sendDue()
+        self.assertEqual([0], self.getSent())
+        self.assertEqual(1001.0, self.scheduled[-1])
+
+        self.clock.now = 1003.5
+        pb.sendDue()
+        self.assertEqual(4, pb.count)
+        self.assertEqual(1004.0, self.scheduled[-1])
+
+        # faster from the current log time on
+        pb.setSpeed(10)
+        self.clock.now += 0.25
+        pb.sendDue()
+        self.assertEqual(7, pb.count)
+        self.assertFalse(pb.done)
+
+        self.clock.now += 100
+        pb.sendDue()
+        self.assertEqual(NUM_RECORDS, pb.count)
+        self.assertTrue(pb.done)
+
+    def test_pauseResume(self):
+        pb = self.pb
+        pb.sendDue()
+        self.clock.now = 1002.5
+        pb.sendDue()
+        pb.pause()
+        self.assertEqual(3500000, pb.getLogTime())
+
+        # nothing is sent while paused, and the replay continues where
+        # it was paused rather than catching up
+        self.clock.now = 1100
+        pb.sendDue()
+        self.assertEqual(3, pb.count)
+        pb.resume()
+        self.assertEqual(3500000, pb.getLogTime())
+        pb.sendDue()
+        self.assertEqual(3, pb.count)
+        self.clock.now += 0.5
+        pb.sendDue()
+        self.assertEqual(4, pb.count)
+
+    def test_seek(self):
+        pb = self.pb
+        pb.sendDue()
+        self.clock.now = 1100
+        pb.sendDue()
+        self.assertTrue(pb.done)
+
+        # seeking backwards replays the segment again, even without
+        # an index
+        pb.seek(8000000)
+        self.assertFalse(pb.done)
+        pb.sendDue()
+        self.assertEqual([7], self.getSent()[NUM_RECORDS:])
+        pb.seek(2000000)
+        self.clock.now += 100
+        pb.sendDue()
+        self.assertEqual(range(1, NUM_RECORDS), self.getSent()[NUM_RECORDS + 1:])
+        self.assertTrue(pb.done)
+
+    def test_maxSpeed(self):
+        pb = self.makePlayback('--maxBatch', '4')
+        self.pb.log.close()
+        self.pb = pb
+        pb.sendDue()
+        # max speed sends in batches without waiting for the clock
+        self.assertEqual(4, pb.count)
+        self.assertEqual(self.clock.now, self.scheduled[-1])
+        pb.sendDue()
+        pb.sendDue()
+        self.assertEqual(NUM_RECORDS, pb.count)
+        self.assertTrue(pb.done)
+
+
+if __name__ == '__main__':
+    unittest.main()
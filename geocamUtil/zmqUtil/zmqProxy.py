@@ -15,13 +15,68 @@
 # specific language governing permissions and limitations under the License.
 #__END_LICENSE__
 
+"""
+Forwards bus messages to WebSocket clients.
+
+The proxy keeps one bus subscription per topic prefix, however many
+clients asked for it, and an index from each prefix to the clients
+subscribed to it. Each message is converted to its outgoing text once
+and the same string is queued for every interested client.
+
+Each client has a bounded outbound queue. Messages are only handed to
+tornado when the previous writes to that client have been flushed to
+its socket, so a client on a slow link can't make the proxy buffer an
+unbounded amount of data. When a client's queue is full, the queue
+policy of the topic of the incoming message decides what happens:
+
+  dropOldest   drop the oldest queued message
+  keepLatest   only keep the latest queued message on each topic; a
+               newer message replaces a queued one in place
+  disconnect   close the client's connection
+
+Policies are set per topic prefix with --queuePolicy. Queue depth and
+drop counts for each client are logged every --statsPeriodSecs, and are
+available from the 'stats' RPC method and at /stats/.
+
+A client can ask for batched delivery with the 'setBatch' RPC method.
+The proxy then sends the messages queued in each interval together in
+frames of the form
+
+  zmqProxy.batch:<msg1>\x1e<msg2>\x1e...
+
+where each message is 'topic:body' as usual. JSON bodies never contain
+a raw \x1e, but other bodies on the bus, such as legacy messages with
+MIME attachments, may. A message that contains the separator is never
+put in a batch; it is sent in a frame of its own, in order with the
+batches around it, so a batch frame can always be split on \x1e.
+
+A client that connects with '?deflate=1' in its URL also negotiates
+per-message deflate, at --compressionLevel.
+
+With --workers N, the proxy pre-forks N worker processes that share
+the listen port, so it can use more than one core. Each worker has its
+own subscriber connection to central and serves its own clients. Every
+WORKER_STATS_PERIOD_SECS each worker publishes its stats on an ipc PUB
+socket and subscribes to the stats of all the others, so /stats/ on any
+worker reports the totals for the whole proxy.
+"""
+
+import os
 import sys
 import traceback
 import time
+import itertools
+import collections
 
 import tornado.ioloop
 import tornado.web
-from tornado import websocket
+import tornado.netutil
+import tornado.process
+import tornado.httpserver
+from tornado import websocket, iostream
+
+import zmq
+from zmq.eventloop.zmqstream import ZMQStream
 
 from zmq.eventloop import ioloop
 ioloop.install()
@@ -29,9 +84,35 @@ ioloop.install()
 from geocamUtil import anyjson as json
 from geocamUtil.zmqUtil.util import zmqLoop
 from geocamUtil.zmqUtil.subscriber import ZmqSubscriber
+from geocamUtil.zmqUtil.messageCodec import toJsonBody
 
 # pylint: disable=W0223,E1101
 
+QUEUE_POLICIES = ('dropOldest', 'keepLatest', 'disconnect')
+DEFAULT_QUEUE_POLICY = 'dropOldest'
+DEFAULT_CLIENT_QUEUE_SIZE = 1000
+
+# max number of topics to remember the queue policy and clients for
+MAX_POLICY_CACHE = 10000
+MAX_ROUTE_CACHE = 10000
+
+# websocket close code for clients disconnected by the disconnect policy
+CLOSE_CODE_TOO_SLOW = 1008
+
+BATCH_TOPIC = 'zmqProxy.batch'
+BATCH_SEPARATOR = '\x1e'
+DEFAULT_BATCH_MESSAGES = 500
+DEFAULT_COMPRESSION_LEVEL = 6
+
+# how often workers share their stats, and when to forget a worker that
+# stopped sending them
+WORKER_STATS_PERIOD_SECS = 1
+WORKER_STATS_TIMEOUT_SECS = 5
+DEFAULT_WORKER_STATS_ENDPOINT = 'ipc:///tmp/zmqProxy-{port}-stats-{worker}'
+
+# client stats that are summed into worker and proxy totals
+SUMMED_STATS = ('queueDepth', 'sent', 'frames', 'dropped', 'replaced')
+
 proxyG = None
 
 
@@ -110,13 +191,48 @@ class MainHandler(tornado.web.RequestHandler):
         self.write("The zmqProxy server forwards 0MQ messages via WebSockets. Point your WebSockets subscriber at ws://hostname:port/zmq/")
 
 
+class StatsHandler(tornado.web.RequestHandler):
+    def get(self):
+        self.set_header('Content-Type', 'application/json')
+        self.write(json.dumps(proxyG.getStats(), sort_keys=True, indent=4))
+
+
 class ClientSocket(websocket.WebSocketHandler, JsonRpcService):
     def __init__(self, *args, **kwargs):
         super(ClientSocket, self).__init__(*args, **kwargs)
         self.handlers = {}
+        self.clientId = None
+        self.closed = False
+
+        # the queue holds (topic, text) pairs. for keepLatest topics it
+        # holds (topic, None) and the text is kept in self.latest, so a
+        # newer message can replace it without moving it in the queue.
+        self.queue = collections.deque()
+        self.latest = {}
+        self.maxQueueSize = proxyG.opts.clientQueueSize
+        self.writing = False
+
+        # batching is off until the client asks for it
+        self.batchMsecs = 0
+        self.batchMessages = DEFAULT_BATCH_MESSAGES
+        self.flushTimeout = None
+
+        self.numSent = 0
+        self.numDropped = 0
+        self.numReplaced = 0
+        self.maxQueueDepth = 0
+        self.numFrames = 0
+
+    def get_compression_options(self):
+        # per-message deflate is only negotiated with clients that ask
+        if proxyG.opts.compressionLevel and self.get_argument('deflate', None) == '1':
+            return {'compression_level': proxyG.opts.compressionLevel}
+        return None
 
     def open(self):
-        print "WebSocket opened"
+        self.clientId = '%s#%d.%d' % (self.request.remote_ip, proxyG.workerId, next(proxyG.clientCounter))
+        proxyG.clients[self.clientId] = self
+        print "WebSocket opened", self.clientId
 
     def writeResponse(self, response):
         self.write_message('zmqProxy.response:' + json.dumps(response))
@@ -127,12 +243,28 @@ class ClientSocket(websocket.WebSocketHandler, JsonRpcService):
     def handle_time(self):
         return time.time()
 
+    def handle_stats(self):
+        return self.getStats()
+
+    def handle_setBatch(self, intervalMsecs, maxMessages=DEFAULT_BATCH_MESSAGES):
+        """
+        Batches the messages sent to this client, sending at most one
+        frame of up to @maxMessages messages every @intervalMsecs.
+        @intervalMsecs 0 turns batching off.
+        """
+        if intervalMsecs < 0 or maxMessages < 1:
+            raise ValueError('expected intervalMsecs >= 0 and maxMessages >= 1')
+        self.batchMsecs = intervalMsecs
+        self.batchMessages = maxMessages
+        return {'intervalMsecs': self.batchMsecs,
+                'maxMessages': self.batchMessages}
+
     def handle_subscribe(self, topicPrefix):
         topicPrefix = topicPrefix.encode('utf-8')
         print >> sys.stderr, 'Client subscribing to topicPrefix "%s"' % topicPrefix
         handlerInfo = self.handlers.setdefault(topicPrefix, {'refCount': 0})
         if handlerInfo['refCount'] == 0:
-            handlerInfo['handlerId'] = proxyG.subscriber.subscribeRaw(topicPrefix, self.forward)
+            proxyG.subscribe(self, topicPrefix)
         handlerInfo['refCount'] += 1
         return topicPrefix
 
@@ -141,37 +273,346 @@ class ClientSocket(websocket.WebSocketHandler, JsonRpcService):
         handlerInfo = self.handlers[topicPrefix]
         handlerInfo['refCount'] -= 1
         if handlerInfo['refCount'] == 0:
-            proxyG.subscriber.unsubscribe(handlerInfo['handlerId'])
+            proxyG.unsubscribe(self, topicPrefix)
             del self.handlers[topicPrefix]
         return 'ok'
 
-    def forward(self, topic, msg):
-        # print >> sys.stderr, 'forward %s %s' % (topic, msg)
-        self.write_message(''.join((topic, ':', msg)))
+    def enqueue(self, topic, text, policy):
+        """
+        Queues message @text, which has topic @topic, for sending.
+        @policy is the queue policy for @topic.
+        """
+        if self.closed:
+            return
+        if policy == 'keepLatest':
+            if topic in self.latest:
+                self.latest[topic] = text
+                self.numReplaced += 1
+                return
+        if len(self.queue) >= self.maxQueueSize:
+            if policy == 'disconnect':
+                print >> sys.stderr, ('Client %s queue full with %d messages, disconnecting'
+                                      % (self.clientId, len(self.queue)))
+                self.disconnect()
+                return
+            oldTopic, oldText = self.queue.popleft()
+            if oldText is None:
+                del self.latest[oldTopic]
+            self.numDropped += 1
+
+        if policy == 'keepLatest':
+            self.latest[topic] = text
+            self.queue.append((topic, None))
+        else:
+            self.queue.append((topic, text))
+        if len(self.queue) > self.maxQueueDepth:
+            self.maxQueueDepth = len(self.queue)
+
+        self.scheduleFlush()
+
+    def scheduleFlush(self):
+        if self.writing:
+            # flushQueue() will be called when the current write finishes
+            return
+        if not self.batchMsecs or len(self.queue) >= self.batchMessages:
+            self.flushQueue()
+        elif self.flushTimeout is None:
+            self.flushTimeout = (tornado.ioloop.IOLoop.current()
+                                 .call_later(self.batchMsecs / 1000.0, self.flushQueue))
+
+    def flushQueue(self):
+        """
+        Writes the queued messages to the client. Called again when
+        tornado has flushed them to the socket, so at most one queue's
+        worth of messages is ever buffered by tornado.
+        """
+        self.cancelFlush()
+        if self.closed or not self.queue:
+            return
+        queue = self.queue
+        latest = self.latest
+        batch = []
+        batchMessages = self.batchMessages if self.batchMsecs else 1
+        try:
+            while queue:
+                topic, text = queue.popleft()
+                if text is None:
+                    text = latest.pop(topic)
+                if batchMessages > 1 and BATCH_SEPARATOR in text:
+                    # can't be batched unambiguously, send it by itself
+                    if batch:
+                        writeFuture = self.writeBatch(batch)
+                        batch = []
+                    writeFuture = self.writeBatch([text])
+                    continue
+                batch.append(text)
+                if len(batch) >= batchMessages:
+                    writeFuture = self.writeBatch(batch)
+                    batch = []
+            if batch:
+                writeFuture = self.writeBatch(batch)
+        except (websocket.WebSocketClosedError, iostream.StreamClosedError):
+            self.disconnect()
+            return
+        self.writing = True
+        tornado.ioloop.IOLoop.current().add_future(writeFuture, self.writeDone)
+
+    def writeBatch(self, batch):
+        self.numSent += len(batch)
+        self.numFrames += 1
+        if len(batch) == 1:
+            return self.write_message(batch[0])
+        return self.write_message(''.join((BATCH_TOPIC, ':', BATCH_SEPARATOR.join(batch))))
+
+    def writeDone(self, _future):
+        self.writing = False
+        if self.queue:
+            self.scheduleFlush()
+
+    def disconnect(self):
+        if not self.closed:
+            self.closed = True
+            self.queue.clear()
+            self.latest.clear()
+            self.cancelFlush()
+            self.close(CLOSE_CODE_TOO_SLOW, 'client too slow')
+
+    def cancelFlush(self):
+        if self.flushTimeout is not None:
+            tornado.ioloop.IOLoop.current().remove_timeout(self.flushTimeout)
+            self.flushTimeout = None
+
+    def getStats(self):
+        return {'clientId': self.clientId,
+                'queueDepth': len(self.queue),
+                'maxQueueDepth': self.maxQueueDepth,
+                'sent': self.numSent,
+                'frames': self.numFrames,
+                'dropped': self.numDropped,
+                'replaced': self.numReplaced,
+                'closed': self.closed}
 
     def on_close(self):
-        print "WebSocket closed"
-        for handlerInfo in self.handlers.itervalues():
-            proxyG.subscriber.unsubscribe(handlerInfo['handlerId'])
+        print "WebSocket closed", self.clientId
+        self.closed = True
+        self.queue.clear()
+        self.latest.clear()
+        self.cancelFlush()
+        proxyG.clients.pop(self.clientId, None)
+        for topicPrefix in self.handlers.iterkeys():
+            proxyG.unsubscribe(self, topicPrefix)
+        self.handlers = {}
+
+
+def parseQueuePolicies(specs):
+    """
+    Parses 'prefix=policy' strings into a list of (prefix, policy)
+    pairs, longest prefix first.
+    """
+    policies = []
+    for spec in specs:
+        prefix, sep, policy = spec.rpartition('=')
+        if not sep or policy not in QUEUE_POLICIES:
+            raise ValueError('bad queue policy "%s", expected prefix=policy with policy one of %s'
+                             % (spec, ', '.join(QUEUE_POLICIES)))
+        policies.append((prefix, policy))
+    policies.sort(key=lambda item: -len(item[0]))
+    return policies
+
+
+def getWorkerStatsEndpoint(opts, workerId):
+    return (opts.workerStatsEndpoint
+            .replace('{port}', str(opts.port))
+            .replace('{worker}', str(workerId)))
 
 
 class ZmqProxy(object):
-    def __init__(self, opts):
+    def __init__(self, opts, workerId=0, numWorkers=1):
         self.opts = opts
+        self.workerId = workerId
+        self.numWorkers = numWorkers
+        self.queuePolicies = parseQueuePolicies(opts.queuePolicy or [])
+        self.policyCache = {}
+        # topicPrefix -> {'handlerId': ..., 'clients': set of clients}
+        self.subscriptions = {}
+        self.routeCache = {}
+        self.clients = {}
+        self.clientCounter = itertools.count(1)
+        self.statsTimer = None
+        self.numReceived = 0
+
+        # workerId -> (receive time, stats) for the other workers
+        self.workerStats = {}
+        self.workerStatsPub = None
+        self.workerStatsSub = None
+        self.workerStatsTimer = None
 
         self.subscriber = ZmqSubscriber(**ZmqSubscriber.getOptionValues(self.opts))
         self.application = tornado.web.Application([
             (r"^/?$", MainHandler),
             (r"^/zmq/$", ClientSocket),
+            (r"^/stats/?$", StatsHandler),
         ])
 
-    def start(self):
+    def subscribe(self, client, topicPrefix):
+        subscription = self.subscriptions.get(topicPrefix)
+        if subscription is None:
+            handlerId = self.subscriber.subscribeRaw(topicPrefix,
+                                                     lambda topic, msg: self.forward(topicPrefix, topic, msg))
+            subscription = {'handlerId': handlerId, 'clients': set()}
+            self.subscriptions[topicPrefix] = subscription
+        subscription['clients'].add(client)
+        self.routeCache.clear()
+
+    def unsubscribe(self, client, topicPrefix):
+        subscription = self.subscriptions[topicPrefix]
+        subscription['clients'].discard(client)
+        if not subscription['clients']:
+            self.subscriber.unsubscribe(subscription['handlerId'])
+            del self.subscriptions[topicPrefix]
+        self.routeCache.clear()
+
+    def getRoute(self, topic):
+        """
+        Returns (topicPrefix, clients), where topicPrefix is the longest
+        subscribed prefix of @topic and clients is the tuple of clients
+        subscribed to any prefix of @topic. The route is cached until
+        subscriptions change.
+        """
+        route = self.routeCache.get(topic)
+        if route is None:
+            topicColon = topic + ':'
+            longestPrefix = None
+            clients = set()
+            for i in xrange(len(topicColon) + 1):
+                subscription = self.subscriptions.get(topicColon[:i])
+                if subscription:
+                    longestPrefix = topicColon[:i]
+                    clients.update(subscription['clients'])
+            route = (longestPrefix, tuple(clients))
+            if len(self.routeCache) >= MAX_ROUTE_CACHE:
+                self.routeCache.clear()
+            self.routeCache[topic] = route
+        return route
+
+    def forward(self, topicPrefix, topic, msg):
+        # print >> sys.stderr, 'forward %s %s' % (topic, msg)
+        longestPrefix, clients = self.getRoute(topic)
+        if topicPrefix != longestPrefix:
+            # the subscriber calls the handler of each matching prefix.
+            # only the longest one forwards, so each client gets the
+            # message once even if it subscribed to several prefixes.
+            return
+        self.numReceived += 1
+        policy = self.getQueuePolicy(topic)
+        # web clients only understand JSON
+        text = ''.join((topic, ':', toJsonBody(msg)))
+        for client in clients:
+            client.enqueue(topic, text, policy)
+
+    def getQueuePolicy(self, topic):
+        policy = self.policyCache.get(topic)
+        if policy is None:
+            policy = self.opts.defaultQueuePolicy
+            topicColon = topic + ':'
+            for prefix, prefixPolicy in self.queuePolicies:
+                if topicColon.startswith(prefix):
+                    policy = prefixPolicy
+                    break
+            if len(self.policyCache) >= MAX_POLICY_CACHE:
+                self.policyCache.clear()
+            self.policyCache[topic] = policy
+        return policy
+
+    def getWorkerStats(self):
+        """
+        Returns the stats of this worker and its clients.
+        """
+        clients = [client.getStats() for _clientId, client in sorted(self.clients.iteritems())]
+        stats = {'worker': self.workerId,
+                 'pid': os.getpid(),
+                 'numClients': len(clients),
+                 'subscriptions': len(self.subscriptions),
+                 'received': self.numReceived,
+                 'clients': clients}
+        for key in SUMMED_STATS:
+            stats[key] = sum([clientStats[key] for clientStats in clients])
+        return stats
+
+    def getStats(self):
+        """
+        Returns the stats of all the workers that reported recently and
+        their totals.
+        """
+        now = time.time()
+        workers = [self.getWorkerStats()]
+        for workerId, (receiveTime, stats) in sorted(self.workerStats.iteritems()):
+            if workerId != self.workerId and now - receiveTime < WORKER_STATS_TIMEOUT_SECS:
+                workers.append(stats)
+        workers.sort(key=lambda stats: stats['worker'])
+        totals = {'numWorkers': len(workers)}
+        for key in ('numClients', 'received') + SUMMED_STATS:
+            totals[key] = sum([stats[key] for stats in workers])
+        return {'totals': totals,
+                'workers': workers}
+
+    def printStats(self):
+        for stats in self.getWorkerStats()['clients']:
+            print >> sys.stderr, ('Client %(clientId)s: queue %(queueDepth)d (max %(maxQueueDepth)d),'
+                                  ' sent %(sent)d in %(frames)d frames, dropped %(dropped)d, replaced %(replaced)d' % stats)
+        if self.numWorkers > 1 and self.workerId == 0:
+            print >> sys.stderr, ('Proxy totals: %(numWorkers)d workers, %(numClients)d clients,'
+                                  ' received %(received)d, sent %(sent)d, dropped %(dropped)d' % self.getStats()['totals'])
+
+    def publishWorkerStats(self):
+        self.workerStatsPub.send(json.dumps(self.getWorkerStats()))
+
+    def handleWorkerStats(self, messages):
+        for msg in messages:
+            try:
+                stats = json.loads(msg)
+                self.workerStats[stats['worker']] = (time.time(), stats)
+            except (ValueError, KeyError, TypeError):
+                print >> sys.stderr, 'Bad worker stats message: %s' % msg[:100]
+
+    def startWorkerStats(self):
+        context = zmq.Context.instance()
+        self.workerStatsPub = context.socket(zmq.PUB)
+        self.workerStatsPub.bind(getWorkerStatsEndpoint(self.opts, self.workerId))
+        sub = context.socket(zmq.SUB)
+        sub.setsockopt(zmq.SUBSCRIBE, '')
+        for workerId in xrange(self.numWorkers):
+            if workerId != self.workerId:
+                sub.connect(getWorkerStatsEndpoint(self.opts, workerId))
+        self.workerStatsSub = ZMQStream(sub)
+        self.workerStatsSub.on_recv(self.handleWorkerStats)
+        self.workerStatsTimer = ioloop.PeriodicCallback(self.publishWorkerStats,
+                                                        WORKER_STATS_PERIOD_SECS * 1000)
+        self.workerStatsTimer.start()
+
+    def start(self, sockets=None):
+        """
+        Starts the proxy. If @sockets is given, serves web clients on
+        those already-bound listen sockets instead of binding the port.
+        """
         # initialize zmq
         self.subscriber.start()
+        if self.numWorkers > 1:
+            self.startWorkerStats()
+
+        if self.opts.statsPeriodSecs > 0:
+            self.statsTimer = ioloop.PeriodicCallback(self.printStats,
+                                                      self.opts.statsPeriodSecs * 1000)
+            self.statsTimer.start()
 
         # start serving web clients
-        print 'binding to port %d' % self.opts.port
-        self.application.listen(self.opts.port)
+        if sockets is None:
+            print 'binding to port %d' % self.opts.port
+            self.application.listen(self.opts.port)
+        else:
+            print 'worker %d (pid %d) serving port %d' % (self.workerId, os.getpid(), self.opts.port)
+            server = tornado.httpserver.HTTPServer(self.application)
+            server.add_sockets(sockets)
 
 
 def main():
@@ -180,14 +621,48 @@ def main():
     parser.add_option('-p', '--port',
                       type='int', default=8001,
                       help='TCP port where websocket server should listen [%default]')
+    parser.add_option('--clientQueueSize',
+                      type='int', default=DEFAULT_CLIENT_QUEUE_SIZE,
+                      help='Max messages queued for each client [%default]')
+    parser.add_option('--defaultQueuePolicy',
+                      type='choice', choices=QUEUE_POLICIES, default=DEFAULT_QUEUE_POLICY,
+                      help='What to do when a client queue is full: %s [%%default]' % ', '.join(QUEUE_POLICIES))
+    parser.add_option('--queuePolicy',
+                      action='append',
+                      help='Queue policy for topics with a prefix, as prefix=policy, can specify multiple times')
+    parser.add_option('--compressionLevel',
+                      type='int', default=DEFAULT_COMPRESSION_LEVEL,
+                      help='Deflate level for clients that ask for compression, or 0 to never compress [%default]')
+    parser.add_option('-w', '--workers',
+                      type='int', default=1,
+                      help='Number of worker processes sharing the port, or 0 for one per core [%default]')
+    parser.add_option('--workerStatsEndpoint',
+                      default=DEFAULT_WORKER_STATS_ENDPOINT,
+                      help='Endpoint template where each worker publishes its stats [%default]')
+    parser.add_option('--statsPeriodSecs',
+                      type='float', default=60,
+                      help='How often to log client queue stats, or 0 to disable [%default]')
     ZmqSubscriber.addOptions(parser, 'zmqProxy')
     opts, args = parser.parse_args()
     if args:
         parser.error('expected no args')
+    try:
+        parseQueuePolicies(opts.queuePolicy or [])
+    except ValueError, err:
+        parser.error(str(err))
 
     global proxyG
-    proxyG = ZmqProxy(opts)
-    proxyG.start()
+    if opts.workers == 1:
+        proxyG = ZmqProxy(opts)
+        proxyG.start()
+    else:
+        numWorkers = opts.workers or tornado.process.cpu_count()
+        # bind before forking so the workers share the listen socket.
+        # zmq and the ioloop must only be set up after the fork.
+        sockets = tornado.netutil.bind_sockets(opts.port)
+        workerId = tornado.process.fork_processes(numWorkers)
+        proxyG = ZmqProxy(opts, workerId, numWorkers)
+        proxyG.start(sockets)
 
     zmqLoop()
 
@@ -0,0 +1,282 @@
+#__BEGIN_LICENSE__
+# Copyright (c) 2017, United States Government, as represented by the
+# Administrator of the National Aeronautics and Space Administration.
+# All rights reserved.
+#
+# The GeoRef platform is licensed under the Apache License, Version 2.0
+# (the "License"); you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+# http://www.apache.org/licenses/LICENSE-2.0.
+#
+# Unless required by applicable law or agreed to in writing, software distributed
+# under the License is distributed on an "AS IS" BASIS, WITHOUT WARRANTIES OR
+# CONDITIONS OF ANY KIND, either express or implied. See the License for the
+# specific language governing permissions and limitations under the License.
+#__END_LICENSE__
+
+import sys
+import time
+import unittest
+import StringIO
+
+import tornado.httputil
+from tornado.concurrent import Future
+
+from geocamUtil import anyjson as json
+from geocamUtil.zmqUtil import zmqProxy
+from geocamUtil.zmqUtil.zmqProxy import (ZmqProxy,
+                                         ClientSocket,
+                                         parseQueuePolicies,
+                                         getWorkerStatsEndpoint,
+                                         BATCH_TOPIC,
+                                         BATCH_SEPARATOR,
+                                         CLOSE_CODE_TOO_SLOW,
+                                         WORKER_STATS_TIMEOUT_SECS,
+                                         DEFAULT_QUEUE_POLICY)
+
+
+class ProxyOpts(object):
+    clientQueueSize = 5
+    defaultQueuePolicy = DEFAULT_QUEUE_POLICY
+    compressionLevel = 0
+    statsPeriodSecs = 0
+    moduleName = 'zmqProxyTest'
+    port = 8001
+    workerStatsEndpoint = 'ipc:///tmp/zmqProxyTest-{port}-stats-{worker}'
+
+    def __init__(self, queuePolicy=None):
+        self.queuePolicy = queuePolicy
+
+
+class FakeConnection(object):
+    def set_close_callback(self, callback):
+        pass
+
+
+class FakeClientSocket(ClientSocket):
+    """
+    Records the frames written to the client instead of sending them.
+    Writes stay pending until the test calls finishWrites().
+    """
+    def __init__(self):
+        request = tornado.httputil.HTTPServerRequest(method='GET',
+                                                     uri='/zmq/',
+                                                     connection=FakeConnection())
+        super(FakeClientSocket, self).__init__(zmqProxy.proxyG.application, request)
+        self.frames = []
+        self.closeCode = None
+
+    def write_message(self, message, binary=False):
+        self.frames.append(message)
+        return Future()
+
+    def close(self, code=None, reason=None):
+        self.closeCode = code
+
+    def finishWrites(self):
+        self.writeDone(None)
+
+
+class ZmqProxyTest(unittest.TestCase):
+    def setUp(self):
+        self.realStdout = sys.stdout
+        self.realStderr = sys.stderr
+        sys.stdout = StringIO.StringIO()
+        sys.stderr = StringIO.StringIO()
+        self.setProxy(ProxyOpts())
+
+    def tearDown(self):
+        sys.stdout = self.realStdout
+        sys.stderr = self.realStderr
+        zmqProxy.proxyG = None
+
+    def setProxy(self, opts, workerId=0, numWorkers=1):
+        self.proxy = ZmqProxy(opts, workerId, numWorkers)
+        zmqProxy.proxyG = self.proxy
+
+    def makeClient(self, *topicPrefixes):
+        client = FakeClientSocket()
+        client.open()
+        for topicPrefix in topicPrefixes:
+            client.handle_subscribe(topicPrefix)
+        return client
+
+    def publish(self, topic, body):
+        self.proxy.subscriber.routeMessage('%s:%s' % (topic, body))
+
+    def test_batchFraming(self):
+        client = self.makeClient('rover.')
+        client.handle_setBatch(100, maxMessages=3)
+        legacyBody = 'Content-Type: multipart/mixed\n\n' + BATCH_SEPARATOR + '\n'
+        for i in xrange(4):
+            self.publish('rover.pose', '{"i": %d}' % i)
+        self.publish('rover.image', legacyBody)
+        self.publish('rover.pose', '{"i": 4}')
+        # the full batch went out as soon as it had maxMessages
+        self.assertEqual([BATCH_TOPIC + ':' + BATCH_SEPARATOR.join(['rover.pose:{"i": %d}' % i
+                                                                    for i in xrange(3)])],
+                         client.frames)
+
+        client.finishWrites()
+        client.flushQueue()
+        # a message containing the separator is sent in a frame of its
+        # own, in order, and a lone message isn't wrapped in a batch
+        self.assertEqual(['rover.pose:{"i": 3}',
+                          'rover.image:' + legacyBody,
+                          'rover.pose:{"i": 4}'],
+                         client.frames[1:])
+        self.assertEqual(6, client.getStats()['sent'])
+        self.assertEqual(4, client.getStats()['frames'])
+        for frame in client.frames:
+            if frame.startswith(BATCH_TOPIC + ':'):
+                for msg in frame[(len(BATCH_TOPIC) + 1):].split(BATCH_SEPARATOR):
+                    self.assertTrue(msg.startswith('rover.pose:'))
+
+    def test_dropOldest(self):
+        client = self.makeClient('rover.')
+        for i in xrange(9):
+            self.publish('rover.pose', '{"i": %d}' % i)
+        # the first message is being written, the queue holds the
+        # latest 5 of the rest
+        stats = client.getStats()
+        self.assertEqual(5, stats['queueDepth'])
+        self.assertEqual(5, stats['maxQueueDepth'])
+        self.assertEqual(3, stats['dropped'])
+
+        client.finishWrites()
+        self.assertEqual(['rover.pose:{"i": %d}' % i for i in (0, 4, 5, 6, 7, 8)],
+                         client.frames)
+        self.assertEqual(0, client.getStats()['queueDepth'])
+
+    def test_keepLatest(self):
+        self.setProxy(ProxyOpts(['rover.pose=keepLatest']))
+        client = self.makeClient('rover.')
+        self.publish('rover.pose', '0')
+        self.publish('rover.pose', '1')
+        self.publish('rover.note', '1')
+        self.publish('rover.pose', '2')
+        self.publish('rover.pose', '3')
+        # newer poses replace the queued one in place
+        self.assertEqual(2, client.getStats()['replaced'])
+        self.assertEqual(2, client.getStats()['queueDepth'])
+        client.finishWrites()
+        self.assertEqual(['rover.pose:0', 'rover.pose:3', 'rover.note:1'], client.frames)
+
+    def test_keepLatestDropped(self):
+        self.setProxy(ProxyOpts(['rover.pose=keepLatest']))
+        client = self.makeClient('rover.')
+        self.publish('rover.note', '0')
+        self.publish('rover.pose', '0')
+        for i in xrange(1, 6):
+            self.publish('rover.note', str(i))
+        # the queued pose was dropped to make room, so a new one is
+        # queued again instead of replacing it
+        self.assertEqual(1, client.getStats()['dropped'])
+        self.publish('rover.pose', '1')
+        client.finishWrites()
+        self.assertEqual(['rover.note:0', 'rover.note:2', 'rover.note:3', 'rover.note:4',
+                          'rover.note:5', 'rover.pose:1'],
+                         client.frames)
+
+    def test_disconnect(self):
+        self.setProxy(ProxyOpts(['rover.=disconnect']))
+        slowClient = self.makeClient('rover.')
+        otherClient = self.makeClient('rover.')
+        for i in xrange(7):
+            self.publish('rover.pose', '{"i": %d}' % i)
+            otherClient.finishWrites()
+        self.assertEqual(CLOSE_CODE_TOO_SLOW, slowClient.closeCode)
+        self.assertTrue(slowClient.getStats()['closed'])
+        self.assertEqual(0, slowClient.getStats()['queueDepth'])
+        # other clients aren't affected
+        self.assertEqual(7, len(otherClient.frames))
+        self.assertEqual(None, otherClient.closeCode)
+
+    def test_parseQueuePolicies(self):
+        self.assertEqual([('rover.pose', 'keepLatest'), ('rover.', 'disconnect'), ('', 'dropOldest')],
+                         parseQueuePolicies(['rover.=disconnect', '=dropOldest', 'rover.pose=keepLatest']))
+        self.assertRaises(ValueError, parseQueuePolicies, ['rover.'])
+        self.assertRaises(ValueError, parseQueuePolicies, ['rover.=dropNewest'])
+
+    def test_sharedSubscription(self):
+        clients = [self.makeClient('rover.') for _i in xrange(3)]
+        # one bus subscription serves all the clients
+        self.assertEqual(1, len(self.proxy.subscriber.handlers['rover.']))
+        self.assertEqual(set(clients), self.proxy.subscriptions['rover.']['clients'])
+
+        self.publish('rover.pose', '{"x": 1}')
+        self.assertEqual(1, self.proxy.numReceived)
+        for client in clients:
+            self.assertEqual(['rover.pose:{"x": 1}'], client.frames)
+        # the message is formatted once for all clients
+        self.assertTrue(clients[0].frames[0] is clients[1].frames[0])
+
+        clients[0].on_close()
+        clients[1].handle_unsubscribe('rover.')
+        self.assertEqual(set([clients[2]]), self.proxy.subscriptions['rover.']['clients'])
+        clients[2].on_close()
+        self.assertEqual({}, self.proxy.subscriptions)
+        self.assertFalse('rover.' in self.proxy.subscriber.handlers)
+
+    def test_overlappingPrefixes(self):
+        both = self.makeClient('rover.', 'rover.pose:')
+        broad = self.makeClient('rover.')
+        narrow = self.makeClient('rover.pose:')
+        self.publish('rover.pose', '1')
+        both.finishWrites()
+        broad.finishWrites()
+        self.publish('rover.note', '1')
+        # each client gets each message once
+        self.assertEqual(['rover.pose:1', 'rover.note:1'], both.frames)
+        self.assertEqual(['rover.pose:1', 'rover.note:1'], broad.frames)
+        self.assertEqual(['rover.pose:1'], narrow.frames)
+        self.assertEqual(2, self.proxy.numReceived)
+
+        # routes are recomputed when subscriptions change
+        broad.handle_unsubscribe('rover.')
+        self.publish('rover.pose', '2')
+        self.assertEqual(['rover.pose:1', 'rover.note:1'], broad.frames)
+        longestPrefix, routeClients = self.proxy.getRoute('rover.pose')
+        self.assertEqual('rover.pose:', longestPrefix)
+        self.assertEqual(set([both, narrow]), set(routeClients))
+
+    def test_workerStats(self):
+        # worker 1 runs in another process, with a client of its own
+        self.setProxy(ProxyOpts(), workerId=1, numWorkers=2)
+        worker1 = self.proxy
+        client1 = self.makeClient('rover.')
+        for i in xrange(3):
+            self.publish('rover.pose', str(i))
+        self.setProxy(ProxyOpts(), workerId=0, numWorkers=2)
+        client0 = self.makeClient('rover.')
+        self.publish('rover.pose', '0')
+        self.assertTrue(client0.clientId.endswith('#0.1'))
+        self.assertTrue(client1.clientId.endswith('#1.1'))
+
+        self.proxy.handleWorkerStats([json.dumps(worker1.getWorkerStats())])
+        stats = self.proxy.getStats()
+        self.assertEqual([0, 1], [workerStats['worker'] for workerStats in stats['workers']])
+        totals = stats['totals']
+        self.assertEqual(2, totals['numWorkers'])
+        self.assertEqual(2, totals['numClients'])
+        self.assertEqual(4, totals['received'])
+        self.assertEqual(2, totals['sent'])
+        self.assertEqual(2, totals['queueDepth'])
+
+        # stats from workers that stopped reporting are left out
+        self.proxy.workerStats[1] = (time.time() - WORKER_STATS_TIMEOUT_SECS - 1,
+                                     self.proxy.workerStats[1][1])
+        self.assertEqual(1, self.proxy.getStats()['totals']['numWorkers'])
+
+    def test_badWorkerStats(self):
+        self.proxy.handleWorkerStats(['not json', '{"pid": 1}', '[]'])
+        self.assertEqual({}, self.proxy.workerStats)
+        self.assertEqual(3, sys.stderr.getvalue().count('Bad worker stats message'))
+
+    def test_workerStatsEndpoint(self):
+        self.assertEqual('ipc:///tmp/zmqProxyTest-8001-stats-3',
+                         getWorkerStatsEndpoint(ProxyOpts(), 3))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -15,46 +15,322 @@
 # specific language governing permissions and limitations under the License.
 #__END_LICENSE__
 
+"""
+Splits message logs into one log per topic, named
+<topic>-zmq-messages.txt.
+
+Records are buffered in memory per topic and written out in large
+chunks whenever --maxBufferedBytes are buffered. Output files are kept
+open in a pool of at most --maxOpenFiles handles, closing the least
+recently used one when the pool is full, so any number of topics can
+be written without running out of file descriptors.
+
+With --jobs N, input logs are split in N worker processes, each into
+its own partition directory, and the partitions for each topic are
+joined in input order afterwards. With --sortByTime, the records for
+each topic are instead merge sorted by timestamp, using sorted runs on
+disk so memory use stays bounded.
+"""
+
+import os
+import shutil
 import logging
+import tempfile
+import multiprocessing
+from collections import OrderedDict
+from cStringIO import StringIO
 
-from geocamUtil.zmqUtil.util import LogParser
+from geocamUtil.zmqUtil.util import openLogParser, MergedLogParser
 
+DEFAULT_MAX_OPEN_FILES = 256
+DEFAULT_BUFFER_SIZE = 1024 * 1024
+DEFAULT_MAX_BUFFERED_BYTES = 64 * 1024 * 1024
+DEFAULT_RUN_RECORDS = 100000
+OUTPUT_SUFFIX = '-zmq-messages.txt'
 
-def sortLogs(opts, logPaths):
-    outFiles = {}
 
+class OutputFilePool(object):
+    """
+    Writes log records to one file per topic in @outDir. Records are
+    buffered until @maxBufferedBytes are pending, and at most
+    @maxOpenFiles files are kept open.
+    """
+    def __init__(self, outDir, maxOpenFiles=DEFAULT_MAX_OPEN_FILES,
+                 maxBufferedBytes=DEFAULT_MAX_BUFFERED_BYTES):
+        self.outDir = outDir
+        self.maxOpenFiles = maxOpenFiles
+        self.maxBufferedBytes = maxBufferedBytes
+        self.openFiles = OrderedDict()
+        self.buffers = {}
+        self.bufferedBytes = 0
+        self.topics = set()
+        self.numReopened = 0
+
+    def getPath(self, topic):
+        return getOutputPath(self.outDir, topic)
+
+    def write(self, rec):
+        buf = self.buffers.get(rec.topic)
+        if buf is None:
+            buf = StringIO()
+            self.buffers[rec.topic] = buf
+        start = buf.tell()
+        rec.writeTo(buf)
+        self.bufferedBytes += buf.tell() - start
+        if self.bufferedBytes >= self.maxBufferedBytes:
+            self.flush()
+
+    def flush(self):
+        # write topics with open files first, before they get evicted
+        topics = [topic for topic in self.openFiles.iterkeys() if topic in self.buffers]
+        topics += [topic for topic in self.buffers.iterkeys() if topic not in self.openFiles]
+        for topic in topics:
+            self.getFile(topic).write(self.buffers[topic].getvalue())
+        self.buffers = {}
+        self.bufferedBytes = 0
+
+    def getFile(self, topic):
+        outFile = self.openFiles.pop(topic, None)
+        if outFile is None:
+            if len(self.openFiles) >= self.maxOpenFiles:
+                _lruTopic, lruFile = self.openFiles.popitem(last=False)
+                lruFile.close()
+            if topic in self.topics:
+                mode = 'ab'
+                self.numReopened += 1
+            else:
+                # first time this run, overwrite any old output
+                mode = 'wb'
+                self.topics.add(topic)
+            outFile = open(self.getPath(topic), mode)
+        # move to the most recently used end
+        self.openFiles[topic] = outFile
+        return outFile
+
+    def close(self):
+        self.flush()
+        for outFile in self.openFiles.itervalues():
+            outFile.close()
+        self.openFiles.clear()
+
+
+def getOutputPath(outDir, topic):
+    return os.path.join(outDir, topic + OUTPUT_SUFFIX)
+
+
+def splitLog(logPath, pool, quiet=False):
+    """
+    Appends the records of the log at @logPath to the per-topic files
+    of OutputFilePool @pool.
+    """
+    print '=== processing %s' % logPath
+    logStream = openLogParser(logPath)
     i = 0
-    for logPath in logPaths:
-        print '=== processing %s' % logPath
-        logFile = open(logPath, 'rb')
-        logStream = LogParser(logFile)
-        for rec in logStream:
-            topic, _body = rec.msg.split(':', 1)
+    for rec in logStream:
+        pool.write(rec)
+        i += 1
+        if i % 10000 == 0 and not quiet:
+            print 'processed %d records from %s, %d topics found so far' % (i, logPath, len(pool.topics))
+    logStream.close()
+
 
-            outFile = outFiles.get(topic)
-            if outFile is None:
-                outPath = '%s-zmq-messages.txt' % topic
-                outFile = open(outPath, 'wb')
-                outFiles[topic] = outFile
+def splitLogWorker(args):
+    """
+    Splits one log into its own partition directory. Returns the set of
+    topics written.
+    """
+    logPath, partDir, maxOpenFiles, maxBufferedBytes, quiet = args
+    pool = OutputFilePool(partDir, maxOpenFiles, maxBufferedBytes)
+    splitLog(logPath, pool, quiet)
+    pool.close()
+    return pool.topics
 
+
+def isSorted(records):
+    for i in xrange(1, len(records)):
+        if records[i].timestamp < records[i - 1].timestamp:
+            return False
+    return True
+
+
+def writeRecords(records, path, bufferSize):
+    with open(path, 'wb', bufferSize) as outFile:
+        for rec in records:
             rec.writeTo(outFile)
-            i += 1
 
-            if (i + 1) % 10000 == 0:
-                print 'processed %d records, %d topics found so far' % (i + 1, len(outFiles))
 
-        logFile.close()
+def mergeRuns(runPaths, outPath, bufferSize):
+    parser = MergedLogParser([openLogParser(path) for path in runPaths])
+    with open(outPath, 'wb', bufferSize) as outFile:
+        for rec in parser:
+            rec.writeTo(outFile)
+    parser.close()
+
+
+def sortTopic(inPaths, outPath, tmpDir, maxOpenFiles, bufferSize, runRecords):
+    """
+    Writes the records in the logs @inPaths to @outPath sorted by
+    timestamp. Records with equal timestamps keep their input order.
+    Inputs are cut into sorted runs of at most @runRecords records,
+    which are merged at most @maxOpenFiles at a time.
+    """
+    runPaths = []
+    tmpPaths = []
+
+    def newTmpPath():
+        fd, path = tempfile.mkstemp(dir=tmpDir, prefix='run')
+        os.close(fd)
+        tmpPaths.append(path)
+        return path
+
+    for inPath in inPaths:
+        logStream = openLogParser(inPath)
+        records = []
+        numRuns = 0
+        for rec in logStream:
+            records.append(rec)
+            if len(records) >= runRecords:
+                records.sort(key=lambda r: r.timestamp)
+                runPaths.append(newTmpPath())
+                writeRecords(records, runPaths[-1], bufferSize)
+                records = []
+                numRuns += 1
+        if numRuns == 0 and isSorted(records):
+            # already sorted (the usual case), use the input as a run
+            runPaths.append(inPath)
+        elif records:
+            records.sort(key=lambda r: r.timestamp)
+            runPaths.append(newTmpPath())
+            writeRecords(records, runPaths[-1], bufferSize)
+        del records
+        logStream.close()
+
+    while len(runPaths) > maxOpenFiles:
+        mergedPaths = []
+        for i in xrange(0, len(runPaths), maxOpenFiles):
+            group = runPaths[i:(i + maxOpenFiles)]
+            if len(group) == 1:
+                mergedPaths.append(group[0])
+            else:
+                mergedPaths.append(newTmpPath())
+                mergeRuns(group, mergedPaths[-1], bufferSize)
+        runPaths = mergedPaths
+
+    tmpOutPath = outPath + '.tmp'
+    mergeRuns(runPaths, tmpOutPath, bufferSize)
+    os.rename(tmpOutPath, outPath)
+    for path in tmpPaths:
+        os.unlink(path)
+
+
+def sortTopicWorker(args):
+    return sortTopic(*args)
+
+
+def joinTopic(inPaths, outPath, bufferSize):
+    with open(outPath, 'wb', bufferSize) as outFile:
+        for inPath in inPaths:
+            with open(inPath, 'rb') as inFile:
+                shutil.copyfileobj(inFile, outFile, bufferSize)
+
+
+def joinTopicWorker(args):
+    return joinTopic(*args)
+
+
+def sortLogs(opts, logPaths):
+    outDir = opts.outputDir
+    if opts.jobs > 1 or opts.sortByTime:
+        # split into partitions, then join or sort them into outDir
+        tmpDir = tempfile.mkdtemp(dir=outDir, prefix='.zmqSortLogs-')
+        partDirs = []
+        for i in xrange(len(logPaths)):
+            partDirs.append(os.path.join(tmpDir, 'part%d' % i))
+            os.mkdir(partDirs[-1])
+    else:
+        tmpDir = None
+        partDirs = [outDir] * len(logPaths)
+
+    workerPool = None
+    if opts.jobs > 1:
+        workerPool = multiprocessing.Pool(opts.jobs)
+        mapFunc = workerPool.imap
+    else:
+        mapFunc = map
+
+    try:
+        if tmpDir is None:
+            # serial split straight into the output files
+            pool = OutputFilePool(outDir, opts.maxOpenFiles, opts.maxBufferedBytes)
+            for logPath in logPaths:
+                splitLog(logPath, pool, opts.quiet)
+            pool.close()
+            print 'wrote %d topics, reopened files %d times' % (len(pool.topics), pool.numReopened)
+            return
 
-    for outFile in outFiles.itervalues():
-        outFile.close()
+        topicsByPart = list(mapFunc(splitLogWorker,
+                                    [(logPath, partDir, opts.maxOpenFiles, opts.maxBufferedBytes, opts.quiet)
+                                     for logPath, partDir in zip(logPaths, partDirs)]))
+        allTopics = sorted(set().union(*topicsByPart))
+        print '=== %s %d topics' % ('sorting' if opts.sortByTime else 'joining', len(allTopics))
+        jobs = []
+        for topic in allTopics:
+            inPaths = [getOutputPath(partDir, topic)
+                       for partDir, topics in zip(partDirs, topicsByPart)
+                       if topic in topics]
+            outPath = getOutputPath(outDir, topic)
+            if opts.sortByTime:
+                jobs.append((inPaths, outPath, tmpDir, opts.maxOpenFiles, opts.bufferSize,
+                             opts.runRecords))
+            else:
+                jobs.append((inPaths, outPath, opts.bufferSize))
+        if opts.sortByTime:
+            worker = sortTopicWorker
+        else:
+            worker = joinTopicWorker
+        for _ in mapFunc(worker, jobs):
+            pass
+        print 'wrote %d topics' % len(allTopics)
+    finally:
+        if workerPool is not None:
+            workerPool.close()
+            workerPool.join()
+        if tmpDir is not None:
+            shutil.rmtree(tmpDir)
 
 
 def main():
     import optparse
     parser = optparse.OptionParser('usage: %prog <messages1.txt> <messages2.txt> ...')
+    parser.add_option('-o', '--outputDir',
+                      default='.',
+                      help='Directory to write per-topic logs to [%default]')
+    parser.add_option('-j', '--jobs',
+                      type='int', default=1,
+                      help='Number of worker processes to split logs with [%default]')
+    parser.add_option('--sortByTime',
+                      action='store_true', default=False,
+                      help='Sort the records for each topic by timestamp')
+    parser.add_option('--maxOpenFiles',
+                      type='int', default=DEFAULT_MAX_OPEN_FILES,
+                      help='Max output files each process keeps open [%default]')
+    parser.add_option('--maxBufferedBytes',
+                      type='int', default=DEFAULT_MAX_BUFFERED_BYTES,
+                      help='Max bytes of output each process buffers in memory before writing [%default]')
+    parser.add_option('--bufferSize',
+                      type='int', default=DEFAULT_BUFFER_SIZE,
+                      help='Write buffer size for sorting and joining, in bytes [%default]')
+    parser.add_option('--runRecords',
+                      type='int', default=DEFAULT_RUN_RECORDS,
+                      help='With --sortByTime, max records to sort in memory at once [%default]')
+    parser.add_option('-q', '--quiet',
+                      action='store_true', default=False,
+                      help='Reduce debug output')
     opts, args = parser.parse_args()
     if len(args) == 0:
         parser.error('expected at least 1 log file argument')
+    if opts.maxOpenFiles < 2:
+        parser.error('--maxOpenFiles must be at least 2')
     logging.basicConfig(level=logging.DEBUG)
 
     sortLogs(opts, args)
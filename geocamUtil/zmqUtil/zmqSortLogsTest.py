@@ -0,0 +1,144 @@
+#__BEGIN_LICENSE__
+# Copyright (c) 2017, United States Government, as represented by the
+# Administrator of the National Aeronautics and Space Administration.
+# All rights reserved.
+#
+# The GeoRef platform is licensed under the Apache License, Version 2.0
+# (the "License"); you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+# http://www.apache.org/licenses/LICENSE-2.0.
+#
+# Unless required by applicable law or agreed to in writing, software distributed
+# under the License is distributed on an "AS IS" BASIS, WITHOUT WARRANTIES OR
+# CONDITIONS OF ANY KIND, either express or implied. See the License for the
+# specific language governing permissions and limitations under the License.
+#__END_LICENSE__
+
+
+import os
+import sys
+import shutil
+import tempfile
+import unittest
+import StringIO
+
+from geocamUtil.zmqUtil import zmqSortLogs
+from geocamUtil.zmqUtil.zmqSortLogs import OutputFilePool, sortTopic, sortLogs, getOutputPath
+from geocamUtil.zmqUtil.util import openLogParser, LogRecord
+
+
+class SortLogsOpts(object):
+    quiet = True
+    maxOpenFiles = 2
+    maxBufferedBytes = 100
+    bufferSize = 4096
+    runRecords = 3
+
+    def __init__(self, outputDir, jobs=1, sortByTime=False):
+        self.outputDir = outputDir
+        self.jobs = jobs
+        self.sortByTime = sortByTime
+
+
+class ZmqSortLogsTest(unittest.TestCase):
+    def setUp(self):
+        self.tmpDir = tempfile.mkdtemp(prefix='zmqSortLogsTest')
+        self.realStdout = sys.stdout
+        sys.stdout = StringIO.StringIO()
+
+    def tearDown(self):
+        sys.stdout = self.realStdout
+        shutil.rmtree(self.tmpDir)
+
+    def makeDir(self, name):
+        path = os.path.join(self.tmpDir, name)
+        os.mkdir(path)
+        return path
+
+    def writeLog(self, name, records):
+        path = os.path.join(self.tmpDir, name)
+        out = open(path, 'wb')
+        for timestamp, msg in records:
+            LogRecord(timestamp, '-', msg).writeTo(out)
+        out.close()
+        return path
+
+    def readLog(self, path):
+        parser = openLogParser(path)
+        result = [(rec.timestamp, rec.msg) for rec in parser]
+        parser.close()
+        return result
+
+    def test_filePool(self):
+        outDir = self.makeDir('out')
+        pool = OutputFilePool(outDir, maxOpenFiles=2, maxBufferedBytes=1)
+        records = [LogRecord(1000 + i, '-', 't%d:%d' % (i % 4, i)) for i in xrange(20)]
+        for rec in records:
+            pool.write(rec)
+            self.assertTrue(len(pool.openFiles) <= 2)
+        pool.close()
+
+        # cycling through 4 topics with 2 files evicts a file each time
+        self.assertEqual(16, pool.numReopened)
+        self.assertEqual(set(['t0', 't1', 't2', 't3']), pool.topics)
+        for topic in pool.topics:
+            self.assertEqual([(rec.timestamp, rec.msg) for rec in records if rec.topic == topic],
+                             self.readLog(getOutputPath(outDir, topic)))
+
+    def test_filePoolOverwrites(self):
+        outDir = self.makeDir('out')
+        open(getOutputPath(outDir, 't0'), 'wb').write('old output\n')
+        pool = OutputFilePool(outDir)
+        pool.write(LogRecord(1000, '-', 't0:new'))
+        pool.close()
+        self.assertEqual([(1000, 't0:new')], self.readLog(getOutputPath(outDir, 't0')))
+
+    def test_sortTopic(self):
+        # equal timestamps must keep their input order
+        inPaths = [self.writeLog('in0.txt', [(1005, 't:a'), (1001, 't:b'), (1003, 't:c'),
+                                             (1003, 't:d'), (1000, 't:e'), (1004, 't:f'),
+                                             (1002, 't:g')]),
+                   self.writeLog('in1.txt', [(1001, 't:h'), (1003, 't:i')]),
+                   self.writeLog('in2.txt', [(1006, 't:j'), (1000, 't:k'), (1003, 't:l')])]
+        runDir = self.makeDir('runs')
+        outPath = os.path.join(self.tmpDir, 'out.txt')
+        # 3-record runs merged 2 at a time takes more than one pass
+        sortTopic(inPaths, outPath, runDir, 2, 4096, 3)
+        self.assertEqual([(1000, 't:e'), (1000, 't:k'), (1001, 't:b'), (1001, 't:h'),
+                          (1002, 't:g'), (1003, 't:c'), (1003, 't:d'), (1003, 't:i'),
+                          (1003, 't:l'), (1004, 't:f'), (1005, 't:a'), (1006, 't:j')],
+                         self.readLog(outPath))
+        self.assertEqual([], os.listdir(runDir))
+
+    def test_sortLogs(self):
+        logs = [[(1000 + 2 * i, 't%d:log0 %d' % (i % 3, i)) for i in xrange(20)],
+                [(1001 + 2 * i, 't%d:log1 %d' % (i % 4, i)) for i in xrange(20)]]
+        logPaths = [self.writeLog('log%d.txt' % i, records) for i, records in enumerate(logs)]
+        topics = ['t0', 't1', 't2', 't3']
+
+        outputs = {}
+        for name, jobs, sortByTime in (('serial', 1, False),
+                                       ('jobs', 2, False),
+                                       ('sorted', 1, True),
+                                       ('sortedJobs', 2, True)):
+            outDir = self.makeDir(name)
+            sortLogs(SortLogsOpts(outDir, jobs, sortByTime), logPaths)
+            self.assertEqual(sorted([topic + zmqSortLogs.OUTPUT_SUFFIX for topic in topics]),
+                             sorted(os.listdir(outDir)))
+            outputs[name] = dict([(topic, self.readLog(getOutputPath(outDir, topic)))
+                                  for topic in topics])
+
+        for topic in topics:
+            # records are grouped by input log unless sorted
+            expected = [(timestamp, msg)
+                        for records in logs
+                        for timestamp, msg in records
+                        if msg.startswith(topic + ':')]
+            self.assertEqual(expected, outputs['serial'][topic])
+            self.assertEqual(expected, outputs['jobs'][topic])
+            self.assertEqual(sorted(expected), outputs['sorted'][topic])
+            self.assertEqual(sorted(expected), outputs['sortedJobs'][topic])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -16,49 +16,457 @@
 # specific language governing permissions and limitations under the License.
 #__END_LICENSE__
 
+"""
+Compiles traffic statistics from zmqCentral message logs.
+
+Record headers are parsed straight into NumPy arrays of timestamps,
+message sizes and topic ids, and the statistics are computed on the
+arrays rather than record by record. For each topic, and for each
+module (topics grouped by their first --moduleDepth components), it
+collects message counts and bytes per time bin of --binSecs seconds and
+a histogram of the gaps between consecutive messages on the same topic.
+With --jobs N, logs are processed in N worker processes. Results can be
+exported with --csv and --json.
+"""
+
+import csv
 import logging
-from collections import defaultdict
 import datetime
+import itertools
+import multiprocessing
+
+import numpy as np
+
+from geocamUtil import anyjson as json
+from geocamUtil.zmqUtil.util import openLogParser, MmapLogParser, LOG_HEADER_REGEX
+
+USECS_PER_SEC = 1000000
+USECS_PER_DAY = 86400 * USECS_PER_SEC
+DEFAULT_BIN_SECS = 3600
+DEFAULT_GAP_EDGES = '0.001,0.01,0.1,1,10,60,600,3600'
+
+# amount of log to parse at once
+CHUNK_BYTES = 64 * 1024 * 1024
+CHUNK_RECORDS = 500000
+
+# time bin keys pack the bin number and topic id into one int64
+MAX_TOPICS = 1 << 20
+
+
+class LogStats(object):
+    """
+    Statistics for a set of log records. Use fromArrays() to compile
+    statistics for a chunk of records and merge() to combine the chunks
+    in the order they were logged.
+    """
+    def __init__(self, binUsecs, gapEdges):
+        self.binUsecs = binUsecs
+        self.gapEdges = gapEdges
+        self.topics = []
+        self.topicIds = {}
+        self.count = np.zeros(0, np.int64)
+        self.bytes = np.zeros(0, np.int64)
+        self.firstTime = np.zeros(0, np.int64)
+        self.lastTime = np.zeros(0, np.int64)
+        self.gapSum = np.zeros(0, np.float64)
+        self.gapCounts = np.zeros((0, len(gapEdges) + 1), np.int64)
+        # sparse time bins, sorted by key
+        self.binKeys = np.zeros(0, np.int64)
+        self.binCounts = np.zeros(0, np.int64)
+        self.binBytes = np.zeros(0, np.int64)
+
+    @classmethod
+    def fromArrays(cls, binUsecs, gapEdges, timestamps, sizes, topicIds, topics):
+        """
+        Compiles statistics for records with @timestamps and @sizes whose
+        topics are @topics[@topicIds].
+        """
+        if len(topics) > MAX_TOPICS:
+            raise ValueError('too many topics (%d), max is %d' % (len(topics), MAX_TOPICS))
+        stats = cls(binUsecs, gapEdges)
+        numTopics = len(topics)
+        stats.topics = list(topics)
+        stats.topicIds = dict(((topic, i) for i, topic in enumerate(topics)))
+        stats.count = np.bincount(topicIds, minlength=numTopics).astype(np.int64)
+        stats.bytes = np.bincount(topicIds, weights=sizes, minlength=numTopics).astype(np.int64)
+
+        keys = (timestamps // binUsecs) * MAX_TOPICS + topicIds
+        stats.binKeys, inverse = np.unique(keys, return_inverse=True)
+        stats.binCounts = np.bincount(inverse).astype(np.int64)
+        stats.binBytes = np.bincount(inverse, weights=sizes).astype(np.int64)
+
+        # sort by topic, then time, to find the gaps within each topic
+        order = np.lexsort((timestamps, topicIds))
+        sortedTopics = topicIds[order]
+        sortedTimes = timestamps[order]
+        isFirst = np.ones(len(order), dtype=bool)
+        isFirst[1:] = sortedTopics[1:] != sortedTopics[:-1]
+        isLast = np.ones(len(order), dtype=bool)
+        isLast[:-1] = isFirst[1:]
+        stats.firstTime = np.full(numTopics, -1, np.int64)
+        stats.firstTime[sortedTopics[isFirst]] = sortedTimes[isFirst]
+        stats.lastTime = np.full(numTopics, -1, np.int64)
+        stats.lastTime[sortedTopics[isLast]] = sortedTimes[isLast]
+
+        stats.gapSum = np.zeros(numTopics, np.float64)
+        stats.gapCounts = np.zeros((numTopics, len(gapEdges) + 1), np.int64)
+        isGap = ~isFirst[1:]
+        stats.addGaps((sortedTimes[1:] - sortedTimes[:-1])[isGap], sortedTopics[1:][isGap])
+        return stats
+
+    def addGaps(self, gaps, gapTopics):
+        numGapBins = self.gapCounts.shape[1]
+        gapBins = np.searchsorted(self.gapEdges, gaps, side='right')
+        counts = np.bincount(gapTopics * numGapBins + gapBins, minlength=self.gapCounts.size)
+        self.gapCounts += counts.reshape(self.gapCounts.shape)
+        self.gapSum += np.bincount(gapTopics, weights=gaps, minlength=len(self.topics))
+
+    def getTopicId(self, topic):
+        topicId = self.topicIds.get(topic)
+        if topicId is None:
+            topicId = len(self.topics)
+            self.topics.append(topic)
+            self.topicIds[topic] = topicId
+        return topicId
+
+    def resize(self, numTopics):
+        extra = numTopics - len(self.count)
+        if extra <= 0:
+            return
+        if numTopics > MAX_TOPICS:
+            raise ValueError('too many topics (%d), max is %d' % (numTopics, MAX_TOPICS))
+        self.count = np.append(self.count, np.zeros(extra, np.int64))
+        self.bytes = np.append(self.bytes, np.zeros(extra, np.int64))
+        self.firstTime = np.append(self.firstTime, np.full(extra, -1, np.int64))
+        self.lastTime = np.append(self.lastTime, np.full(extra, -1, np.int64))
+        self.gapSum = np.append(self.gapSum, np.zeros(extra, np.float64))
+        self.gapCounts = np.vstack((self.gapCounts,
+                                    np.zeros((extra, self.gapCounts.shape[1]), np.int64)))
+
+    def mergeBins(self, keys, counts, numBytes):
+        allKeys = np.concatenate((self.binKeys, keys))
+        self.binKeys, inverse = np.unique(allKeys, return_inverse=True)
+        self.binCounts = np.bincount(inverse, weights=np.concatenate((self.binCounts, counts))).astype(np.int64)
+        self.binBytes = np.bincount(inverse, weights=np.concatenate((self.binBytes, numBytes))).astype(np.int64)
+
+    def merge(self, other):
+        """
+        Adds the statistics in @other, which should cover records logged
+        after the ones already here. The gap between the last message on
+        a topic here and the first one in @other is counted too.
+        """
+        if not other.topics:
+            return
+        mapping = np.array([self.getTopicId(topic) for topic in other.topics], dtype=np.int64)
+        self.resize(len(self.topics))
+
+        last = self.lastTime[mapping]
+        isGap = (last >= 0) & (other.firstTime >= last)
+        self.addGaps((other.firstTime - last)[isGap], mapping[isGap])
+
+        self.count[mapping] += other.count
+        self.bytes[mapping] += other.bytes
+        self.gapSum[mapping] += other.gapSum
+        self.gapCounts[mapping] += other.gapCounts
+        first = self.firstTime[mapping]
+        self.firstTime[mapping] = np.where((first < 0) | (other.firstTime < first),
+                                           other.firstTime, first)
+        self.lastTime[mapping] = np.maximum(last, other.lastTime)
+
+        self.mergeBins((other.binKeys // MAX_TOPICS) * MAX_TOPICS + mapping[other.binKeys % MAX_TOPICS],
+                       other.binCounts, other.binBytes)
+
+    def groupBy(self, getGroup):
+        """
+        Returns statistics with the topics combined into groups named by
+        getGroup(topic). Gap histograms still count the gaps between
+        messages on the same topic.
+        """
+        groups = LogStats(self.binUsecs, self.gapEdges)
+        mapping = np.array([groups.getTopicId(getGroup(topic)) for topic in self.topics],
+                           dtype=np.int64)
+        numGroups = len(groups.topics)
+        groups.resize(numGroups)
+        if not len(mapping):
+            return groups
+        groups.count = np.bincount(mapping, weights=self.count, minlength=numGroups).astype(np.int64)
+        groups.bytes = np.bincount(mapping, weights=self.bytes, minlength=numGroups).astype(np.int64)
+        groups.gapSum = np.bincount(mapping, weights=self.gapSum, minlength=numGroups)
+        np.add.at(groups.gapCounts, mapping, self.gapCounts)
+        hasTime = self.firstTime >= 0
+        groups.firstTime[:] = np.iinfo(np.int64).max
+        np.minimum.at(groups.firstTime, mapping[hasTime], self.firstTime[hasTime])
+        groups.firstTime[groups.firstTime == np.iinfo(np.int64).max] = -1
+        np.maximum.at(groups.lastTime, mapping, self.lastTime)
+        groups.mergeBins((self.binKeys // MAX_TOPICS) * MAX_TOPICS + mapping[self.binKeys % MAX_TOPICS],
+                         self.binCounts, self.binBytes)
+        return groups
+
+    def getMeanGapSecs(self):
+        numGaps = self.gapCounts.sum(axis=1)
+        with np.errstate(invalid='ignore', divide='ignore'):
+            return np.where(numGaps > 0, self.gapSum / np.maximum(numGaps, 1) / USECS_PER_SEC, np.nan)
+
+    def getBins(self, topicId):
+        """
+        Returns (binStartUsecs, counts, bytes) arrays for the time bins
+        of @topicId that have messages.
+        """
+        mask = (self.binKeys % MAX_TOPICS) == topicId
+        return ((self.binKeys[mask] // MAX_TOPICS) * self.binUsecs,
+                self.binCounts[mask],
+                self.binBytes[mask])
+
+
+def getTopicIdArray(topics):
+    """
+    Returns (topicIds, uniqueTopics) for the list of topic strings
+    @topics.
+    """
+    uniqueTopics = sorted(set(topics))
+    ids = dict(((topic, i) for i, topic in enumerate(uniqueTopics)))
+    return np.array(map(ids.__getitem__, topics), dtype=np.int64), uniqueTopics
+
+
+def parseChunk(buf, start, end):
+    """
+    Parses the headers of the records in buf[@start:@end] in one pass.
+    Returns (timestamps, sizes, topics), or None if the headers found
+    don't account for exactly the bytes in the chunk, which happens if
+    the chunk is corrupt or a message contains something that looks like
+    a record header.
+    """
+    fields = list(itertools.chain.from_iterable(LOG_HEADER_REGEX.findall(buf, start, end)))
+    timestampStrs = fields[0::5]
+    sizeStrs = fields[1::5]
+    attachmentStrs = fields[2::5]
+    topics = fields[3::5]
+    numRecords = len(timestampStrs)
+    sizes = np.fromstring(' '.join(sizeStrs), dtype=np.int64, sep=' ')
+    if len(sizes) != numRecords:
+        return None
+    # each record is '@@@ <timestamp> <size> <attachments> <msg>\n'
+    numBytes = (numRecords * 8
+                + len(''.join(timestampStrs))
+                + len(''.join(sizeStrs))
+                + len(''.join(attachmentStrs))
+                + int(sizes.sum()))
+    if numBytes != end - start:
+        return None
+    if '' in fields[4::5]:
+        # a message without a colon has the whole message as its topic,
+        # which the header pattern only finds if it has no newlines
+        for topic, colon, size in itertools.izip(topics, fields[4::5], sizes):
+            if not colon and len(topic) != size:
+                return None
+    timestamps = np.fromstring(' '.join(timestampStrs), dtype=np.int64, sep=' ')
+    return timestamps, sizes, topics
 
-from geocamUtil.zmqUtil.util import LogParser
 
-MSECS_PER_HOUR = 3600 * 1000000
+def getRecordArrays(records):
+    timestamps = []
+    sizes = []
+    topics = []
+    for rec in records:
+        timestamps.append(rec.timestamp)
+        sizes.append(len(rec.getBuffer()))
+        topics.append(rec.topic)
+    return (np.array(timestamps, dtype=np.int64),
+            np.array(sizes, dtype=np.int64),
+            topics)
+
+
+def iterChunks(parser):
+    """
+    Yields (timestamps, sizes, topics) for consecutive chunks of the log
+    read by @parser.
+    """
+    if not isinstance(parser, MmapLogParser):
+        records = iter(parser)
+        while True:
+            chunk = list(itertools.islice(records, CHUNK_RECORDS))
+            if not chunk:
+                return
+            yield getRecordArrays(chunk)
+
+    buf = parser.buf
+    bufSize = len(buf)
+    start = 0
+    while start < bufSize:
+        end = start + CHUNK_BYTES
+        if end >= bufSize:
+            end = bufSize
+        else:
+            nextRecord = buf.find('\n@@@ ', end)
+            if nextRecord == -1:
+                end = bufSize
+            else:
+                end = nextRecord + 1
+        arrays = parseChunk(buf, start, end)
+        if arrays is None:
+            # fall back to framing each record by its length
+            records = list(parser.iterRange(start, end))
+            if records:
+                end = max(end, records[-1].start + records[-1].size + 1)
+            arrays = getRecordArrays(records)
+        yield arrays
+        start = end
+
+
+def statLog(logPath, binUsecs, gapEdges):
+    stats = LogStats(binUsecs, gapEdges)
+    parser = openLogParser(logPath)
+    for timestamps, sizes, topics in iterChunks(parser):
+        if len(timestamps):
+            topicIds, uniqueTopics = getTopicIdArray(topics)
+            stats.merge(LogStats.fromArrays(binUsecs, gapEdges, timestamps, sizes,
+                                            topicIds, uniqueTopics))
+    parser.close()
+    return logPath, stats
+
+
+def statLogWorker(args):
+    return statLog(*args)
+
+
+def getModule(topic, moduleDepth):
+    return '.'.join(topic.split('.')[:moduleDepth])
+
+
+def getGapLabels(gapEdgesSecs):
+    labels = ['<%gs' % gapEdgesSecs[0]]
+    for lo, hi in zip(gapEdgesSecs[:-1], gapEdgesSecs[1:]):
+        labels.append('%g-%gs' % (lo, hi))
+    labels.append('>=%gs' % gapEdgesSecs[-1])
+    return labels
+
+
+def formatBinTime(binStartUsecs, binUsecs):
+    utcDt = datetime.datetime.utcfromtimestamp(binStartUsecs // USECS_PER_SEC)
+    if binUsecs % (3600 * USECS_PER_SEC) == 0:
+        return utcDt.strftime('%Y-%m-%d %H:00')
+    if binUsecs % (60 * USECS_PER_SEC) == 0:
+        return utcDt.strftime('%Y-%m-%d %H:%M')
+    if binUsecs % USECS_PER_SEC == 0:
+        return utcDt.strftime('%Y-%m-%d %H:%M:%S')
+    return '%s.%06d' % (utcDt.strftime('%Y-%m-%d %H:%M:%S'), binStartUsecs % USECS_PER_SEC)
+
+
+def printTimeBins(total):
+    binStarts, counts, _bytes = total.getBins(0)
+    if not len(binStarts):
+        return
+    binUsecs = total.binUsecs
+    countByBin = dict(itertools.izip(binStarts.tolist(), counts.tolist()))
+    print
+    for binStart in xrange(int(binStarts[0]), int(binStarts[-1]) + 1, binUsecs):
+        if binStart % USECS_PER_DAY == 0:
+            print
+        print '%s %6d' % (formatBinTime(binStart, binUsecs), countByBin.get(binStart, 0))
+    print
+
+
+def printSummary(stats, title, top):
+    order = np.argsort(-stats.count, kind='mergesort')
+    if top:
+        order = order[:top]
+    meanGaps = stats.getMeanGapSecs()
+    print '%-40s %10s %12s %10s %12s' % (title, 'messages', 'bytes', 'msgs/sec', 'mean gap (s)')
+    for i in order:
+        durationSecs = float(stats.lastTime[i] - stats.firstTime[i]) / USECS_PER_SEC
+        if durationSecs > 0:
+            rate = '%10.3f' % (stats.count[i] / durationSecs)
+        else:
+            rate = '%10s' % '-'
+        if np.isnan(meanGaps[i]):
+            meanGap = '%12s' % '-'
+        else:
+            meanGap = '%12.3f' % meanGaps[i]
+        print '%-40s %10d %12d %s %s' % (stats.topics[i], stats.count[i], stats.bytes[i], rate, meanGap)
+    if top and len(stats.topics) > top:
+        print '(%d more not shown)' % (len(stats.topics) - top)
+    print
+
+
+def writeCsv(path, levels):
+    binSecs = None
+    with open(path, 'wb') as out:
+        writer = csv.writer(out)
+        writer.writerow(['level', 'name', 'binStartUsecs', 'binStart',
+                         'messages', 'bytes', 'msgsPerSec', 'bytesPerSec'])
+        for level, stats in levels:
+            binSecs = float(stats.binUsecs) / USECS_PER_SEC
+            for i, name in enumerate(stats.topics):
+                for binStart, count, numBytes in zip(*stats.getBins(i)):
+                    writer.writerow([level, name, binStart,
+                                     formatBinTime(binStart, stats.binUsecs),
+                                     count, numBytes,
+                                     '%g' % (count / binSecs),
+                                     '%g' % (numBytes / binSecs)])
+
+
+def getJsonSummary(stats, i):
+    meanGap = stats.getMeanGapSecs()[i]
+    binStarts, counts, numBytes = stats.getBins(i)
+    return {'messages': int(stats.count[i]),
+            'bytes': int(stats.bytes[i]),
+            'firstTime': int(stats.firstTime[i]),
+            'lastTime': int(stats.lastTime[i]),
+            'meanGapSecs': None if np.isnan(meanGap) else float(meanGap),
+            'gapHistogram': stats.gapCounts[i].tolist(),
+            'bins': zip(binStarts.tolist(), counts.tolist(), numBytes.tolist())}
+
+
+def writeJson(path, levels, gapEdgesSecs):
+    result = {'binSecs': float(levels[0][1].binUsecs) / USECS_PER_SEC,
+              'gapEdgesSecs': gapEdgesSecs,
+              'gapLabels': getGapLabels(gapEdgesSecs)}
+    for level, stats in levels:
+        result[level] = dict(((name, getJsonSummary(stats, i))
+                              for i, name in enumerate(stats.topics)))
+    with open(path, 'wb') as out:
+        json.dump(result, out, sort_keys=True, indent=4)
 
 
 def statLogs(opts, logPaths):
-    i = 0
-    for logPath in logPaths:
-        count = defaultdict(int)
-        print '=== compiling statistics on %s' % logPath
-        logFile = open(logPath, 'rb')
-        logStream = LogParser(logFile)
-        for rec in logStream:
-            bucket = int(rec.timestamp / MSECS_PER_HOUR)
-            count[bucket] += 1
-            i += 1
-
-            if i % 10000 == 0:
-                if not opts.quiet:
-                    print 'processed %d records' % i
-
-        buckets = sorted(count.keys())
-        minBucket = buckets[0]
-        maxBucket = buckets[-1]
-
-        print
-        total = 0
-        for bucket in xrange(minBucket, maxBucket + 1):
-            posixTimeStamp = bucket * 3600
-            utcDt = datetime.datetime.utcfromtimestamp(posixTimeStamp)
-            timeString = utcDt.strftime('%Y-%m-%d %H:00')
-            if timeString.endswith('00:00'):
-                print
-            print '%s %6d' % (timeString, count[bucket])
-            total += count[bucket]
-        print
-        print 'Total: %d' % total
-
-        logFile.close()
+    binUsecs = int(opts.binSecs * USECS_PER_SEC)
+    gapEdgesSecs = [float(edge) for edge in opts.gapEdges.split(',')]
+    gapEdges = np.array([int(edge * USECS_PER_SEC) for edge in gapEdgesSecs], dtype=np.int64)
+
+    jobs = [(logPath, binUsecs, gapEdges) for logPath in logPaths]
+    workerPool = None
+    if opts.jobs > 1:
+        workerPool = multiprocessing.Pool(opts.jobs)
+        results = workerPool.imap(statLogWorker, jobs)
+    else:
+        results = itertools.imap(statLogWorker, jobs)
+
+    stats = LogStats(binUsecs, gapEdges)
+    for logPath, logStats in results:
+        if not opts.quiet:
+            print '=== compiled statistics on %s: %d records' % (logPath, logStats.count.sum())
+        stats.merge(logStats)
+    if workerPool is not None:
+        workerPool.close()
+        workerPool.join()
+
+    modules = stats.groupBy(lambda topic: getModule(topic, opts.moduleDepth))
+    total = stats.groupBy(lambda topic: 'all')
+
+    printTimeBins(total)
+    print 'Total: %d' % total.count.sum()
+    print
+    printSummary(modules, 'module', opts.top)
+    printSummary(stats, 'topic', opts.top)
+    print 'gap histogram bins: %s' % ' '.join(getGapLabels(gapEdgesSecs))
+    for name, gapCounts in zip(total.topics, total.gapCounts):
+        print '%s: %s' % (name, ' '.join([str(c) for c in gapCounts]))
+
+    levels = [('all', total), ('modules', modules), ('topics', stats)]
+    if opts.csv:
+        writeCsv(opts.csv, levels)
+    if opts.json:
+        writeJson(opts.json, levels, gapEdgesSecs)
 
 
 def main():
@@ -67,9 +475,30 @@ def main():
     parser.add_option('-q', '--quiet',
                       action='store_true', default=False,
                       help='Reduce debug output')
+    parser.add_option('-b', '--binSecs',
+                      type='float', default=DEFAULT_BIN_SECS,
+                      help='Width of time bins for message rates, in seconds [%default]')
+    parser.add_option('--gapEdges',
+                      default=DEFAULT_GAP_EDGES,
+                      help='Comma-separated bin edges for the inter-arrival gap histogram, in seconds [%default]')
+    parser.add_option('--moduleDepth',
+                      type='int', default=1,
+                      help='Number of leading topic components that name the module [%default]')
+    parser.add_option('-j', '--jobs',
+                      type='int', default=1,
+                      help='Number of worker processes [%default]')
+    parser.add_option('--top',
+                      type='int', default=20,
+                      help='Number of busiest modules and topics to print, or 0 for all [%default]')
+    parser.add_option('--csv',
+                      help='Write message counts and bytes per time bin to this CSV file')
+    parser.add_option('--json',
+                      help='Write all statistics to this JSON file')
     opts, args = parser.parse_args()
     if len(args) == 0:
         parser.error('expected at least 1 log file argument')
+    if opts.binSecs < 0.001:
+        parser.error('--binSecs must be at least 0.001')
     logging.basicConfig(level=logging.DEBUG)
 
     statLogs(opts, args)
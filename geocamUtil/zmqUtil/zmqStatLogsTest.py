@@ -0,0 +1,123 @@
+#__BEGIN_LICENSE__
+# Copyright (c) 2017, United States Government, as represented by the
+# Administrator of the National Aeronautics and Space Administration.
+# All rights reserved.
+#
+# The GeoRef platform is licensed under the Apache License, Version 2.0
+# (the "License"); you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+# http://www.apache.org/licenses/LICENSE-2.0.
+#
+# Unless required by applicable law or agreed to in writing, software distributed
+# under the License is distributed on an "AS IS" BASIS, WITHOUT WARRANTIES OR
+# CONDITIONS OF ANY KIND, either express or implied. See the License for the
+# specific language governing permissions and limitations under the License.
+#__END_LICENSE__
+
+import os
+import sys
+import gzip
+import shutil
+import tempfile
+import unittest
+import StringIO
+
+from geocamUtil.zmqUtil import zmqStatLogs
+from geocamUtil.zmqUtil.util import openLogParser, LogParser
+
+MESSAGES = ['nocolon',
+            'rover.pose:{"x": 1}',
+            'multi\nline',
+            'rover.note:{"text": "a\nb"}',
+            ':{}']
+TOPICS = ['nocolon', 'rover.pose', 'multi\nline', 'rover.note', '']
+
+
+class StatLogsOpts(object):
+    quiet = True
+    binSecs = 1.0
+    gapEdges = zmqStatLogs.DEFAULT_GAP_EDGES
+    moduleDepth = 1
+    top = 0
+    csv = None
+    json = None
+
+    def __init__(self, jobs):
+        self.jobs = jobs
+
+
+class ZmqStatLogsTest(unittest.TestCase):
+    def setUp(self):
+        self.tmpDir = tempfile.mkdtemp(prefix='zmqStatLogsTest')
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpDir)
+
+    def writeLog(self, name, messages, startTime=1000000, compress=False):
+        path = os.path.join(self.tmpDir, name)
+        if compress:
+            out = gzip.open(path, 'wb')
+        else:
+            out = open(path, 'wb')
+        for i, msg in enumerate(messages):
+            out.write('@@@ %d %d - %s\n' % (startTime + i * 10000, len(msg), msg))
+        out.close()
+        return path
+
+    def getChunkTopics(self, path):
+        parser = openLogParser(path)
+        topics = []
+        for _timestamps, _sizes, chunkTopics in zmqStatLogs.iterChunks(parser):
+            topics.extend(chunkTopics)
+        parser.close()
+        return topics
+
+    def test_topics(self):
+        path = self.writeLog('log.txt', MESSAGES)
+        parser = openLogParser(path)
+        buf = parser.buf
+        # the one-pass header parser falls back to framing each record
+        # because of the message without a colon that has a newline
+        self.assertEqual(None, zmqStatLogs.parseChunk(buf, 0, len(buf)))
+        self.assertEqual(TOPICS, [rec.topic for rec in parser])
+        parser.close()
+        parser = LogParser(open(path, 'rb'))
+        self.assertEqual(TOPICS, [rec.topic for rec in parser])
+        parser.close()
+        self.assertEqual(TOPICS, self.getChunkTopics(path))
+
+        # the same topics from a compressed log, record by record
+        gzPath = self.writeLog('log.txt.gz', MESSAGES, compress=True)
+        self.assertEqual(TOPICS, self.getChunkTopics(gzPath))
+
+        # and from the one-pass parser when it can handle the chunk
+        path = self.writeLog('simple.txt', ['nocolon', 'rover.pose:{}'])
+        parser = openLogParser(path)
+        self.assertEqual(['nocolon', 'rover.pose'], zmqStatLogs.parseChunk(parser.buf, 0, len(parser.buf))[2])
+        parser.close()
+
+    def statLogs(self, jobs, logPaths):
+        opts = StatLogsOpts(jobs)
+        opts.json = os.path.join(self.tmpDir, 'stats%d.json' % jobs)
+        realStdout = sys.stdout
+        sys.stdout = StringIO.StringIO()
+        try:
+            zmqStatLogs.statLogs(opts, logPaths)
+            output = sys.stdout.getvalue()
+        finally:
+            sys.stdout = realStdout
+        return output, open(opts.json, 'rb').read()
+
+    def test_jobs(self):
+        messages = [('rover.pose:{"i": %d}', 'rover.battery:{"i": %d}', 'base.status:{"i": %d}', 'nocolon %d')[i % 4] % i
+                    for i in xrange(500)]
+        logPaths = [self.writeLog('log1.txt', messages),
+                    self.writeLog('log2.txt.gz', messages, startTime=9000000, compress=True),
+                    self.writeLog('log3.txt', MESSAGES, startTime=20000000)]
+        serial = self.statLogs(1, logPaths)
+        self.assertTrue('nocolon 3' in serial[1])
+        self.assertEqual(serial, self.statLogs(2, logPaths))
+
+
+if __name__ == '__main__':
+    unittest.main()